@@ -6,13 +6,25 @@
 import pygame
 
 import os
-from random import randint, shuffle
+from random import Random, randint, shuffle, getrandbits
 from itertools import permutations
 import time
 import math
 from operator import itemgetter
 from copy import copy
 
+import numpy as np
+
+import bitboard
+import batch_eval
+import eval_tables
+import mcts
+import rollout
+from transposition import TranspositionTable, LeafCache, MAX_NODE, CHANCE_NODE, MIN_NODE, EXACT, LOWER, UPPER
+from parallel import ParallelSearch
+from ai_worker import AIWorker
+from replay import GameRecorder, open_log
+
 # Import pygame.locals for easier access to key coordinates
 # Updated to conform to flake8 and black standards
 from pygame.locals import (
@@ -26,6 +38,9 @@ from pygame.locals import (
     K_a,
     K_r,
     K_b,
+    K_m,
+    K_t,
+    K_p,
     KEYDOWN,
     QUIT,
 )
@@ -47,10 +62,72 @@ def print_directions():
     print("\tE to start Expectimax Algorithm")
     print("\tB to use combination of both")
     print("\tR to move randomly")
+    print("\tM to use Monte Carlo rollouts")
+    print("\tP to pause or resume the AI, ESCAPE to stop it")
+    print("\tT to turn turbo mode on or off, the AI then plays at full speed")
+    print("\t  and the board is only drawn 10 times a second")
 
 def manualcopy(lst):
 	return [list(lst[0]),list(lst[1]),list(lst[2]),list(lst[3])]
 
+# fonts by size and tile surfaces by value, made once and reused
+# by print_pygame
+_fonts = {}
+_tile_surfaces = {}
+
+def get_font(size):
+	font = _fonts.get(size)
+	if font is None:
+		font = _fonts[size] = pygame.font.SysFont(None, size)
+	return font
+
+# raised inside a search when its deadline has passed
+class SearchTimeout(Exception):
+	pass
+
+##########################################################
+# Move make/unmake for list boards
+#
+# MOVE_LINES holds the cells of the four lines of every move,
+# each starting at the wall the tiles move towards. move2 slides
+# every line on its own, so a move is the same line slide four
+# times. slide_line gives the result of one line and its score,
+# and _line_moves keeps the results of the lines seen so far.
+##########################################################
+MOVE_LINES = {
+	1: [(4*r, 4*r+1, 4*r+2, 4*r+3) for r in range(4)],
+	2: [(c, c+4, c+8, c+12) for c in range(4)],
+	3: [(4*r+3, 4*r+2, 4*r+1, 4*r) for r in range(4)],
+	4: [(c+12, c+8, c+4, c) for c in range(4)],
+}
+_line_moves = {}
+
+##########################################################
+# slides and merges the tile values of line towards its first
+# cell, walking the tiles like the left branch of move2. Returns
+# the new line and the score of its merges.
+##########################################################
+def slide_line(line):
+	lst = list(line)
+	score = 0
+	for i in range(1, 4):
+		if lst[i] != 0:
+			# sentinel value, tiles can only combine once a move
+			sentinel = 0
+			while i != 0:
+				if lst[i] == lst[i-1] and sentinel == 0:
+					sentinel = 1
+					lst[i-1] = 0
+					lst[i] *= 2
+					score += lst[i]
+				if lst[i-1] == 0:
+					lst[i-1] = lst[i]
+					lst[i] = 0
+					i -= 1
+				else:
+					break
+	return tuple(lst), score
+
 ##########################################################
 # 2048 Game class
 #
@@ -58,22 +135,101 @@ def manualcopy(lst):
 # adversarial search algorithm implementations
 ##########################################################
 class Game2048:
-	# initialize the start of the game
-	def __init__(self):
+	# optional TranspositionTable used by expectimax and alphabeta
+	tt = None
+	# largest tile that can merge, None when there is no limit
+	merge_limit = None
+	# path probability below which expectimax stops expanding chance
+	# nodes, None samples spawns with get_child_boards instead
+	prob_cutoff = None
+	# optional ParallelSearch that expectimax and alphabeta hand off to
+	parallel = None
+	# optional evaluator (an ntuple.NTupleNetwork) that expectimax and
+	# alphabeta score leaves with instead of the heuristic
+	evaluator = None
+	# mcts.MCTS tree kept between moves by the mcts method
+	tree = None
+	# optional LeafCache, expectimax keeps the values of the leaves it
+	# scored for the next move
+	leaf_cache = None
+	# optional search_stats.SearchStats, expectimax and alphabeta then
+	# write what every search did to its file
+	search_stats = None
+	# key the transposition table, leaf cache and move orders on the
+	# canonical form of boards (see symmetry_key). Only exact when
+	# the evaluation is the same on all eight symmetries of a board,
+	# like the n-tuple evaluator. The hand tuned heuristic is not.
+	symmetric_keys = False
+	# alphabeta tries moves in the order of a history table (how often
+	# and how deep each move was the best) and spawns by how much
+	# they hurt in sibling nodes (the same depth) first. The tables
+	# are kept between searches and halved at the start of each.
+	alphabeta_ordering = True
+	# principal variation search in alphabeta: children after the
+	# first are tried with a null window and only searched again
+	# with the full window if they can change the value
+	pvs = False
+	# turns on Star1 pruning of the chance nodes of expectimax with
+	# the bound of leaf_upper_bound (see expectimax)
+	star1 = False
+	# half width of the window alphabeta_timed searches each depth
+	# with, around the value of the iteration two plies before. None
+	# always searches with a full window.
+	aspiration_window = None
+	# value of the move the last expectimax or alphabeta search
+	# returned (not set by a ParallelSearch)
+	last_value = None
+	# optional replay.GameRecorder that play writes every move to
+	recorder = None
+	# turbo mode of print_pygame: draw at most every render_every
+	# moves and at most max_fps times a second (None for no limit)
+	render_every = 1
+	max_fps = None
+
+	# initialize the start of the game. Tiles spawn from a random
+	# generator seeded with seed, a random seed when it is None, so
+	# a seed and the moves played decide the whole game.
+	def __init__(self, seed=None):
+		# a new game starts with an empty transposition table
+		if self.tt is not None:
+			self.tt.clear()
+		if self.tree is not None:
+			self.tree.clear()
+		if self.leaf_cache is not None:
+			self.leaf_cache.clear()
+
 		# create the board
 		self.board = [0 for _ in range(16)]
-		# board 2 is used to check if the board changes after a move
+		# board 2 is the board as print_pygame last drew it
 		self.board2 = [-1 for _ in range(16)]
+		self.drawn_score = None
+		self.last_render = 0.0
 		# score of the game, sum of all combinations of tiles
 		self.score = 0
 
+		if seed is None:
+			seed = getrandbits(64)
+		self.seed = seed
+		self.rng = Random(seed)
+		# moves made with play
+		self.moves_played = 0
+		# (cell, value) of the last tile spawn_blocks placed
+		self.last_spawn = None
+		# alphabeta's ordering tables, see alphabeta_ordering. Index 0
+		# of move_history is unused, moves are 1-4.
+		self.move_history = [0]*5
+		self.spawn_damage = {}
+		# (evaluator, its upper_bound()), see leaf_upper_bound
+		self._evaluator_bound = None
+
 		# spawn in first two tiles, always a four and a two.
 		for k in range(2):
-			i = randint(0,16)
+			i = self.rng.randint(0,15)
 			if k == 1:
 				self.board[i] = 2
 			else:
 				self.board[i] = 4
+		self.start_board = list(self.board)
 
 		# dictionary holding colors of tile values
 		self.color_dict = {
@@ -133,11 +289,34 @@ class Game2048:
 		else:
 			# spawn a two in a random open tile, but with a 10% chance
 			# spawn a 4 instead.
-			cell_num = empty_cells[randint(0,len(empty_cells)-1)]
+			cell_num = empty_cells[self.rng.randint(0,len(empty_cells)-1)]
 			cell_value = 2
-			if randint(0,9) == 0:
+			if self.rng.randint(0,9) == 0:
 				cell_value = 4
 			self.board[cell_num] = cell_value
+			self.last_spawn = (cell_num, cell_value)
+
+	##########################################################
+	# makes a move on the game, spawning a tile if it changed the
+	# board, and records it with self.recorder when that is set.
+	# search_time is how long the move took to find in seconds.
+	# Moves other than 1-4 are ignored.
+	##########################################################
+	def play(self, move, search_time=0.0):
+		if move not in (1, 2, 3, 4):
+			return
+		before = list(self.board)
+		self.move(move)
+		spawn = None
+		if self.board != before:
+			self.spawn_blocks()
+			spawn = self.last_spawn
+
+		if self.recorder is not None:
+			if self.moves_played == 0:
+				self.recorder.start_game(self.seed, self.start_board)
+			self.recorder.record_move(move, spawn, search_time)
+		self.moves_played+=1
 
 	##########################################################
 	# print the 2D array representation of the board.
@@ -145,66 +324,85 @@ class Game2048:
 	def print_board(self):
 		print(self.board)
 
+	##########################################################
+	# surface of a tile with its value, made once per value
+	##########################################################
+	def tile_surface(self, value):
+		surface = _tile_surfaces.get(value)
+		if surface is None:
+			# get the colors of the tiles using the color_dict in __init__
+			if value in self.color_dict:
+				color = self.color_dict[value]
+			else:
+				color = self.color_dict[4096]
+			surface = pygame.Surface((95, 95))
+			surface.fill(color)
+
+			# if the tile holds a value other than 0 (empty) add the text
+			# of the value, centered depending on its number of characters
+			if value != 0:
+				if value in [2,4]:
+					img = get_font(50).render(str(value), True, (116,110,102))
+				else:
+					img = get_font(50).render(str(value), True, (255,255,255))
+				if value < 10:
+					surface.blit(img, (35, 35))
+				elif value < 100:
+					surface.blit(img, (28, 35))
+				elif value < 1000:
+					surface.blit(img, (21, 35))
+				else:
+					surface.blit(img, (8, 35))
+			# match the screen's pixel format so blitting it is a plain copy
+			if pygame.display.get_surface() is not None:
+				surface = surface.convert()
+			_tile_surfaces[value] = surface
+		return surface
+
 	##########################################################
 	# print the pygame representation of the board.
+	#
+	# board2 holds the board as it is on screen, only the tiles
+	# that differ from it and the score (when it changed) are drawn
+	# and updated. A board2 of -1s (a new game) redraws everything.
+	#
+	# In turbo mode the board is drawn at most every render_every
+	# moves and max_fps times a second, force draws it anyway.
 	##########################################################
-	def print_pygame(self):
-		# set the font
-		font = pygame.font.SysFont(None, 50)
-		# sentinel value, this holds the value 1 if the board 
-		# has changed
-		sentinel = 0
+	def print_pygame(self, force=False):
+		if not force:
+			if self.render_every > 1 and self.moves_played % self.render_every != 0:
+				return
+			if self.max_fps is not None and time.perf_counter() - self.last_render < 1/self.max_fps:
+				return
+
+		rects = []
+		# a new game, start by filling background with a greyish color
+		if -1 in self.board2:
+			screen.fill((185,172,161))
+			rects.append(screen.get_rect())
+			self.drawn_score = None
+
+		# draw the tiles that changed at their location in the 2D array
 		for i in range(16):
 			if self.board[i] != self.board2[i]:
-				sentinel = 1
+				rect = screen.blit(self.tile_surface(self.board[i]), (15+100*(i%4), 65+100*int(i/4)))
+				rects.append(rect)
+				self.board2[i] = self.board[i]
 
-		# If the board has changed then print the board.
-		if sentinel == 1:
-			# start by filling background with a greyish color
-			screen.fill((185,172,161))
-			# loop over all tiles in the 2D array representation of the game
-			for i in range(16):
-				# get the colors of the tiles using the color_dict in __init__
-				if self.board[i] in self.color_dict:
-					color = self.color_dict[self.board[i]]
-				else:
-					color = self.color_dict[4096]
-
-				# draw the rectange of the tile using color and location in
-				# 2D array
-				rectangle = pygame.Rect(15+100*(i%4), 65+100*int(i/4), 95, 95)
-				pygame.draw.rect(screen,color,rectangle)
-
-				# if the 2D array at i,j holds a value other than 0 (empty)
-				# add text of the value of the tile.
-				if self.board[i] != 0:
-					# center the text depending on number of characters
-					if self.board[i] in [2,4]:
-						img = font.render(str(self.board[i]), True, (116,110,102))
-					else:
-						img = font.render(str(self.board[i]), True, (255,255,255))
-					if self.board[i] < 10:
-						screen.blit(img, (50+100*(i%4), 100+100*int(i/4)))
-					elif self.board[i] < 100:
-						screen.blit(img, (43+100*(i%4), 100+100*int(i/4)))
-					elif self.board[i] < 1000:
-						screen.blit(img, (36+100*(i%4), 100+100*int(i/4)))
-					else:
-						screen.blit(img, (23+100*(i%4), 100+100*int(i/4)))
-			
-			# print the score
-			font = pygame.font.SysFont(None, 40)
-			img = font.render(f"Score: {self.score}", True, (255,255,255))
+		# print the score
+		if self.score != self.drawn_score:
+			area = pygame.Rect(0, 0, screen.get_width(), 60)
+			screen.fill((185,172,161), area)
+			img = get_font(40).render(f"Score: {self.score}", True, (255,255,255))
 			screen.blit(img, (30, 20))
+			rects.append(area)
+			self.drawn_score = self.score
 
-			# update screen
-			screen_display.update()
-			
-			# update board2 so that the screen will not be updated until another
-			# change occurs in board
-			for i in range(16):
-				self.board2[i] = self.board[i]
-
+		# update only the changed parts of the screen
+		if rects:
+			screen_display.update(rects)
+		self.last_render = time.perf_counter()
 
 	##########################################################
 	# move function, this move function changes the value in
@@ -509,20 +707,22 @@ class Game2048:
 
 	##########################################################
 	# checks if a state is terminal 
-	# uses move2 to see if any move you make will result in no zeros on the board
+	# a board with an empty tile or two equal neighbors still has a
+	# move that leaves an empty tile, any other board is terminal.
 	#
 	# this is important because sometimes there are no empty tiles, but
 	# you can still combine tiles to continue.
 	##########################################################
 	def terminal(self,board: list):
-		res = True
-		for i in range(1,5):
-			next, _ = self.move2(board,i)
-			for i in range(16):
-				if next[i] == 0:
-					res = False
-
-		return res
+		for i in range(16):
+			if board[i] == 0:
+				return False
+			# neighbor to the right and below
+			if i%4 != 3 and board[i] == board[i+1]:
+				return False
+			if i < 12 and board[i] == board[i+4]:
+				return False
+		return True
 	
 	##########################################################
 	# In 2048 a common strategy is to create chains of decending
@@ -685,12 +885,19 @@ class Game2048:
 	# an evaluation score) 
 	##########################################################
 	def evaluate(self, parent_board: list, board: list, score):
+		if self.evaluator is not None:
+			return self.evaluator.evaluate(parent_board, board, score)
 
 		if self.terminal(board):
 			return -99999999999999999+score
-		
-		parent_board = [parent_board[0:4],parent_board[4:8],parent_board[8:12],parent_board[12:16]]
-		board = [board[0:4],board[4:8],board[8:12],board[12:16]]
+
+		return self.heuristic(parent_board, board, score)
+
+	##########################################################
+	# the evaluation function without the terminal check,
+	# takes list boards
+	##########################################################
+	def heuristic(self, parent_board: list, board: list, score):
 		# if the current state is nerminal add a really large negative score
 
 			
@@ -700,57 +907,58 @@ class Game2048:
 		score = score*5	
 	
 		#Reward chain length
-		chain_len = self.chain_length(board)
+		chain_len = self.chain_length([board[0:4],board[4:8],board[8:12],board[12:16]])
 		score+=200*(chain_len)
 
 		# loop over tiles on board
 		for i in range(4):
 			for j in range(4):
-				if board[i][j] == 0:
+				k = 4*i+j
+				if board[k] == 0:
 					num_zeros+=1
 				# any tile less than or equal to 64 has a penalty for simply being on the board
-				if board[i][j] <= 64:
-					score = score - 8*board[i][j]
-				score+=board[i][j]
+				if board[k] <= 64:
+					score = score - 8*board[k]
+				score+=board[k]
 				# decentivize moving large tiles
 				# checking if the current tile has changed from the parent board
 				# and that the new tile has not become 2 times its previous value
-				if (parent_board[i][j] != board[i][j]) or (2*parent_board[i][j] != board[i][j]):
+				if (parent_board[k] != board[k]) or (2*parent_board[k] != board[k]):
 					# if condition is met subtract 12 * the moved tile
-					score = score - 12*parent_board[i][j]
+					score = score - 12*parent_board[k]
 			
 				# checking for all neighbors
 				# if the values are close in tile value add to score
-				if (i != 3 and (board[i][j] == 2*board[i+1][j] or 2*board[i][j] == board[i+1][j])):
-					score = score + 1*board[i][j]
+				if (i != 3 and (board[k] == 2*board[k+4] or 2*board[k] == board[k+4])):
+					score = score + 1*board[k]
 				# # # if the are far from each other decrease from score scaling on the difference
-				elif (i != 3 and (board[i][j] > 8*board[i+1][j] or 4*board[i][j] > board[i+1][j])):
-					score = score - 0.2*abs(board[i+1][j] - board[i][j])
+				elif (i != 3 and (board[k] > 8*board[k+4] or 4*board[k] > board[k+4])):
+					score = score - 0.2*abs(board[k+4] - board[k])
 
 				# if the values are close in tile value add to score
-				if (j != 3 and (board[i][j] == 2*board[i][j+1] or 2*board[i][j] == board[i][j+1])):
-					score = score + 1*board[i][j]
+				if (j != 3 and (board[k] == 2*board[k+1] or 2*board[k] == board[k+1])):
+					score = score + 1*board[k]
 				# # # if the are far from each other decrease from score scaling on the difference
-				elif (j != 3 and (board[i][j] > 8*board[i][j+1] or 4*board[i][j] > board[i][j+1])):
-					score = score - 0.2*abs(board[i][j+1] - board[i][j])
+				elif (j != 3 and (board[k] > 8*board[k+1] or 4*board[k] > board[k+1])):
+					score = score - 0.2*abs(board[k+1] - board[k])
 
 				# if the values are close in tile value add to score
-				if (i != 0 and (board[i][j] == 2*board[i-1][j] or 2*board[i][j] == board[i-1][j])):
-					score = score + 1*board[i][j]
+				if (i != 0 and (board[k] == 2*board[k-4] or 2*board[k] == board[k-4])):
+					score = score + 1*board[k]
 				# # # if the are far from each other decrease from score scaling on the difference
-				elif (i != 0 and (board[i][j] > 8*board[i-1][j] or 4*board[i][j] > board[i-1][j])):
-					score = score - 0.2*abs(board[i-1][j] - board[i][j])
+				elif (i != 0 and (board[k] > 8*board[k-4] or 4*board[k] > board[k-4])):
+					score = score - 0.2*abs(board[k-4] - board[k])
 
 				# if the values are close in tile value add to score
-				if (j != 0 and (board[i][j] == 2*board[i][j-1] or 2*board[i][j] == board[i][j-1])):
-					score = score + 1*board[i][j]
+				if (j != 0 and (board[k] == 2*board[k-1] or 2*board[k] == board[k-1])):
+					score = score + 1*board[k]
 				# # # if the are far from each other decrease from score scaling on the difference
-				elif (j != 0 and (board[i][j] > 8*board[i][j-1] or 4*board[i][j] > board[i][j-1])):
-					score = score - 0.2*abs(board[i][j-1] - board[i][j])
+				elif (j != 0 and (board[k] > 8*board[k-1] or 4*board[k] > board[k-1])):
+					score = score - 0.2*abs(board[k-1] - board[k])
 				
 				# if the tile is on the side enter
 				if i == 0 or i == 3 or j == 0 or j == 3:
-					value = board[i][j]
+					value = board[k]
 
 					# multiplier for tiles on sides
 					multiplier = 0
@@ -771,7 +979,7 @@ class Game2048:
 				multiplier = 0
 				# decentivize large values in middle
 				if i == 1 or i == 2 or j == 1 or j == 2:
-					value = board[i][j]
+					value = board[k]
 					# if the value is large add an extra penalization for being in the middle 
 					# add a multipier for being in middle
 					if i == 1:
@@ -789,6 +997,72 @@ class Game2048:
 
 		return score
 
+	##########################################################
+	# evaluates many boards at once with NumPy, see batch_eval.py
+	#
+	# returns an array with the evaluate score of every board. With
+	# parity set every board is also scored with evaluate and an
+	# AssertionError is raised if any score differs.
+	##########################################################
+	def evaluate_batch(self, parent_boards, boards, scores, parity=False):
+		# learned evaluators score one board at a time
+		if self.evaluator is not None:
+			return np.array([self.evaluate(parent_board, board, score)
+				for parent_board, board, score in zip(parent_boards, boards, scores)], dtype=float)
+
+		res = batch_eval.evaluate_batch(self.boards_to_array(parent_boards), self.boards_to_array(boards), scores, self.merge_limit)
+
+		if parity:
+			expected = np.array([self.evaluate(parent_board, board, score)
+				for parent_board, board, score in zip(parent_boards, boards, scores)], dtype=float)
+			differs = ~np.isclose(res, expected, rtol=1e-9, atol=1e-6)
+			if differs.any():
+				i = int(np.argmax(differs))
+				raise AssertionError(f"evaluate_batch differs from evaluate on board {i}: {res[i]} != {expected[i]}")
+
+		return res
+
+	##########################################################
+	# converts boards to the (N, 16) array evaluate_batch works on
+	##########################################################
+	def boards_to_array(self, boards):
+		return batch_eval.boards_to_array(boards)
+
+	##########################################################
+	# returns the board that searches start from
+	##########################################################
+	def get_search_board(self):
+		return self.board
+
+	##########################################################
+	# returns a hashable version of a board for the transposition
+	# table
+	##########################################################
+	def board_key(self, board):
+		return tuple(board)
+
+	##########################################################
+	# board_key of the canonical form of board and the transform of
+	# bitboard.symmetries that makes it, 0 when symmetric_keys is off.
+	# Moves stored under the key are in the canonical board's frame,
+	# key_move and board_move convert them.
+	##########################################################
+	def symmetry_key(self, board):
+		if not self.symmetric_keys:
+			return self.board_key(board), 0
+		key, transform = bitboard.canonical(bitboard.to_bitboard(board))
+		return key, transform
+
+	def key_move(self, transform, move):
+		if transform == 0 or move is None:
+			return move
+		return bitboard.MOVE_MAPS[transform][move]
+
+	def board_move(self, transform, move):
+		if transform == 0 or move is None:
+			return move
+		return bitboard.UNMAP_MOVES[transform][move]
+
 	##########################################################
 	# gets all possible boards resulting from a state depending on current player
 	##########################################################
@@ -796,99 +1070,544 @@ class Game2048:
 
 		# if player equals one use move2 to find possible states
 		if player == 1:
-			res = [[i, self.move2(board,i)[0], self.move2(board,i)[1]] for i in range(1,5) if self.move2(board,i)[0] != board]
+			res = []
+			for i in range(1,5):
+				child_board, score = self.move2(board,i)
+				if child_board != board:
+					res.append([i, child_board, score])
 			return res
 		# otherwise find all empty tiles and add to res a version where that empty tile now
 		# is 2 or 4.
 		else:
 			res = []
-			num_children = 6
-
-			for i in range(16):
-				if board[i] == 0:
-					board[i] = 2
-					res.append((2,copy(board)))
-					if self.get_num_zeros(board) < 4:
-						board[i] = 4
-						res.append((4,copy(board)))
-					board[i] = 0
-			
-			if len(res) < num_children:
-				num_children = len(res)
+			for num, i in self.get_spawns(board):
+				board[i] = num
+				res.append((num,copy(board)))
+				board[i] = 0
+			return res
+
+	##########################################################
+	# makes move dir on board in place, the same move as move2.
+	# Returns the score and what unmake_move needs to take it back,
+	# the lines that changed with their old tiles. No line changes
+	# when the move does not change the board.
+	##########################################################
+	def make_move(self, board, dir):
+		score = 0
+		undo = []
+		for cells in MOVE_LINES[dir]:
+			a, b, c, d = cells
+			line = (board[a], board[b], board[c], board[d])
+			result = _line_moves.get(line)
+			if result is None:
+				result = _line_moves[line] = slide_line(line)
+			new_line, line_score = result
+			if new_line != line:
+				board[a], board[b], board[c], board[d] = new_line
+				undo.append((cells, line))
+				score += line_score
+		return score, undo
+
+	def unmake_move(self, board, undo):
+		for (a, b, c, d), line in undo:
+			board[a], board[b], board[c], board[d] = line
+
+	##########################################################
+	# yields the same (move, child board, score) as
+	# get_child_boards(1, board), in the order of moves, but makes
+	# each move on one scratch copy of board and unmakes it before
+	# the next. Like spawn_children, a yielded board is only valid
+	# until the loop moves on.
+	##########################################################
+	def move_children(self, board, moves=(1, 2, 3, 4)):
+		child_board = copy(board)
+		for i in moves:
+			score, undo = self.make_move(child_board, i)
+			if undo:
+				yield i, child_board, score
+				self.unmake_move(child_board, undo)
+
+	##########################################################
+	# the spawns get_child_boards(2, board) searches, a random sample
+	# of at most 6 (tile value, cell) pairs. A 4 is only added when the
+	# board has few empty tiles left.
+	##########################################################
+	def get_spawns(self, board):
+		res = []
+		num_children = 6
+
+		cells = [i for i in range(16) if board[i] == 0]
+		for i in cells:
+			res.append((2, i))
+			if len(cells) - 1 < 4:
+				res.append((4, i))
 
-			shuffle(res)
-			res = res[:num_children]
+		if len(res) < num_children:
+			num_children = len(res)
 
+		shuffle(res)
+		res = res[:num_children]
+
+		return res
+
+	##########################################################
+	# Spawn make/unmake
+	#
+	# spawn_children and chance_children yield the same children as
+	# get_child_boards(2, board) and get_chance_boards(board), but
+	# make each spawn on one scratch copy of board and take it off
+	# again before the next, instead of copying the board for every
+	# child. A yielded board is only valid until the loop moves on,
+	# so it must not be kept (the search only keeps keys made from
+	# it).
+	##########################################################
+	def spawn_children(self, board, spawns=None):
+		if spawns is None:
+			spawns = self.get_spawns(board)
+		child_board = copy(board)
+		for num, i in spawns:
+			child_board[i] = num
+			yield child_board
+			child_board[i] = 0
+
+	def chance_children(self, board, spawns=None):
+		if spawns is None:
+			spawns = self.get_chance_spawns(board)
+		child_board = copy(board)
+		for weight, num, i in spawns:
+			child_board[i] = num
+			yield weight, child_board
+			child_board[i] = 0
+
+	##########################################################
+	# (weight, tile value, cell) of every child of an expectimax
+	# chance node, see get_chance_boards
+	##########################################################
+	def get_chance_spawns(self, board):
+		if self.prob_cutoff is not None:
+			cells = [i for i in range(16) if board[i] == 0]
+			res = []
+			for i in cells:
+				res.append((0.9/len(cells), 2, i))
+				res.append((0.1/len(cells), 4, i))
 			return res
+		spawns = self.get_spawns(board)
+		return [(0.1/len(spawns) if num == 4 else 0.9/len(spawns), num, i) for num, i in spawns]
 
 	
+	##########################################################
+	# returns every board a spawn can produce with its probability,
+	# a two with probability 0.9 and a four with 0.1 on each empty
+	# tile, the same odds as spawn_blocks
+	##########################################################
+	def get_spawn_boards(self, board: list):
+		res = []
+		num_zeros = self.get_num_zeros(board)
+		for i in range(16):
+			if board[i] == 0:
+				board[i] = 2
+				res.append((0.9/num_zeros, copy(board)))
+				board[i] = 4
+				res.append((0.1/num_zeros, copy(board)))
+				board[i] = 0
+		return res
+
+	##########################################################
+	# returns the children of an expectimax chance node with the
+	# weight of each. With prob_cutoff set these are all the spawns
+	# with their probabilities, otherwise the sample from
+	# get_child_boards averaged with a two weighted 0.9 and a four 0.1
+	##########################################################
+	def get_chance_boards(self, board):
+		if self.prob_cutoff is not None:
+			return self.get_spawn_boards(board)
+		children = self.get_child_boards(2, board)
+		res = []
+		for num, child_board in children:
+			if num == 4:
+				res.append((0.1/len(children), child_board))
+			else:
+				res.append((0.9/len(children), child_board))
+		return res
+
 	##########################################################
 	# Expectimax implementation using depth parameter
+	#
+	# If self.tt holds a TranspositionTable, max nodes are cached
+	# on (board, depth) and chance nodes on (board, depth, score2)
+	# because the leaves below a chance node are evaluated with the
+	# score of the move that reached it.
+	#
+	# deadline is a time.perf_counter() value, SearchTimeout is raised
+	# once it passes.
+	#
+	# If self.prob_cutoff is set, chance nodes take the true expected
+	# value over every possible spawn (see get_chance_boards) and a
+	# chance node is evaluated as a leaf once the probability of
+	# reaching it falls below prob_cutoff. Otherwise they average a
+	# random sample from get_child_boards. How deep the tree below a
+	# node goes then depends on that probability, so transposition
+	# table keys also hold its power of two (prob_bucket) and a value
+	# is only reused for a probability within a factor of two.
+	#
+	# If self.leaf_cache holds a LeafCache the leaf values are kept,
+	# the next move's search then only evaluates the leaves of the
+	# new frontier (see leaf_value).
+	#
+	# If self.star1 is set chance nodes are pruned with Star1: a max
+	# node passes the best value it has so far down as alpha, and a
+	# chance node stops searching spawns once the ones searched plus
+	# leaf_upper_bound for the rest can not beat it. Its value
+	# is then an upper bound, which the transposition table keeps
+	# apart from exact values. The chosen move and its value do not
+	# change. Star2 probing is not done: it cuts chance nodes that
+	# are above a beta, and with no min player the beta of every
+	# expectimax node is infinite.
+	#
+	# If self.parallel holds a ParallelSearch the search is split
+	# across its worker processes.
+	#
+	# If self.search_stats holds a SearchStats the search is counted
+	# and timed (not when it runs in parallel).
 	##########################################################
-	def expectimax(self, depth_limit: int):
+	def expectimax(self, depth_limit: int, deadline=None):
+		if self.parallel is not None:
+			return self.parallel.expectimax(self, depth_limit, deadline)
+		if self.tt is not None:
+			self.tt.new_search()
+
+		# call max value first since it is "our move"
+		root = self.get_search_board()
+		if self.leaf_cache is not None:
+			self.leaf_cache.new_search(self.symmetry_key(root)[0])
+		stats = self.search_stats
+		if stats is None:
+			best_move, self.last_value = self.expectimax_value(root, root, depth_limit, deadline=deadline)
+			return best_move
+
+		stats.begin(self, "expectimax", root, depth_limit)
+		best_move = None
+		try:
+			best_move, self.last_value = self.expectimax_value(root, root, depth_limit, deadline=deadline)
+		finally:
+			stats.end(best_move)
+		return best_move
+
+	##########################################################
+	# the part of parent_board that evaluate depends on. The
+	# heuristic only uses the parent's tile sum (the moved tile
+	# penalty) and the n-tuple evaluator does not use it at all.
+	##########################################################
+	def parent_key(self, parent_board):
+		return sum(parent_board)
+
+	##########################################################
+	# a value no leaf of a depth_limit search from board scores
+	# above, used by Star1 pruning. For the n-tuple evaluator it is
+	# the network's upper_bound. Every term of the heuristic is at
+	# most a multiple of the leaf's tile sum:
+	#   5*score         the move's merges, at most the tile sum
+	#   200*chain       a chain adds up tiles, at most twice the sum
+	#                   (the bottom right chain starts on an extra
+	#                   tile)
+	#   tiles, sides    +2*tile on corners, less elsewhere
+	#   neighbours      +tile for each of at most four neighbours
+	#   empty tiles     at most 2000*(4+3+2+1)*4
+	#   moved tiles     -12 times the parent's sum, at least the
+	#                   leaf's sum minus the spawned 4
+	# so the heuristic is below 399*sum + 80048. Moves keep the tile
+	# sum and a spawn adds at most 4, so a leaf's sum is at most the
+	# board's plus 4 per ply.
+	##########################################################
+	def leaf_upper_bound(self, board, depth_limit):
+		if self.evaluator is not None:
+			if self._evaluator_bound is None or self._evaluator_bound[0] is not self.evaluator:
+				self._evaluator_bound = (self.evaluator, self.evaluator.upper_bound())
+			return self._evaluator_bound[1]
+		return 399*(self.tile_sum(board) + 4*depth_limit) + 80048
+
+	def tile_sum(self, board):
+		return sum(board)
+
+	##########################################################
+	# evaluate for the leaves of expectimax, looked up in
+	# self.leaf_cache when it is set
+	##########################################################
+	def leaf_value(self, parent_board, board, score):
+		if self.leaf_cache is None:
+			return self.evaluate(parent_board, board, score)
+		key = (self.symmetry_key(board)[0], score, self.parent_key(parent_board))
+		value = self.leaf_cache.get(key)
+		if value is None:
+			value = self.evaluate(parent_board, board, score)
+			self.leaf_cache.put(key, value)
+		return value
+
+	##########################################################
+	# value of an expectimax max node, returns the best move and its
+	# value. prob is the probability of reaching board and moves, if
+	# given, limits the moves tried at board (that value is then not
+	# stored in the transposition table).
+	##########################################################
+	def expectimax_value(self, parent_board, board, depth_limit, score2=0, prob=1.0, deadline=None, moves=None):
+		tt = self.tt
+		prob_cutoff = self.prob_cutoff
+		upper = self.leaf_upper_bound(board, depth_limit) if self.star1 else None
+
+		def prob_bucket(prob):
+			if prob_cutoff is None:
+				return 0
+			return math.frexp(prob)[1]
 
 		# the following functions recursively call eachother and decrement depth at each "move"
 
 		# define the expected value for player function (expected score after environment move)
-		def expected_value_for_max(parent_board: list, board: list, depth_limit: int, score2):
+		# alpha is the best value the parent max node already has, only
+		# used for Star1 pruning
+		def expected_value_for_max(parent_board: list, board: list, depth_limit: int, score2, prob, alpha=-math.inf):
+			if deadline is not None and time.perf_counter() > deadline:
+				raise SearchTimeout()
 			# if the board is terminal or the depth is zero return the evaluation function's score
-			if self.terminal(board) or depth_limit == 0:
-				return None, self.evaluate(parent_board, board, score2)
+			# (evaluate checks for terminal boards itself, leaves skip the check)
+			if depth_limit == 0 or self.terminal(board):
+				return None, self.leaf_value(parent_board, board, score2)
+			# lines that are too unlikely to matter are not searched further
+			if prob_cutoff is not None and prob < prob_cutoff:
+				return None, self.leaf_value(parent_board, board, score2)
+
+			if tt is not None:
+				key = (CHANCE_NODE, self.symmetry_key(board)[0], depth_limit, score2, prob_bucket(prob))
+				entry = tt.get(key)
+				# values cut off by Star1 are upper bounds
+				if entry is not None and (entry[2] == EXACT or entry[0] <= alpha):
+					return None, entry[0]
 			
-			# loop over the child boards and average their scores from max_value
-			scores = []
-			for num, child_board in self.get_child_boards(2, board):
-				_, score = max_value(board, child_board, depth_limit-1, score2)
-				if num == 4:
-					scores.append(score*0.1)
-				else:
-					scores.append(score*0.9)
-
-			expected_score = sum(scores) / len(scores)
+			# loop over the child boards and weight their scores from max_value
+			expected_score = 0
+			flag = EXACT
+			if upper is None:
+				for weight, child_board in self.chance_children(board):
+					_, score = max_value(board, child_board, depth_limit-1, score2, prob*weight)
+					expected_score += weight*score
+			else:
+				# Star1: stop once the children left could not lift the
+				# value above alpha even if they all scored upper
+				spawns = self.get_chance_spawns(board)
+				rest = sum(spawn[0] for spawn in spawns)
+				for weight, child_board in self.chance_children(board, spawns):
+					rest -= weight
+					child_alpha = (alpha - expected_score - upper*rest)/weight
+					_, score = max_value(board, child_board, depth_limit-1, score2, prob*weight, child_alpha)
+					expected_score += weight*score
+					if expected_score + upper*rest <= alpha:
+						expected_score += upper*rest
+						flag = UPPER
+						break
+
+			if tt is not None:
+				tt.put(key, depth_limit, expected_score, None, flag)
 			return None, expected_score
 		
 		# define the value function of players moves
-		def max_value(parent_board:list, board: list, depth_limit: int, score2):
-			if self.terminal(board) or depth_limit == 0:
-				return None, self.evaluate(parent_board, board, score2)
+		def max_value(parent_board:list, board: list, depth_limit: int, score2, prob, alpha=-math.inf, moves=None):
+			if deadline is not None and time.perf_counter() > deadline:
+				raise SearchTimeout()
+			if depth_limit == 0 or self.terminal(board):
+				return None, self.leaf_value(parent_board, board, score2)
+
+			use_tt = tt is not None and moves is None
+			if use_tt:
+				board_key, transform = self.symmetry_key(board)
+				key = (MAX_NODE, board_key, depth_limit, prob_bucket(prob))
+				entry = tt.get(key)
+				if entry is not None and (entry[2] == EXACT or entry[0] <= alpha):
+					return self.board_move(transform, entry[1]), entry[0]
 
 			# loop over child boards and find the best score from the expected value function.
 			best_score = -math.inf
 			best_move = None
-			for move, child_board, score2 in self.get_child_boards(1, board):
-				_, score = expected_value_for_max(board, child_board, depth_limit - 1, score2)
+			for move, child_board, score2 in self.move_children(board):
+				if moves is not None and move not in moves:
+					continue
+				_, score = expected_value_for_max(board, child_board, depth_limit - 1, score2, prob, max(alpha, best_score))
 				if score > best_score:
 					best_score = score
 					best_move = move
 
+			if use_tt:
+				# with Star1 a value no better than alpha is only an upper bound
+				flag = UPPER if upper is not None and best_score <= alpha else EXACT
+				tt.put(key, depth_limit, best_score, self.key_move(transform, best_move), flag)
 			return best_move, best_score
 
-		# call max value first since it is "our move"
-		best_move, _ = max_value(self.board,self.board,depth_limit,0)
+		# the nested functions call each other through these names
+		if self.search_stats is not None and self.search_stats.record is not None:
+			max_value = self.search_stats.node(max_value, "max")
+			expected_value_for_max = self.search_stats.node(expected_value_for_max, "chance")
 
-		return best_move
+		return max_value(parent_board, board, depth_limit, score2, prob, -math.inf, moves)
 
 	##########################################################
 	# alphabeta implementation
+	#
+	# If self.tt holds a TranspositionTable, values are stored with
+	# the bound they represent (exact, lower or upper) so they are
+	# only reused when they still decide the window. The stored best
+	# move of a max node is searched first.
+	#
+	# deadline is a time.perf_counter() value, SearchTimeout is raised
+	# once it passes. move_order maps boards to the best move found by
+	# an earlier search, it is searched first and updated with the
+	# best move of this search.
+	#
+	# guess is an estimate of the value, the root is then searched
+	# with an aspiration window around it (see alphabeta_root).
+	#
+	# alphabeta_ordering, pvs and aspiration_window switch the move
+	# ordering and window enhancements. None of them change the value
+	# of a tree, only how much of it is searched. As spawns are
+	# sampled at random the tree itself does differ from search to
+	# search.
+	#
+	# If self.parallel holds a ParallelSearch the root moves are
+	# searched in its worker processes.
+	#
+	# If self.search_stats holds a SearchStats the search is counted
+	# and timed (not when it runs in parallel).
+	##########################################################
+	def alphabeta(self, depth_limit, deadline=None, move_order=None, guess=None):
+		if self.parallel is not None:
+			return self.parallel.alphabeta(self, depth_limit, deadline)
+		if self.tt is not None:
+			self.tt.new_search()
+		if self.alphabeta_ordering:
+			self.age_history()
+
+		# call max_value since it always is "our move" 
+		root = self.get_search_board()
+		stats = self.search_stats
+		if stats is None:
+			placement, self.last_value = self.alphabeta_root(root, depth_limit, deadline, move_order, guess)
+			# return resulting placement
+			return placement
+
+		stats.begin(self, "alphabeta", root, depth_limit)
+		placement = None
+		try:
+			placement, self.last_value = self.alphabeta_root(root, depth_limit, deadline, move_order, guess)
+		finally:
+			stats.end(placement)
+		return placement
+
 	##########################################################
-	def alphabeta(self, depth_limit):
+	# halves the ordering tables, so the moves and spawns of recent
+	# searches count most
+	##########################################################
+	def age_history(self):
+		self.move_history = [count >> 1 for count in self.move_history]
+		self.spawn_damage = {key: count >> 1 for key, count in self.spawn_damage.items() if count > 1}
+
+	##########################################################
+	# searches the root of alphabeta. With aspiration_window set and
+	# a guess, the root is searched with the window guess +-
+	# aspiration_window first. If the value falls outside it the root
+	# is searched again with the window opened on that side.
+	##########################################################
+	def alphabeta_root(self, root, depth_limit, deadline=None, move_order=None, guess=None):
+		if guess is None or self.aspiration_window is None:
+			return self.alphabeta_value(root, root, depth_limit, deadline=deadline, move_order=move_order)
+
+		alpha = guess - self.aspiration_window
+		beta = guess + self.aspiration_window
+		while True:
+			move, value = self.alphabeta_value(root, root, depth_limit, alpha, beta, deadline=deadline, move_order=move_order)
+			if value <= alpha and alpha != -math.inf:
+				alpha = -math.inf
+			elif value >= beta and beta != math.inf:
+				beta = math.inf
+			else:
+				return move, value
+
+	##########################################################
+	# value of an alphabeta max node, returns the best move and its
+	# value. moves, if given, limits the moves tried at board (that
+	# value is then not stored in the transposition table).
+	##########################################################
+	def alphabeta_value(self, parent_board, board, depth_limit, alpha=-math.inf, beta=math.inf, score2=0,
+			deadline=None, move_order=None, moves=None):
+		tt = self.tt
+		history = self.move_history if self.alphabeta_ordering else None
+		damage = self.spawn_damage if self.alphabeta_ordering else None
+		pvs = self.pvs
+
+		# returns the value of a table entry if it can be used with the
+		# current window, otherwise None
+		def probe(entry, alpha, beta):
+			value, _, flag = entry
+			if flag == EXACT or (flag == LOWER and value >= beta) or (flag == UPPER and value <= alpha):
+				return value
+			return None
+
+		# the bound a value represents given the window it was searched with
+		def bound(value, alpha, beta):
+			if value <= alpha:
+				return UPPER
+			if value >= beta:
+				return LOWER
+			return EXACT
 		
 		# max value function for player (you)
 		# takes in the parent_board (previous board), board (current board),
 		# a depth limit, beta, and score2 (score of child board / current board)
-		def max_value(parent_board, board, depth_limit, alpha, beta, score2):
+		def max_value(parent_board, board, depth_limit, alpha, beta, score2, moves=None):
+			if deadline is not None and time.perf_counter() > deadline:
+				raise SearchTimeout()
 			# if the board is at a terminal state or the depth is at zero return
 			# the evaluation score
-			if self.terminal(board) or depth_limit == 0:
+			if depth_limit == 0 or self.terminal(board):
 				return None, self.evaluate(parent_board, board, score2)
+
+			entry = None
+			use_tt = tt is not None and moves is None
+			board_key, transform = self.symmetry_key(board)
+			if use_tt:
+				key = (MAX_NODE, board_key, depth_limit)
+				entry = tt.get(key)
+				if entry is not None:
+					value = probe(entry, alpha, beta)
+					if value is not None:
+						return self.board_move(transform, entry[1]), value
+				alpha_orig = alpha
+
+			order = [1, 2, 3, 4]
+			if moves is not None:
+				order = [move for move in order if move in moves]
+			# search the previous best move first, from the table or from an
+			# earlier search
+			first_move = None
+			if entry is not None:
+				first_move = self.board_move(transform, entry[1])
+			elif move_order is not None:
+				first_move = self.board_move(transform, move_order.get(board_key))
+			if history is not None:
+				order.sort(key=lambda move: (move != first_move, -history[move]))
+			elif first_move is not None:
+				order.sort(key=lambda move: move != first_move)
 			
 			# define best_score, best_move and alpha
 			best_score = -math.inf
 			best_move = None
 
-			# get child boards and call min_value
-			for move, child_board, score2 in self.get_child_boards(1, board):
-				_, score = min_value(board, child_board, depth_limit - 1, alpha, beta, score2)
+			# make the moves in order and call min_value
+			for move, child_board, score2 in self.move_children(board, order):
+				if pvs and best_move is not None:
+					# a null window only tells whether the move beats alpha,
+					# the ones that do are searched again with the full window
+					_, score = min_value(board, child_board, depth_limit - 1, alpha, math.nextafter(alpha, math.inf), score2)
+					if alpha < score < beta:
+						_, score = min_value(board, child_board, depth_limit - 1, alpha, beta, score2)
+				else:
+					_, score = min_value(board, child_board, depth_limit - 1, alpha, beta, score2)
 				# if the current score of the child board is better than best score make that the best move
 				if score > best_score:
 					best_score = score
@@ -898,46 +1617,163 @@ class Game2048:
 				# if alpha is ever greater than or equal to beta then break
 				if beta <= alpha:
 					break
-			
+
+			if history is not None and best_move is not None:
+				history[best_move] += depth_limit*depth_limit
+
+			if use_tt:
+				tt.put(key, depth_limit, best_score, self.key_move(transform, best_move), bound(best_score, alpha_orig, beta))
+			if move_order is not None and moves is None:
+				move_order[board_key] = self.key_move(transform, best_move)
 			return best_move, best_score
 	
 		# min value function for environment
 		# takes in the parent_board (previous board), board (current board),
 		# a depth limit, beta, and score2 (score of child board / current board)
 		def min_value(parent_board, board, depth_limit, alpha, beta, score2):
+			if deadline is not None and time.perf_counter() > deadline:
+				raise SearchTimeout()
 			# if the board is at a terminal state or the depth is at zero return
 			# the evaluation score
-			if self.terminal(board) or depth_limit == 0:
+			if depth_limit == 0 or self.terminal(board):
 				return None, self.evaluate(parent_board, board, score2)
 
+			if tt is not None:
+				key = (MIN_NODE, self.symmetry_key(board)[0], depth_limit, score2)
+				entry = tt.get(key)
+				if entry is not None:
+					value = probe(entry, alpha, beta)
+					if value is not None:
+						return None, value
+				beta_orig = beta
+
 			# define best score and beta
 			best_score = math.inf
+			worst_spawn = None
+
+			spawns = self.get_spawns(board)
+			if damage is not None:
+				# spawns that hurt most in sibling nodes first
+				spawns.sort(key=lambda spawn: damage.get((depth_limit,)+spawn, 0), reverse=True)
 
 			# get all the child boards resulting from an environment move and find the max value using
 			# max value function
-			for _, child_board in self.get_child_boards(2, board):
-				_, score = max_value(board, child_board, depth_limit-1, alpha, beta, score2)
+			for spawn, child_board in zip(spawns, self.spawn_children(board, spawns)):
+				if pvs and worst_spawn is not None:
+					# the same null window test as in max_value, from below beta
+					_, score = max_value(board, child_board, depth_limit-1, math.nextafter(beta, -math.inf), beta, score2)
+					if alpha < score < beta:
+						_, score = max_value(board, child_board, depth_limit-1, alpha, beta, score2)
+				else:
+					_, score = max_value(board, child_board, depth_limit-1, alpha, beta, score2)
 				# score is the worst possible state resulting from max_value
 				if score < best_score:
 					best_score = score
+					worst_spawn = spawn
 
 				# beta is the worst score so far
 				beta = min(beta, best_score)
 				# if beta is ever less than or equal to alpha break
 				if beta <= alpha:
 					break
-			
+
+			if damage is not None and worst_spawn is not None:
+				damage_key = (depth_limit,)+worst_spawn
+				damage[damage_key] = damage.get(damage_key, 0) + depth_limit*depth_limit
+			if tt is not None:
+				tt.put(key, depth_limit, best_score, None, bound(best_score, alpha, beta_orig))
 			return None, best_score
 
-		# call max_value since it always is "our move" 
-		placement, _ = max_value(self.board,self.board,depth_limit,-math.inf,math.inf,0)
+		# the nested functions call each other through these names
+		if self.search_stats is not None and self.search_stats.record is not None:
+			max_value = self.search_stats.node(max_value, "max", window=True)
+			min_value = self.search_stats.node(min_value, "chance", window=True)
 
-		# return resulting placement
-		return placement
+		return max_value(parent_board, board, depth_limit, alpha, beta, score2, moves)
+
+	##########################################################
+	# Iterative deepening with a time budget
+	#
+	# search(depth, deadline) is run at depth 1, 2, 3, ... until
+	# time_limit seconds have passed or max_depth is reached. The
+	# first iteration always runs to completion, later iterations are
+	# stopped by the deadline and the move of the deepest finished
+	# iteration is returned. The depth it came from is kept in
+	# self.last_search_depth.
+	##########################################################
+	def iterative_deepening(self, search, time_limit, max_depth=20):
+		start = time.perf_counter()
+		deadline = start + time_limit
+		best_move = search(1, None)
+		self.last_search_depth = 1
+		last_time = time.perf_counter() - start
+
+		for depth in range(2, max_depth+1):
+			# the next iteration takes longer than the last one, skip it
+			# if it can not finish in the remaining time
+			iteration_start = time.perf_counter()
+			if deadline - iteration_start < last_time:
+				break
+			try:
+				best_move = search(depth, deadline)
+			except SearchTimeout:
+				break
+			self.last_search_depth = depth
+			last_time = time.perf_counter() - iteration_start
+
+		return best_move
+
+	##########################################################
+	# expectimax with a time budget in seconds instead of a depth
+	##########################################################
+	def expectimax_timed(self, time_limit, max_depth=20):
+		return self.iterative_deepening(self.expectimax, time_limit, max_depth)
+
+	##########################################################
+	# alphabeta with a time budget in seconds instead of a depth,
+	# every iteration searches the best moves of the last one first.
+	# The value of an iteration is the aspiration window guess of the
+	# iteration two plies deeper (values of odd and even depths
+	# differ too much to guess each other).
+	##########################################################
+	def alphabeta_timed(self, time_limit, max_depth=20):
+		move_order = {}
+		values = {}
+		def search(depth, deadline):
+			move = self.alphabeta(depth, deadline, move_order, values.get(depth-2))
+			values[depth] = self.last_value
+			return move
+		return self.iterative_deepening(search, time_limit, max_depth)
 
 	# return a random number from 1-4	
 	def random_move(self):
 		return randint(1,5)
+
+	##########################################################
+	# Monte Carlo rollout player
+	#
+	# Plays playouts random (or greedy) games to the end after each
+	# legal move and returns the move with the best average score.
+	# The playouts run as NumPy arrays in rollout.py and draw their
+	# seed from the global random generator, so random.seed makes
+	# them repeatable.
+	##########################################################
+	def monte_carlo(self, playouts=100, policy="random", max_steps=None):
+		rng = np.random.default_rng(getrandbits(64))
+		best_move, _ = rollout.best_move(bitboard.to_bitboard(self.board), playouts, rng, policy, max_steps)
+		return best_move
+
+	##########################################################
+	# Monte Carlo Tree Search for iterations iterations or
+	# time_limit seconds. The tree is kept in self.tree, so the
+	# part below the move that was played and the tile that
+	# spawned is reused by the next call.
+	##########################################################
+	def mcts(self, iterations=None, time_limit=None):
+		if self.tree is None:
+			self.tree = mcts.MCTS()
+		deadline = None if time_limit is None else time.perf_counter() + time_limit
+		return self.tree.search(bitboard.to_bitboard(self.board), iterations, deadline)
 	
 	##########################################################
 	# after game has ended display score and then reset
@@ -957,7 +1793,7 @@ class Game2048:
 			print(string)
 
 		screen.fill((185,172,161))
-		font = pygame.font.SysFont(None, 40)
+		font = get_font(40)
 		img = font.render(string, True, (255,255,255))
 		screen.blit(img, (10,200))
 		if isWon:
@@ -968,15 +1804,236 @@ class Game2048:
 
 		screen_display.update()
 
-		time.sleep(3)
+		if self.tt is not None:
+			print(f"Transposition table: {self.tt.stats()}")
+		if self.recorder is not None:
+			self.recorder.end_game()
+
+		# show the result for 3 seconds, letting the window system know
+		# the window is still alive
+		end = time.perf_counter() + 3
+		while time.perf_counter() < end:
+			pygame.event.pump()
+			time.sleep(0.05)
 
 		self.__init__()
 
+##########################################################
+# 2048 Game class backed by the bitboard engine
+#
+# self.board stays a 16 element list so the pygame UI works
+# unchanged. Searches convert it to a 64-bit bitboard once at
+# the root and every node below works on integers.
+##########################################################
+class BitboardGame2048(Game2048):
+	merge_limit = bitboard.MERGE_LIMIT
+
+	##########################################################
+	# move self.board using the bitboard engine
+	##########################################################
+	def move(self,dir):
+		board, score = bitboard.move(bitboard.to_bitboard(self.board), dir)
+		self.score+=score
+		self.board = bitboard.from_bitboard(board)
+
+	def move2(self,board,dir):
+		return bitboard.move(board, dir)
+
+	def terminal(self,board):
+		return bitboard.is_terminal(board)
+
+	##########################################################
+	# the heuristic on bitboards from the evaluation tables, the same
+	# scores as the list heuristic apart from float rounding
+	##########################################################
+	def heuristic(self, parent_board, board, score):
+		return eval_tables.heuristic(parent_board, board, score)
+
+	def get_search_board(self):
+		return bitboard.to_bitboard(self.board)
+
+	def boards_to_array(self, boards):
+		return batch_eval.bitboards_to_array(boards)
+
+	def board_key(self, board):
+		return board
+
+	def symmetry_key(self, board):
+		if not self.symmetric_keys:
+			return board, 0
+		return bitboard.canonical(board)
+
+	def parent_key(self, parent_board):
+		return eval_tables.moved_penalty(parent_board)
+
+	def tile_sum(self, board):
+		return eval_tables.moved_penalty(board)
+
+	##########################################################
+	# same children as Game2048.get_child_boards but for bitboards
+	##########################################################
+	def get_child_boards(self, player, board):
+		if player == 1:
+			res = []
+			for i in bitboard.legal_moves(board):
+				child_board, score = bitboard.move(board, i)
+				res.append([i, child_board, score])
+			return res
+		else:
+			return [(num, board | (num >> 1) << 4*i) for num, i in self.get_spawns(board)]
+
+	# bitboard moves return a new int, there is nothing to unmake
+	def move_children(self, board, moves=(1, 2, 3, 4)):
+		legal = bitboard.legal_moves(board)
+		for i in moves:
+			if i in legal:
+				child_board, score = bitboard.move(board, i)
+				yield i, child_board, score
+
+	def get_spawns(self, board):
+		res = []
+		num_children = 6
+
+		cells = bitboard.empty_cells(board)
+		for i in cells:
+			res.append((2, i))
+			# a 4 is only added when the board has few empty tiles left
+			if len(cells) - 1 < 4:
+				res.append((4, i))
+
+		if len(res) < num_children:
+			num_children = len(res)
+
+		shuffle(res)
+		res = res[:num_children]
+
+		return res
+
+	##########################################################
+	# bitboards are values, a spawn is made with one or and there
+	# is nothing to unmake
+	##########################################################
+	def spawn_children(self, board, spawns=None):
+		if spawns is None:
+			spawns = self.get_spawns(board)
+		for num, i in spawns:
+			yield board | (num >> 1) << 4*i
+
+	def chance_children(self, board, spawns=None):
+		if spawns is None:
+			spawns = self.get_chance_spawns(board)
+		for weight, num, i in spawns:
+			yield weight, board | (num >> 1) << 4*i
+
+	def get_chance_spawns(self, board):
+		if self.prob_cutoff is not None:
+			cells = bitboard.empty_cells(board)
+			res = []
+			for i in cells:
+				res.append((0.9/len(cells), 2, i))
+				res.append((0.1/len(cells), 4, i))
+			return res
+		return Game2048.get_chance_spawns(self, board)
+
+	def get_spawn_boards(self, board):
+		res = []
+		cells = bitboard.empty_cells(board)
+		for i in cells:
+			res.append((0.9/len(cells), bitboard.set_cell(board, i, 1)))
+			res.append((0.1/len(cells), bitboard.set_cell(board, i, 2)))
+		return res
+
+##########################################################
+# Bitboard game scoring spawn leaves as deltas
+#
+# BitboardGame2048 scores every leaf with eight row and column
+# lookups, the chain walk and four lookups for the parent board.
+# A leaf that is its parent with one spawned tile (the leaves of
+# an even depth expectimax) is scored as a delta here instead: the
+# parent's eval_tables.line_scores are kept while its spawns are
+# scored, and only the spawn's row and column are looked up again.
+##########################################################
+class TableEvalGame2048(BitboardGame2048):
+	# parent board of the last spawn leaf and its line_scores
+	_lines_board = None
+	_lines = None
+
+	def heuristic(self, parent_board, board, score):
+		diff = board ^ parent_board
+		cell = (diff.bit_length()-1) >> 2
+		# one cell that was empty in parent_board
+		if not diff or diff >> 4*cell << 4*cell != diff or (parent_board >> 4*cell) & bitboard.CELL_MASK:
+			return eval_tables.heuristic(parent_board, board, score)
+		if parent_board != self._lines_board:
+			self._lines = eval_tables.line_scores(parent_board)
+			self._lines_board = parent_board
+		return eval_tables.spawn_heuristic(self._lines, board, cell, score)
+
+##########################################################
+# moves of the AI keys, run by the AIWorker thread. Each returns
+# the move to play on game.board, or None when deadline (a
+# CancelToken) stopped the search.
+##########################################################
+def ai_expectimax(game, deadline):
+	num_zeros = game.get_num_zeros(game.board)
+	try:
+		if num_zeros < 3:
+			return game.expectimax(5+(3-num_zeros), deadline)
+		return game.expectimax(5, deadline)
+	except SearchTimeout:
+		return None
+
+def ai_alphabeta(game, deadline):
+	num_zeros = game.get_num_zeros(game.board)
+	try:
+		if num_zeros < 3:
+			return game.alphabeta(6+(3-num_zeros), deadline)
+		return game.alphabeta(6, deadline)
+	except SearchTimeout:
+		return None
+
+# expectimax when the score is less than 18,000 and alpha-beta when
+# score is greater than 18,000, 18,000 is arbitrary
+def ai_hybrid(game, deadline):
+	if game.get_score() > 18000:
+		return ai_alphabeta(game, deadline)
+	return ai_expectimax(game, deadline)
+
+# With depth of 4 and run over 50 games is won about 25% of them
+# return game.alphabeta(4)
+def ai_single_move(game, deadline):
+	try:
+		return game.expectimax(6, deadline)
+	except SearchTimeout:
+		return None
+
+def ai_random(game, deadline):
+	time.sleep(0.02)
+	return game.random_move()
+
+def ai_monte_carlo(game, deadline):
+	return game.monte_carlo(200)
+
+AI_KEYS = {
+	K_SPACE: ai_single_move,
+	K_e: ai_expectimax,
+	K_a: ai_alphabeta,
+	K_b: ai_hybrid,
+	K_r: ai_random,
+	K_m: ai_monte_carlo,
+}
+
 ##########################################################
 # main function for calling appropriate functions in Game 
 # class
 ##########################################################
 if __name__ == "__main__":
+	# with more than one core the AI searches are split across worker
+	# processes, started before pygame so they do not inherit its state
+	parallel = None
+	if (os.cpu_count() or 1) > 1:
+		parallel = ParallelSearch(TableEvalGame2048, tt_bytes=32*1024*1024, leaf_cache=True)
+
 	# Initialize pygame
 	pygame.init()
 	wd = os.getcwd()
@@ -997,133 +2054,115 @@ if __name__ == "__main__":
 	# Variable to keep the main loop running
 	running = True
 
-	curGame = Game2048()
+	curGame = TableEvalGame2048()
+	# keep searched positions between moves of a game
+	curGame.tt = TranspositionTable(persist=True)
+	curGame.leaf_cache = LeafCache()
+	curGame.star1 = True
+	curGame.parallel = parallel
+	# every game played is appended to games.bin, see replay.py
+	curGame.recorder = GameRecorder(open_log("games.bin"))
+
+	# the AI searches run in a worker thread, the loop below keeps
+	# handling events and plays the moves it posts
+	ai = AIWorker(curGame)
+	# choose_move function of the AI game being played, None when the
+	# keys play
+	ai_strategy = None
+	# True when the AI plays a single move (the space key)
+	ai_single = False
+	ai_paused = False
 
 	while running:
 		# Look at every event in the queue
 		for event in pygame.event.get():
 			# Did the user hit a key?
 			if event.type == KEYDOWN:
-				# Was it the Escape key? If so, stop the loop.
+				# Was it the Escape key? If so, stop the AI game, or the loop
+				# when no AI game is running.
 				if event.key == K_ESCAPE:
-					running = False
-
-				# if the key is space use expectimax for 1 move
-				best_move = -1
-				if event.key == K_SPACE:
-					board = curGame.get_boards()[0]
-					# With depth of 4 and run over 50 games is won about 25% of them
-					# best_move = curGame.alphabeta(4)
-					best_move = curGame.expectimax(6)
-
-				# if the key is E use expectimax for the game
-				if event.key == K_e:
-					while 1:
-						num_zeros = curGame.get_num_zeros(curGame.get_boards()[0])
-						if num_zeros < 3:
-							best_move = curGame.expectimax(5+(3-num_zeros))
-						else:
-							best_move = curGame.expectimax(5)
-						curGame.move(best_move)
-
-						boards = curGame.get_boards()
-						if boards[0] !=  boards[1]:
-							curGame.spawn_blocks()
-						curGame.print_pygame()
-
-						if curGame.terminal(boards[0]):
-							curGame.endGame()
-							break
-				
-				# if the key is R use only random moves
-				if event.key == K_r:
-					while 1:
-						move = curGame.random_move()
-						curGame.move(move)
-						time.sleep(0.02)
-						boards = curGame.get_boards()
-						if boards[0] !=  boards[1]:
-							curGame.spawn_blocks()
-						curGame.print_pygame()
-
-						if curGame.terminal(boards[0]):
-							curGame.endGame()
-							break
-				
-				# if the key is A use alpha-beta for the game
-				if event.key == K_a:
-					while 1:
-						num_zeros = curGame.get_num_zeros(curGame.get_boards()[0])
-						if num_zeros < 3:
-							best_move = curGame.alphabeta(6+(3-num_zeros))
-						else:
-							best_move = curGame.alphabeta(6)
-						
-						curGame.move(best_move)
-						boards = curGame.get_boards()
-						if boards[0] !=  boards[1]:
-							curGame.spawn_blocks()
-						curGame.print_pygame()
-
-						if curGame.terminal(boards[0]):
-							curGame.endGame()
-							break
-
-				# if the key is B use expectimax when the score is less than 18,000 and
-				# alpha-beta when score is greater than 18,000
-				# 18,000 is arbitrary
-				if event.key == K_b:
-					while 1:
-						num_zeros = curGame.get_num_zeros(curGame.get_boards()[0])
-						if curGame.get_score() > 18000:
-							if num_zeros < 3:
-								best_move = curGame.alphabeta(6+(3-num_zeros))
-							else:
-								best_move = curGame.alphabeta(6)
-						else:
-							if num_zeros < 3:
-								best_move = curGame.expectimax(5+(3-num_zeros))
-							else:
-								best_move = curGame.expectimax(5)
-
-						curGame.move(best_move)
-						boards = curGame.get_boards()
-						if boards[0] !=  boards[1]:
-							curGame.spawn_blocks()
-						curGame.print_pygame()
-
-						if curGame.terminal(boards[0]):
-							curGame.endGame()
-							break
-
-				if event.key == K_LEFT or best_move == 1:
-					curGame.move(1)
-					boards = curGame.get_boards()
-					if boards[0] !=  boards[1]:
-						curGame.spawn_blocks()
-
-                # up down left and right moves if playing manually
-				if event.key == K_UP or best_move == 2:
-					curGame.move(2)
-					boards = curGame.get_boards()
-					if boards[0] !=  boards[1]:
-						curGame.spawn_blocks()
-
-				if event.key == K_RIGHT or best_move == 3:
-					curGame.move(3)
-					boards = curGame.get_boards()
-					if boards[0] !=  boards[1]:
-						curGame.spawn_blocks()
-
-				if event.key == K_DOWN or best_move == 4:
-					curGame.move(4)
-					boards = curGame.get_boards()
-					if boards[0] !=  boards[1]:
-						curGame.spawn_blocks()
-
+					if ai_strategy is not None:
+						ai.cancel()
+						ai_strategy = None
+						print("AI stopped")
+					else:
+						running = False
+
+				# if the key is P pause or resume the AI game, a search that
+				# is running is stopped and searched again on resume
+				if event.key == K_p and ai_strategy is not None:
+					ai_paused = not ai_paused
+					if ai_paused:
+						ai.cancel()
+						print("AI paused")
+					else:
+						ai.request(ai_strategy)
+						print("AI resumed")
+
+				# if the key is T switch turbo mode, drawing is capped at 10
+				# frames a second so the AI spends its time searching
+				if event.key == K_t:
+					if curGame.max_fps is None:
+						curGame.max_fps = 10
+						print("Turbo mode on")
+					else:
+						curGame.max_fps = None
+						print("Turbo mode off")
+
+				# the other keys only work when no AI game is running
+				if ai_strategy is not None:
+					continue
+
+				# if the key is space use expectimax for 1 move, E expectimax,
+				# A alpha-beta, B a combination of both, R random moves and M
+				# Monte Carlo rollouts for the game
+				if event.key in AI_KEYS:
+					ai_strategy = AI_KEYS[event.key]
+					ai_single = event.key == K_SPACE
+					ai_paused = False
+					ai.request(ai_strategy)
+
+				# up down left and right moves if playing manually
+				if event.key == K_LEFT:
+					curGame.play(1)
+				if event.key == K_UP:
+					curGame.play(2)
+				if event.key == K_RIGHT:
+					curGame.play(3)
+				if event.key == K_DOWN:
+					curGame.play(4)
 
             # Did the user click the window close button? If so, stop the loop.
 			if event.type == QUIT:
 				running = False
 
-		curGame.print_pygame()
+		# play the move of the AI when it is ready, waiting for it at most
+		# a frame so events are still handled 60 times a second
+		try:
+			result = ai.wait_result(1/60) if ai.busy() else None
+		except Exception as exc:
+			result = None
+			ai_strategy = None
+			print(f"AI stopped, the search failed: {exc!r}")
+		if result is not None:
+			best_move, search_time = result
+			curGame.play(best_move, search_time)
+			curGame.print_pygame()
+			if best_move is None or curGame.terminal(curGame.get_search_board()):
+				ai_strategy = None
+				curGame.endGame()
+			elif ai_single:
+				ai_strategy = None
+			else:
+				ai.request(ai_strategy)
+		elif not ai.busy():
+			time.sleep(1/60)
+
+		# always show the latest board once the AI is done or paused
+		if ai_strategy is None or ai_paused:
+			curGame.print_pygame(force=True)
+
+	ai.close()
+	curGame.recorder.close()
+	if parallel is not None:
+		parallel.close()
@@ -0,0 +1,123 @@
+# Noah Nisbet
+# Background AI player
+# Runs the searches of an AI game in a worker thread so the pygame
+# event loop keeps running, and lets a search be stopped halfway.
+
+import math
+import queue
+import threading
+import time
+import traceback
+
+##########################################################
+# Cancellable deadline
+#
+# Passed to expectimax and alphabeta as their deadline. The
+# searches check time.perf_counter() > deadline, which is True
+# once cancel has been called from any thread (or once time_limit
+# seconds have passed, if given), so the search raises
+# SearchTimeout at its next node. ParallelSearch checks it the
+# same way while its workers search, and stops them once it is
+# cancelled. deadline - now gives the time left like a float
+# deadline does, for iterative deepening.
+##########################################################
+class CancelToken:
+	def __init__(self, time_limit=None):
+		self.cancelled = False
+		self.at = math.inf if time_limit is None else time.perf_counter() + time_limit
+
+	def cancel(self):
+		self.cancelled = True
+
+	# time.perf_counter() > token
+	def __lt__(self, now):
+		return self.cancelled or now > self.at
+
+	def __gt__(self, now):
+		return not self.cancelled and now < self.at
+
+	def __sub__(self, now):
+		return 0.0 if self.cancelled else self.at - now
+
+##########################################################
+# AI worker
+#
+# One daemon thread that searches the game's current board
+# whenever a move is requested. request(choose_move) starts a
+# search of choose_move(game, token), which returns the move to
+# play (it should pass token as the search deadline). The result is
+# read with wait_result on the UI thread, which plays the move and
+# requests the next one, so the game is only touched by one thread
+# at a time.
+#
+# cancel stops the running search at its next node and drops any
+# result not yet read. A search that is not interruptible (the
+# Monte Carlo rollouts) runs to its end but its move is dropped the
+# same way. An exception raised by choose_move is printed and raised
+# again by wait_result, the thread keeps serving requests.
+##########################################################
+class AIWorker:
+	def __init__(self, game):
+		self.game = game
+		self.requests = queue.Queue()
+		self.results = queue.Queue()
+		self.token = None
+		self.thread = threading.Thread(target=self._run, name="ai-search", daemon=True)
+		self.thread.start()
+
+	def _run(self):
+		while True:
+			request = self.requests.get()
+			if request is None:
+				return
+			choose_move, token = request
+			if token.cancelled:
+				continue
+			start = time.perf_counter()
+			move = error = None
+			try:
+				move = choose_move(self.game, token)
+			except Exception as exc:
+				traceback.print_exc()
+				error = exc
+			if not token.cancelled:
+				self.results.put((token, move, time.perf_counter() - start, error))
+
+	##########################################################
+	# True while a requested move has not been read yet
+	##########################################################
+	def busy(self):
+		return self.token is not None
+
+	def request(self, choose_move):
+		self.cancel()
+		self.token = CancelToken()
+		self.requests.put((choose_move, self.token))
+
+	def cancel(self):
+		if self.token is not None:
+			self.token.cancel()
+			self.token = None
+
+	##########################################################
+	# waits up to timeout seconds for the requested move, returns
+	# (move, search seconds) or None. Raises the exception of a
+	# search that failed.
+	##########################################################
+	def wait_result(self, timeout):
+		try:
+			token, move, seconds, error = self.results.get(timeout=timeout)
+		except queue.Empty:
+			return None
+		# a result of a cancelled request
+		if token is not self.token:
+			return None
+		self.token = None
+		if error is not None:
+			raise error
+		return move, seconds
+
+	def close(self):
+		self.cancel()
+		self.requests.put(None)
+		self.thread.join(timeout=1)
@@ -0,0 +1,164 @@
+# Noah Nisbet
+# NumPy batch evaluation
+# Scores many boards at once with the same heuristic as Game2048.evaluate
+
+import numpy as np
+
+# score given to terminal boards, the same constant as Game2048.evaluate
+TERMINAL_SCORE = -99999999999999999
+
+##########################################################
+# board conversion
+#
+# Batches are (N, 16) int64 arrays of tile values in the same
+# row-major order as Game2048.board.
+##########################################################
+def boards_to_array(boards):
+	return np.asarray(boards, dtype=np.int64).reshape(-1, 16)
+
+_SHIFTS = np.arange(0, 64, 4, dtype=np.uint64)
+
+def bitboards_to_array(boards):
+	boards = np.fromiter(boards, dtype=np.uint64).reshape(-1, 1)
+	exps = ((boards >> _SHIFTS) & np.uint64(0xF)).astype(np.int64)
+	return np.where(exps > 0, np.left_shift(1, exps), 0)
+
+##########################################################
+# Chain paths
+#
+# Game2048.chain_length walks a snake from the corner holding the
+# largest tile. The cells it visits do not depend on the tile
+# values, only on when it stops, so the walk of each of the eight
+# chains is replayed once here to get its list of cells. Negative
+# indices wrap the same way Python list indexing does, and a walk
+# ends where the scalar code would index past the board.
+##########################################################
+def _snake_path(i, j, step, flip, vertical):
+	path = []
+	while -4 <= i <= 3 and -4 <= j <= 3 and len(path) < 16:
+		path.append(4*(i % 4) + j % 4)
+		if vertical:
+			if i == 3 or i == 0:
+				step*=-1
+				j+=flip
+			i+=step
+		else:
+			if j == 3 or j == 0:
+				step*=-1
+				i+=flip
+			j+=step
+	return np.array(path)
+
+# (corner cell, first chain path, second chain path, stop at tiles <= 4)
+CHAINS = [
+	(0, _snake_path(1, 0, 1, 1, True), _snake_path(0, 1, 1, 1, False), True),
+	(3, _snake_path(1, 3, 1, -1, True), _snake_path(0, 2, -1, 1, False), True),
+	(12, _snake_path(2, 0, -1, 1, True), _snake_path(3, 1, 1, -1, False), True),
+	(15, _snake_path(2, 3, -1, -1, True), _snake_path(3, 2, -1, -1, False), False),
+]
+
+##########################################################
+# follows a chain along path for every board. Returns the chain
+# sums and the value of the cell each chain stopped on.
+##########################################################
+def _walk_chain(values, start, cur, path, above_four):
+	total = start.copy()
+	stop = np.zeros_like(start)
+	alive = np.ones(len(values), dtype=bool)
+	for cell in path:
+		value = values[:, cell]
+		cond = alive & (value < cur)
+		if above_four:
+			cond &= value > 4
+		total += np.where(cond, value, 0)
+		stop = np.where(alive & ~cond, value, stop)
+		cur = np.where(cond, value, cur)
+		alive = cond
+	return total, stop
+
+##########################################################
+# chain_length for a batch of boards
+##########################################################
+def chain_length_batch(values):
+	corners = values[:, [0, 3, 12, 15]]
+	# argmax picks the first largest corner, like max in chain_length
+	index = np.argmax(corners, axis=1)
+	res = np.zeros(len(values), dtype=np.int64)
+	for k, (corner, path1, path2, above_four) in enumerate(CHAINS):
+		rows = index == k
+		if not rows.any():
+			continue
+		sub = values[rows]
+		start = sub[:, corner]
+		chain1, stop = _walk_chain(sub, start, start, path1, above_four)
+		if corner == 15:
+			# the bottom right chain2 starts from the tile chain1 stopped on
+			chain2, _ = _walk_chain(sub, stop, start, path2, above_four)
+		else:
+			chain2, _ = _walk_chain(sub, start, start, path2, above_four)
+		res[rows] = np.maximum(chain1, chain2)
+	return res
+
+##########################################################
+# terminal for a batch of boards, full and no equal neighbours.
+# merge_limit is the largest tile that can still merge, None
+# when any pair merges (the bitboard engine stops at 16384).
+##########################################################
+def terminal_batch(values, merge_limit=None):
+	grid = values.reshape(-1, 4, 4)
+	full = (values != 0).all(axis=1)
+	rows = grid[:, :, 1:] == grid[:, :, :-1]
+	cols = grid[:, 1:, :] == grid[:, :-1, :]
+	if merge_limit is not None:
+		rows &= grid[:, :, 1:] <= merge_limit
+		cols &= grid[:, 1:, :] <= merge_limit
+	return full & ~rows.any(axis=(1, 2)) & ~cols.any(axis=(1, 2))
+
+##########################################################
+# neighbour similarity term for one direction, tiles close in value
+# add to the score and far apart tiles subtract from it
+##########################################################
+def _neighbour_terms(tile, other):
+	close = (tile == 2*other) | (2*tile == other)
+	far = ~close & ((tile > 8*other) | (4*tile > other))
+	return np.where(close, tile, 0).sum(axis=(1, 2)), np.where(far, np.abs(other - tile), 0).sum(axis=(1, 2))
+
+# edge cells add their value, middle rows and columns subtract theirs
+_EDGE = np.array([1, 1, 1, 1, 1, 0, 0, 1, 1, 0, 0, 1, 1, 1, 1, 1])
+_MIDDLE = np.array([0, 1, 1, 0, 1, 2, 2, 1, 1, 2, 2, 1, 0, 1, 1, 0])
+# the empty tile reward is added after every row with the count so far
+_EMPTY_WEIGHT = np.repeat([4, 3, 2, 1], 4)
+
+##########################################################
+# Game2048.evaluate for a batch of boards
+#
+# parent_values and values are (N, 16) arrays of tile values,
+# scores holds the score2 of every board and merge_limit is passed
+# to terminal_batch. The integer terms are summed exactly, the
+# results match evaluate up to float rounding of the 0.2
+# neighbour terms.
+##########################################################
+def evaluate_batch(parent_values, values, scores, merge_limit=None):
+	scores = np.asarray(scores, dtype=np.int64).reshape(-1)
+	grid = values.reshape(-1, 4, 4)
+
+	res = scores*5 + 200*chain_length_batch(values)
+	res += values.sum(axis=1) - 8*np.where(values <= 64, values, 0).sum(axis=1)
+	# moved tiles, every parent tile is subtracted
+	res -= 12*parent_values.sum(axis=1)
+	res += (values*_EDGE).sum(axis=1) - (values*_MIDDLE).sum(axis=1)
+	res += 2000*((values == 0)*_EMPTY_WEIGHT).sum(axis=1)
+
+	diffs = np.zeros(len(values), dtype=np.int64)
+	for tile, other in (
+		(grid[:, :-1, :], grid[:, 1:, :]),
+		(grid[:, :, :-1], grid[:, :, 1:]),
+		(grid[:, 1:, :], grid[:, :-1, :]),
+		(grid[:, :, 1:], grid[:, :, :-1]),
+	):
+		close, far = _neighbour_terms(tile, other)
+		res += close
+		diffs += far
+
+	res = res - 0.2*diffs
+	return np.where(terminal_batch(values, merge_limit), float(TERMINAL_SCORE) + scores, res)
@@ -0,0 +1,249 @@
+# Noah Nisbet
+# Pool of warm search workers
+# Worker processes that each keep one game alive (evaluation tables
+# loaded, transposition table and leaf cache kept) and search batches
+# of boards sent to them.
+#
+# example:
+#   python3 batch_search.py positions.json --depth 3 --out moves.jsonl
+
+import argparse
+import json
+import os
+import sys
+import time
+from itertools import islice
+from multiprocessing import Pool
+
+import bitboard
+import ntuple
+from simulate import ENGINES
+from transposition import TranspositionTable, LeafCache
+
+STRATEGIES = ("expectimax", "alphabeta")
+MAX_DEPTH = 20
+
+# the game each worker process searches with, made once by _init_worker
+_worker_game = None
+
+##########################################################
+# runs once in every worker, like parallel._init_worker. The
+# transposition table is never cleared: its keys hold everything a
+# value depends on, so entries stay valid for any later board.
+# star1 turns on Star1 pruning of expectimax (Game2048.star1).
+##########################################################
+def _init_worker(game_class, tt_bytes, evaluator_path, star1=False):
+	global _worker_game
+	_worker_game = game_class()
+	_worker_game.star1 = star1
+	if evaluator_path is not None:
+		_worker_game.evaluator = ntuple.load(evaluator_path)
+		_worker_game.symmetric_keys = True
+	if tt_bytes > 0:
+		_worker_game.tt = TranspositionTable(max_bytes=tt_bytes, persist=True)
+	_worker_game.leaf_cache = LeafCache()
+	_worker_game.expectimax(2)
+
+def _ready(_):
+	return os.getpid()
+
+##########################################################
+# checks a request and returns it with its defaults filled in, or
+# raises ValueError. A request is a dictionary with
+#   board      16 tile values, the same list as Game2048.board
+#   strategy   "expectimax" (default) or "alphabeta"
+#   depth      search depth
+#   time       seconds for an iterative deepening search, instead
+#              of depth
+#   score      game score, default 0
+# depth defaults to 5 for expectimax and 6 for alphabeta, like the
+# AI keys.
+##########################################################
+def check_request(request):
+	if not isinstance(request, dict):
+		raise ValueError("a request must be an object")
+	board = request.get("board")
+	if not isinstance(board, (list, tuple)) or len(board) != 16:
+		raise ValueError("board must be a list of 16 tile values")
+	for tile in board:
+		if not isinstance(tile, int) or isinstance(tile, bool) or tile < 0 or tile & (tile-1) or tile > 32768 or tile == 1:
+			raise ValueError(f"invalid tile {tile!r}, tiles are 0 or powers of two from 2 to 32768")
+
+	strategy = request.get("strategy", "expectimax")
+	if strategy not in STRATEGIES:
+		raise ValueError(f"strategy must be one of {STRATEGIES}")
+
+	time_limit = request.get("time")
+	depth = request.get("depth")
+	if time_limit is not None:
+		if not isinstance(time_limit, (int, float)) or time_limit <= 0:
+			raise ValueError("time must be a positive number of seconds")
+		depth = None
+	else:
+		if depth is None:
+			depth = 5 if strategy == "expectimax" else 6
+		if not isinstance(depth, int) or not 1 <= depth <= MAX_DEPTH:
+			raise ValueError(f"depth must be an integer from 1 to {MAX_DEPTH}")
+
+	score = request.get("score", 0)
+	if not isinstance(score, int) or score < 0:
+		raise ValueError("score must be a non-negative integer")
+
+	return {"board": list(board), "strategy": strategy, "depth": depth, "time": time_limit, "score": score}
+
+##########################################################
+# searches one checked request on game. Returns the move (None
+# when no move is legal), its value, the depth searched and the
+# search time.
+##########################################################
+def search_board(game, request):
+	game.board = list(request["board"])
+	game.score = request["score"]
+	game.last_value = None
+	start = time.perf_counter()
+	if request["strategy"] == "expectimax":
+		if request["time"] is None:
+			move = game.expectimax(request["depth"])
+		else:
+			move = game.expectimax_timed(request["time"])
+	else:
+		if request["time"] is None:
+			move = game.alphabeta(request["depth"])
+		else:
+			move = game.alphabeta_timed(request["time"])
+	seconds = time.perf_counter() - start
+
+	depth = request["depth"] if request["time"] is None else game.last_search_depth
+	value = game.last_value if move is not None else None
+	return {"move": move, "value": value, "depth": depth, "seconds": seconds}
+
+def _search_batch_task(batch):
+	return [(index, search_board(_worker_game, request)) for index, request in batch]
+
+##########################################################
+# Search pool
+#
+# Keeps a pool of worker processes alive between batches. submit
+# splits a batch of checked requests into a few chunks per worker,
+# so a large batch costs a few messages instead of one per board,
+# and calls callback with a list of (index, result) for every chunk
+# as it finishes (on a thread of the pool). A chunk that fails calls
+# error_callback with the indices of its requests and the exception.
+##########################################################
+class SearchPool:
+	def __init__(self, game_class, workers=None, tt_bytes=64*1024*1024, evaluator_path=None, star1=False):
+		self.workers = workers or os.cpu_count()
+		self.pool = Pool(processes=self.workers, initializer=_init_worker,
+			initargs=(game_class, tt_bytes, evaluator_path, star1))
+		# wait for every worker to finish warming up
+		self.pool.map(_ready, range(self.workers), chunksize=1)
+
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	##########################################################
+	# splits requests (a list of (index, request)) into chunks
+	##########################################################
+	def chunks(self, requests, per_worker=2):
+		count = min(len(requests), per_worker*self.workers)
+		if count == 0:
+			return []
+		size = -(-len(requests) // count)
+		return [requests[i:i+size] for i in range(0, len(requests), size)]
+
+	def submit(self, requests, callback, error_callback):
+		for chunk in self.chunks(requests):
+			def failed(exc, indices=[index for index, _ in chunk]):
+				error_callback(indices, exc)
+			self.pool.apply_async(_search_batch_task, (chunk,), callback=callback, error_callback=failed)
+
+	##########################################################
+	# best move of every board, yielded as (index, move, value) in
+	# the order the searches finish. See best_moves.
+	##########################################################
+	def best_moves(self, boards, depth=None, strategy="expectimax", time_limit=None, chunk_size=64):
+		requests = enumerate(check_request({"board": board_list(board), "strategy": strategy, "depth": depth,
+			"time": time_limit}) for board in boards)
+		chunks = iter(lambda: list(islice(requests, chunk_size)), [])
+		for results in self.pool.imap_unordered(_search_batch_task, chunks):
+			for index, result in results:
+				yield index, result["move"], result["value"]
+
+##########################################################
+# a board as a 16 element list of tile values. Boards can be lists,
+# rows of a NumPy array or bitboards.
+##########################################################
+def board_list(board):
+	if isinstance(board, int) or hasattr(board, "dtype") and board.ndim == 0:
+		return bitboard.from_bitboard(int(board))
+	return [int(tile) for tile in board]
+
+##########################################################
+# Batch best moves
+#
+# Searches the best move of every board in boards (any iterable,
+# for example a list of Game2048.board lists, an (N, 16) NumPy
+# array of tile values or an array of bitboards) and yields
+# (index, move, value) as each search finishes, index being the
+# board's position in boards. Boards are read lazily and sent to
+# the workers in chunks of chunk_size, so the tables, caches and
+# processes of one pool serve the whole batch.
+#
+# depth or time_limit (seconds per board) set the search as in the
+# service requests. Pass a SearchPool to reuse its workers across
+# calls, otherwise one is started for this batch.
+##########################################################
+def best_moves(boards, depth=None, strategy="expectimax", time_limit=None, pool=None, engine="table",
+		workers=None, chunk_size=64):
+	if pool is not None:
+		yield from pool.best_moves(boards, depth, strategy, time_limit, chunk_size)
+		return
+	with SearchPool(ENGINES[engine], workers) as pool:
+		yield from pool.best_moves(boards, depth, strategy, time_limit, chunk_size)
+
+##########################################################
+# reads the boards of a json file, a list of boards or a
+# benchmark corpus {stage: [board, ...]} (replay.py --corpus)
+##########################################################
+def load_boards(path):
+	with open(path) as f:
+		data = json.load(f)
+	if isinstance(data, dict):
+		return [board for boards in data.values() for board in boards]
+	return data
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description="Search the best move of every board in a file.")
+	parser.add_argument("boards", help="json list of boards or {stage: [board, ...]} corpus")
+	parser.add_argument("--strategy", choices=STRATEGIES, default="expectimax")
+	parser.add_argument("--depth", type=int, default=None, help="search depth (default: 5 expectimax, 6 alphabeta)")
+	parser.add_argument("--time", type=float, default=None, help="seconds per board instead of a depth")
+	parser.add_argument("--engine", choices=sorted(ENGINES), default="table")
+	parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: all cores)")
+	parser.add_argument("--out", metavar="PATH", help="write json lines here instead of stdout")
+	return parser.parse_args(argv)
+
+def main(argv=None):
+	args = parse_args(argv)
+	boards = load_boards(args.boards)
+	out = open(args.out, "w") if args.out else sys.stdout
+	start = time.perf_counter()
+	try:
+		for index, move, value in best_moves(boards, args.depth, args.strategy, args.time,
+				engine=args.engine, workers=args.workers):
+			out.write(json.dumps({"index": index, "board": boards[index], "move": move, "value": value}) + "\n")
+	finally:
+		if out is not sys.stdout:
+			out.close()
+	seconds = time.perf_counter() - start
+	print(f"{len(boards)} boards in {seconds:.2f} s ({len(boards)/seconds:.0f} boards/s)", file=sys.stderr)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,253 @@
+# Noah Nisbet
+# Benchmarks for the 2048 search hot paths
+# Times the board functions and the searches on a fixed, seeded corpus
+# of boards and compares the results against a saved baseline.
+#
+# example:
+#   python3 benchmark.py --save baseline.json
+#   python3 benchmark.py --baseline baseline.json
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+import eval_tables
+from simulate import ENGINES
+
+CORPUS_SEED = 2048
+
+##########################################################
+# corpus stages, (largest tile exponent, min empty, max empty)
+##########################################################
+STAGES = {
+	"early": (6, 10, 13),
+	"mid": (9, 5, 9),
+	"late": (11, 0, 3),
+}
+
+##########################################################
+# makes the benchmark corpus, boards_per_stage boards of every stage.
+# The corpus only depends on the seed, not on the engine, so it stays
+# the same while the engine changes.
+##########################################################
+def make_corpus(seed=CORPUS_SEED, boards_per_stage=8):
+	rng = random.Random(seed)
+	corpus = {}
+	for stage, (max_exp, min_empty, max_empty) in STAGES.items():
+		boards = []
+		for _ in range(boards_per_stage):
+			num_empty = rng.randint(min_empty, max_empty)
+			board = [0 for _ in range(16)]
+			for i in rng.sample(range(16), 16-num_empty):
+				board[i] = 2**rng.randint(1, max_exp)
+			boards.append(board)
+		corpus[stage] = boards
+	return corpus
+
+##########################################################
+# reads a corpus saved as {"stage": [board, ...]}
+##########################################################
+def load_corpus(path):
+	with open(path) as f:
+		return json.load(f)
+
+##########################################################
+# times fn over every argument tuple in calls, returns the best
+# nanoseconds per call over repeat runs
+##########################################################
+def time_calls(fn, calls, repeat, number):
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter_ns()
+		for _ in range(number):
+			for args in calls:
+				fn(*args)
+		elapsed = (time.perf_counter_ns() - start) / (number*len(calls))
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+##########################################################
+# micro benchmarks, nanoseconds per call of each hot path
+##########################################################
+def micro_benchmarks(engine, corpus, repeat, number):
+	game = ENGINES[engine]()
+	boards = [board for stage in corpus.values() for board in stage]
+	# boards in the engine's own representation
+	game_boards = []
+	for board in boards:
+		game.board = list(board)
+		game_boards.append(game.get_search_board())
+	children = [game.get_child_boards(1, board) for board in game_boards]
+
+	results = {}
+	results["move2"] = time_calls(game.move2, [(board, dir) for board in game_boards for dir in range(1, 5)], repeat, number)
+	results["terminal"] = time_calls(game.terminal, [(board,) for board in game_boards], repeat, number)
+	# (parent, child, score) of every child board in the corpus
+	batch = [(board, child[1], child[2]) for board, child_boards in zip(game_boards, children) for child in child_boards]
+	results["evaluate"] = time_calls(game.evaluate, batch, repeat, number)
+	# evaluate_batch scores every child board in one call, reported per board
+	results["evaluate_batch"] = time_calls(game.evaluate_batch,
+		[([args[0] for args in batch], [args[1] for args in batch], [args[2] for args in batch])],
+		repeat, number) / len(batch)
+	# the bitboard engines score the chain on the bitboard itself
+	if isinstance(game_boards[0], int):
+		results["chain_length"] = time_calls(eval_tables.chain_length, [(board,) for board in game_boards], repeat, number)
+	else:
+		results["chain_length"] = time_calls(game.chain_length,
+			[([board[0:4], board[4:8], board[8:12], board[12:16]],) for board in boards], repeat, number)
+	results["get_child_boards_max"] = time_calls(game.get_child_boards, [(1, board) for board in game_boards], repeat, number)
+	random.seed(0)
+	results["get_child_boards_chance"] = time_calls(game.get_child_boards, [(2, board) for board in game_boards], repeat, number)
+	return {name: {"ns_per_call": ns} for name, ns in results.items()}
+
+##########################################################
+# wraps a game method so that its calls are counted
+##########################################################
+def count_calls(game, name, counter):
+	method = getattr(game, name)
+	def counted(*args):
+		counter[0]+=1
+		return method(*args)
+	setattr(game, name, counted)
+
+##########################################################
+# search benchmarks, mean time per search and nodes per second
+# at each depth. A node is an expanded board (move_children, or
+# spawn_children and chance_children for chance nodes) or an
+# evaluated leaf (evaluate).
+##########################################################
+def search_benchmarks(engine, corpus, search, depths):
+	results = {}
+	for depth in depths:
+		game = ENGINES[engine]()
+		nodes = [0]
+		count_calls(game, "move_children", nodes)
+		count_calls(game, "spawn_children", nodes)
+		count_calls(game, "chance_children", nodes)
+		count_calls(game, "evaluate", nodes)
+
+		elapsed = 0.0
+		searches = 0
+		for stage in corpus.values():
+			for board in stage:
+				game.board = list(board)
+				# chance nodes sample spawns with the global random generator
+				random.seed(CORPUS_SEED)
+				start = time.perf_counter()
+				getattr(game, search)(depth)
+				elapsed += time.perf_counter() - start
+				searches+=1
+
+		results[f"{search}_d{depth}"] = {
+			"seconds": elapsed / searches,
+			"nodes": nodes[0],
+			"nodes_per_second": nodes[0] / elapsed if elapsed > 0 else 0.0,
+		}
+	return results
+
+##########################################################
+# runs the whole suite and returns a json friendly report
+##########################################################
+def run_suite(engines, corpus, expectimax_depths, alphabeta_depths, repeat=3, number=20):
+	results = {}
+	for engine in engines:
+		for name, value in micro_benchmarks(engine, corpus, repeat, number).items():
+			results[f"micro.{engine}.{name}"] = value
+		for name, value in search_benchmarks(engine, corpus, "expectimax", expectimax_depths).items():
+			results[f"search.{engine}.{name}"] = value
+		for name, value in search_benchmarks(engine, corpus, "alphabeta", alphabeta_depths).items():
+			results[f"search.{engine}.{name}"] = value
+
+	return {
+		"meta": {
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+			"boards": sum(len(stage) for stage in corpus.values()),
+		},
+		"results": results,
+	}
+
+##########################################################
+# compares a report against a baseline report. Returns rows of
+# (name, metric, baseline, current, ratio) and whether any timing
+# got slower than the baseline by more than threshold.
+##########################################################
+def compare(report, baseline, threshold):
+	rows = []
+	regressed = False
+	for name, value in report["results"].items():
+		if name not in baseline["results"]:
+			continue
+		for metric in ("ns_per_call", "seconds"):
+			if metric in value and metric in baseline["results"][name]:
+				old = baseline["results"][name][metric]
+				ratio = value[metric] / old if old > 0 else 1.0
+				rows.append((name, metric, old, value[metric], ratio))
+				if ratio > 1+threshold:
+					regressed = True
+	return rows, regressed
+
+def print_report(report):
+	for name, value in report["results"].items():
+		if "ns_per_call" in value:
+			print(f"{name:<45} {value['ns_per_call']:>14.0f} ns/call")
+		else:
+			print(f"{name:<45} {1000*value['seconds']:>11.2f} ms/search  {value['nodes_per_second']:>10.0f} nodes/s")
+
+def print_comparison(rows, threshold):
+	for name, metric, old, new, ratio in rows:
+		flag = "  SLOWER" if ratio > 1+threshold else ""
+		print(f"{name:<45} {metric:<12} {old:>14.6g} -> {new:<14.6g} x{ratio:.2f}{flag}")
+
+def parse_depths(text):
+	return [int(depth) for depth in text.split(",") if depth]
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark the 2048 engine hot paths.")
+	parser.add_argument("--engine", choices=sorted(ENGINES), action="append",
+		help="engine to benchmark, can be given more than once (default: all)")
+	parser.add_argument("--expectimax-depths", type=parse_depths, default=[1, 2, 3, 4])
+	parser.add_argument("--alphabeta-depths", type=parse_depths, default=[1, 2, 3, 4, 5])
+	parser.add_argument("--corpus", metavar="PATH", help="json corpus {stage: [board, ...]} instead of the seeded one")
+	parser.add_argument("--boards-per-stage", type=int, default=8)
+	parser.add_argument("--repeat", type=int, default=3, help="micro benchmark runs, the best is kept")
+	parser.add_argument("--number", type=int, default=20, help="passes over the corpus per micro benchmark run")
+	parser.add_argument("--save", metavar="PATH", help="write the report as json")
+	parser.add_argument("--baseline", metavar="PATH", help="compare against a saved report")
+	parser.add_argument("--threshold", type=float, default=0.10,
+		help="slowdown against the baseline that counts as a regression (default: 0.10)")
+	return parser.parse_args(argv)
+
+def main(argv=None):
+	args = parse_args(argv)
+	if args.corpus:
+		corpus = load_corpus(args.corpus)
+	else:
+		corpus = make_corpus(boards_per_stage=args.boards_per_stage)
+
+	report = run_suite(args.engine or sorted(ENGINES), corpus, args.expectimax_depths,
+		args.alphabeta_depths, args.repeat, args.number)
+	print_report(report)
+
+	if args.save:
+		with open(args.save, "w") as f:
+			json.dump(report, f, indent=1)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		rows, regressed = compare(report, baseline, args.threshold)
+		print()
+		print_comparison(rows, args.threshold)
+		if regressed:
+			print(f"regression: at least one timing is more than {100*args.threshold:.0f}% slower than the baseline")
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
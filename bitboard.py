@@ -0,0 +1,395 @@
+# Noah Nisbet
+# 2048 bitboard engine
+# Stores a board as a single 64-bit integer of 4-bit tile exponents
+
+import os
+import time
+from array import array
+from random import randint
+
+##########################################################
+# Board layout
+#
+# Every cell holds the exponent of its tile (0 = empty, 1 = 2,
+# 2 = 4, ... 15 = 32768) in 4 bits. Cell i of the list board
+# (row-major, the same indexing as Game2048.board) lives in bits
+# 4*i to 4*i+3, so row r is the 16 bits starting at bit 16*r and
+# column c of that row is the nibble starting at bit 4*c.
+##########################################################
+ROW_MASK = 0xFFFF
+CELL_MASK = 0xF
+# a one in the lowest bit of every cell
+CELL_ONES = 0x1111111111111111
+# largest tile that can merge, two 32768 tiles would not fit in a cell
+MERGE_LIMIT = 16384
+
+##########################################################
+# Conversion to and from the 16 element list used by Game2048
+##########################################################
+def to_bitboard(board):
+	res = 0
+	for i in range(16):
+		if board[i] != 0:
+			res |= (board[i].bit_length() - 1) << (4*i)
+	return res
+
+def from_bitboard(board):
+	res = []
+	for i in range(16):
+		exp = (board >> (4*i)) & CELL_MASK
+		if exp == 0:
+			res.append(0)
+		else:
+			res.append(1 << exp)
+	return res
+
+##########################################################
+# Slide and merge a single row towards column 0.
+# Returns the resulting row and the score gained from merges.
+#
+# This walks the tiles exactly like the left branch of
+# Game2048.move2 so that both engines agree on every board.
+# A pair of 32768 tiles does not merge because the result would
+# not fit in 4 bits.
+##########################################################
+def slide_row_left(row):
+	lst = [(row >> (4*c)) & CELL_MASK for c in range(4)]
+	score = 0
+	for i in range(1, 4):
+		if lst[i] != 0:
+			# sentinel value, tiles can only combine once a move
+			sentinel = 0
+			while i != 0:
+				if lst[i] == lst[i-1] and sentinel == 0 and lst[i] != CELL_MASK:
+					sentinel = 1
+					lst[i-1] = 0
+					lst[i] += 1
+					score += 1 << lst[i]
+				if lst[i-1] == 0:
+					lst[i-1] = lst[i]
+					lst[i] = 0
+					i -= 1
+				else:
+					break
+
+	new_row = lst[0] | (lst[1] << 4) | (lst[2] << 8) | (lst[3] << 12)
+	return new_row, score
+
+##########################################################
+# mirror a row so that column 0 becomes column 3
+##########################################################
+def reverse_row(row):
+	return ((row & 0xF) << 12) | ((row & 0xF0) << 4) | ((row >> 4) & 0xF0) | (row >> 12)
+
+##########################################################
+# Row transition tables
+#
+# There are only 65536 possible rows, so the result of sliding
+# every row left and right is computed once and looked up after
+# that. ROW_CAN_MOVE holds a bitmask per row, bit 1 is set when
+# the row changes moving left and bit 2 when it changes moving
+# right. Up and down reuse the same tables through transpose.
+#
+# The tables are saved to TABLE_CACHE after the first build so
+# later start ups only read the file.
+##########################################################
+TABLE_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "row_tables.bin")
+# bump this when slide_row_left changes so old cache files are rebuilt
+TABLE_VERSION = 1
+_TABLE_MAGIC = b"2048ROWS"
+
+CAN_MOVE_LEFT = 1
+CAN_MOVE_RIGHT = 2
+
+##########################################################
+# build the row tables from slide_row_left
+##########################################################
+def build_tables():
+	row_left = array("H", bytes(2*65536))
+	row_right = array("H", bytes(2*65536))
+	left_score = array("I", bytes(4*65536))
+	right_score = array("I", bytes(4*65536))
+	can_move = array("B", bytes(65536))
+	for row in range(65536):
+		new_row, score = slide_row_left(row)
+		row_left[row] = new_row
+		left_score[row] = score
+		rev_row, rev_score = slide_row_left(reverse_row(row))
+		row_right[row] = reverse_row(rev_row)
+		right_score[row] = rev_score
+
+		if new_row != row:
+			can_move[row] |= CAN_MOVE_LEFT
+		if row_right[row] != row:
+			can_move[row] |= CAN_MOVE_RIGHT
+
+	return row_left, row_right, left_score, right_score, can_move
+
+##########################################################
+# Table cache files
+#
+# A cache file is a header (magic bytes and a version) followed by
+# the raw contents of 65536 entry arrays with the given typecodes.
+# These are shared with the other table modules (eval_tables.py).
+##########################################################
+
+##########################################################
+# read tables from a cache file, returns None if the file is
+# missing or was written with another magic or version
+##########################################################
+def read_tables(path, magic, version, typecodes):
+	try:
+		with open(path, "rb") as f:
+			header = f.read(len(magic)+1)
+			if header != magic + bytes([version]):
+				return None
+			tables = [array(typecode) for typecode in typecodes]
+			for table in tables:
+				table.fromfile(f, 65536)
+			return tuple(tables)
+	except (OSError, EOFError):
+		return None
+
+##########################################################
+# write tables to a cache file, failing to write the cache is not
+# an error, the tables are just rebuilt next time. The file is
+# written under a temporary name and renamed so other processes
+# never read a half written cache.
+##########################################################
+def write_tables(path, magic, version, tables):
+	tmp_path = f"{path}.{os.getpid()}.tmp"
+	try:
+		with open(tmp_path, "wb") as f:
+			f.write(magic + bytes([version]))
+			for table in tables:
+				table.tofile(f)
+		os.replace(tmp_path, path)
+		return True
+	except OSError:
+		return False
+
+##########################################################
+# load tables from a cache file or make them with build() and
+# cache them. Returns the tables and a dictionary describing the
+# load (where they came from, seconds taken and bytes used).
+##########################################################
+def load_cached_tables(path, magic, version, typecodes, build):
+	start = time.perf_counter()
+	tables = None
+	source = "cache"
+	if path is not None:
+		tables = read_tables(path, magic, version, typecodes)
+	if tables is None:
+		tables = build()
+		source = "built"
+		if path is not None:
+			write_tables(path, magic, version, tables)
+
+	stats = {
+		"source": source,
+		"seconds": time.perf_counter() - start,
+		"bytes": sum(table.itemsize * len(table) for table in tables),
+	}
+	return tables, stats
+
+##########################################################
+# load the row tables from the cache or build and cache them
+##########################################################
+def load_tables(path=TABLE_CACHE):
+	return load_cached_tables(path, _TABLE_MAGIC, TABLE_VERSION, "HHIIB", build_tables)
+
+(ROW_LEFT, ROW_RIGHT, ROW_LEFT_SCORE, ROW_RIGHT_SCORE, ROW_CAN_MOVE), TABLE_STATS = load_tables()
+
+def move_row_left(row):
+	return ROW_LEFT[row], ROW_LEFT_SCORE[row]
+
+def move_row_right(row):
+	return ROW_RIGHT[row], ROW_RIGHT_SCORE[row]
+
+##########################################################
+# swap rows and columns, cell (r,c) moves to (c,r)
+##########################################################
+def transpose(board):
+	a1 = board & 0xF0F00F0FF0F00F0F
+	a2 = board & 0x0000F0F00000F0F0
+	a3 = board & 0x0F0F00000F0F0000
+	a = a1 | (a2 << 12) | (a3 >> 12)
+	b1 = a & 0xFF00FF0000FF00FF
+	b2 = a & 0x00FF00FF00000000
+	b3 = a & 0x00000000FF00FF00
+	return b1 | (b2 >> 24) | (b3 << 24)
+
+##########################################################
+# reflect left to right, cell (r,c) moves to (r,3-c)
+##########################################################
+def mirror(board):
+	return ((board & 0x000F000F000F000F) << 12) | ((board & 0x00F000F000F000F0) << 4) \
+		| ((board >> 4) & 0x00F000F000F000F0) | ((board >> 12) & 0x000F000F000F000F)
+
+##########################################################
+# reflect top to bottom, cell (r,c) moves to (3-r,c)
+##########################################################
+def flip(board):
+	return ((board & 0xFFFF) << 48) | ((board & 0xFFFF0000) << 16) \
+		| ((board >> 16) & 0xFFFF0000) | (board >> 48)
+
+##########################################################
+# the eight rotations and reflections of a board, starting with
+# the board itself
+##########################################################
+def symmetries(board):
+	m = mirror(board)
+	f = flip(board)
+	t = transpose(board)
+	mt = mirror(t)
+	return [board, m, f, mirror(f), t, mt, flip(t), flip(mt)]
+
+##########################################################
+# Canonical boards
+#
+# The moves commute with the symmetries: move k on a board gives
+# the same result (transformed) as move MOVE_MAPS[t][k] on
+# symmetries(board)[t], with the same score. UNMAP_MOVES[t] turns
+# a move on the transformed board back into one on the board.
+# Index 0 of each map is unused, moves are 1-4.
+##########################################################
+MOVE_MAPS = (
+	(0, 1, 2, 3, 4),
+	(0, 3, 2, 1, 4),
+	(0, 1, 4, 3, 2),
+	(0, 3, 4, 1, 2),
+	(0, 2, 1, 4, 3),
+	(0, 2, 3, 4, 1),
+	(0, 4, 1, 2, 3),
+	(0, 4, 3, 2, 1),
+)
+UNMAP_MOVES = tuple(tuple([0]+[move_map.index(k) for k in range(1, 5)]) for move_map in MOVE_MAPS)
+
+##########################################################
+# the smallest of the eight symmetries of a board and the index
+# into symmetries() of the transform that gives it. Boards that
+# are rotations or reflections of each other share a canonical
+# board.
+##########################################################
+def canonical(board):
+	syms = symmetries(board)
+	res = min(syms)
+	return res, syms.index(res)
+
+##########################################################
+# slide all four rows of a board with a row table
+##########################################################
+def _move_rows(board, rows, scores):
+	r0 = board & ROW_MASK
+	r1 = (board >> 16) & ROW_MASK
+	r2 = (board >> 32) & ROW_MASK
+	r3 = board >> 48
+	res = rows[r0] | (rows[r1] << 16) | (rows[r2] << 32) | (rows[r3] << 48)
+	return res, scores[r0] + scores[r1] + scores[r2] + scores[r3]
+
+##########################################################
+# moves a board and returns the new board and the score gained,
+# the same contract as Game2048.move2
+#
+# dir map:
+# 1 = left
+# 2 = up
+# 3 = right
+# 4 = down
+##########################################################
+def move(board, dir):
+	if dir == 1:
+		return _move_rows(board, ROW_LEFT, ROW_LEFT_SCORE)
+	elif dir == 2:
+		res, score = _move_rows(transpose(board), ROW_LEFT, ROW_LEFT_SCORE)
+		return transpose(res), score
+	elif dir == 3:
+		return _move_rows(board, ROW_RIGHT, ROW_RIGHT_SCORE)
+	elif dir == 4:
+		res, score = _move_rows(transpose(board), ROW_RIGHT, ROW_RIGHT_SCORE)
+		return transpose(res), score
+	return board, 0
+
+##########################################################
+# returns the legal moves of a board without building the
+# child boards, in the same 1-4 order as move
+##########################################################
+def legal_moves(board):
+	rows = ROW_CAN_MOVE[board & ROW_MASK] | ROW_CAN_MOVE[(board >> 16) & ROW_MASK] \
+		| ROW_CAN_MOVE[(board >> 32) & ROW_MASK] | ROW_CAN_MOVE[board >> 48]
+	t = transpose(board)
+	cols = ROW_CAN_MOVE[t & ROW_MASK] | ROW_CAN_MOVE[(t >> 16) & ROW_MASK] \
+		| ROW_CAN_MOVE[(t >> 32) & ROW_MASK] | ROW_CAN_MOVE[t >> 48]
+
+	res = []
+	if rows & CAN_MOVE_LEFT:
+		res.append(1)
+	if cols & CAN_MOVE_LEFT:
+		res.append(2)
+	if rows & CAN_MOVE_RIGHT:
+		res.append(3)
+	if cols & CAN_MOVE_RIGHT:
+		res.append(4)
+	return res
+
+##########################################################
+# number of empty cells on a board
+##########################################################
+def count_empty(board):
+	# fold every cell into its lowest bit, then count the cells that stayed zero
+	board |= (board >> 2) & 0x3333333333333333
+	board |= board >> 1
+	return (~board & CELL_ONES).bit_count()
+
+##########################################################
+# indices (0-15) of the empty cells on a board
+##########################################################
+def empty_cells(board):
+	return [i for i in range(16) if (board >> (4*i)) & CELL_MASK == 0]
+
+##########################################################
+# value of the largest tile on the board
+##########################################################
+def max_tile(board):
+	res = 0
+	while board:
+		res = max(res, board & CELL_MASK)
+		board >>= 4
+	return 0 if res == 0 else 1 << res
+
+##########################################################
+# A board is terminal when it is full and no move changes it.
+# Any board with an empty cell keeps an empty cell after every
+# move so it is never terminal, the same rule Game2048.terminal
+# applies through move2.
+##########################################################
+def is_terminal(board):
+	return count_empty(board) == 0 and len(legal_moves(board)) == 0
+
+##########################################################
+# place a tile with the given exponent on cell i
+##########################################################
+def set_cell(board, i, exp):
+	return (board & ~(CELL_MASK << (4*i))) | (exp << (4*i))
+
+##########################################################
+# spawn a random tile, a two with a 90% chance and a four with
+# a 10% chance, the same rule as Game2048.spawn_blocks
+##########################################################
+def spawn(board):
+	cells = empty_cells(board)
+	if len(cells) == 0:
+		return board
+	cell_num = cells[randint(0, len(cells)-1)]
+	exp = 1
+	if randint(0, 9) == 0:
+		exp = 2
+	return set_cell(board, cell_num, exp)
+
+##########################################################
+# report how the row tables were loaded
+##########################################################
+if __name__ == "__main__":
+	print(f"row tables {TABLE_STATS['source']} in {TABLE_STATS['seconds']*1000:.1f} ms")
+	print(f"row tables use {TABLE_STATS['bytes']/1024:.0f} KiB")
+	print(f"cache file: {TABLE_CACHE}")
@@ -0,0 +1,249 @@
+# Noah Nisbet
+# Table driven evaluation
+# Game2048.evaluate split into per row and per column tables so that a
+# bitboard is scored with a handful of lookups
+
+import os
+from array import array
+
+import batch_eval
+import bitboard
+from bitboard import ROW_MASK, CELL_MASK
+
+# score given to terminal boards, the same constant as Game2048.evaluate
+TERMINAL_SCORE = -99999999999999999
+
+# the chain paths of batch_eval as lists of cells
+CHAINS = [(corner, path1.tolist(), path2.tolist(), above_four)
+	for corner, path1, path2, above_four in batch_eval.CHAINS]
+
+##########################################################
+# Evaluation tables
+#
+# Every term of the heuristic except the chain is a sum over rows
+# and columns:
+# ROW_SCORES[r] = tile values, the penalty for tiles <= 64, the
+#                 edge bonus and middle penalty of row r, the
+#                 empty tile reward of row r and the neighbour
+#                 terms between tiles of the row
+# PAIR_SCORE    = the neighbour terms of a line on its own, used
+#                 for the columns of the transposed board
+# ROW_SUM       = sum of the tiles, used for the parent board's
+#                 moved tile penalty
+##########################################################
+EVAL_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eval_tables.bin")
+# bump this when the heuristic changes so old cache files are rebuilt
+EVAL_VERSION = 1
+_EVAL_MAGIC = b"2048EVAL"
+
+##########################################################
+# neighbour term of tile next to other, the same checks as
+# Game2048.heuristic
+##########################################################
+def _neighbour(tile, other):
+	if tile == 2*other or 2*tile == other:
+		return tile
+	elif tile > 8*other or 4*tile > other:
+		return -0.2*abs(other - tile)
+	return 0
+
+def build_tables():
+	row_scores = [array("d", bytes(8*65536)) for _ in range(4)]
+	pair_score = array("d", bytes(8*65536))
+	row_sum = array("I", bytes(4*65536))
+
+	for row in range(65536):
+		values = []
+		for c in range(4):
+			exp = (row >> (4*c)) & CELL_MASK
+			values.append(0 if exp == 0 else 1 << exp)
+
+		pairs = 0
+		for c in range(3):
+			pairs += _neighbour(values[c], values[c+1]) + _neighbour(values[c+1], values[c])
+		pair_score[row] = pairs
+		row_sum[row] = sum(values)
+
+		zeros = values.count(0)
+		for r in range(4):
+			score = 0
+			for c in range(4):
+				value = values[c]
+				score += value
+				if value <= 64:
+					score -= 8*value
+				# one bonus for being on any side
+				if r == 0 or r == 3 or c == 0 or c == 3:
+					score += value
+				# one penalty per middle row or column
+				score -= ((r == 1 or r == 2) + (c == 1 or c == 2))*value
+			# evaluate adds the empty tiles counted so far after every row,
+			# so empty tiles of row r are counted 4-r times
+			score += 2000*(4-r)*zeros
+			row_scores[r][row] = score + pairs
+
+	return (*row_scores, pair_score, row_sum)
+
+def load_tables(path=EVAL_CACHE):
+	return bitboard.load_cached_tables(path, _EVAL_MAGIC, EVAL_VERSION, "dddddI", build_tables)
+
+(ROW_SCORE_0, ROW_SCORE_1, ROW_SCORE_2, ROW_SCORE_3, PAIR_SCORE, ROW_SUM), TABLE_STATS = load_tables()
+
+##########################################################
+# follows one chain over the cells of path, returns the chain sum
+# and the tile the chain stopped on
+##########################################################
+def _walk_chain(board, total, cur, path, above_four):
+	for cell in path:
+		exp = (board >> (4*cell)) & CELL_MASK
+		value = 0 if exp == 0 else 1 << exp
+		if value < cur and (value > 4 or not above_four):
+			total += value
+			cur = value
+		else:
+			return total, value
+	return total, 0
+
+##########################################################
+# exponents of the corner tiles and the index in CHAINS of the
+# corner the chain starts from
+##########################################################
+def _chain_corner(board):
+	corners = [board & CELL_MASK, (board >> 12) & CELL_MASK, (board >> 48) & CELL_MASK, board >> 60]
+	# the first largest corner, like max in chain_length
+	return corners, corners.index(max(corners))
+
+##########################################################
+# Game2048.chain_length on a bitboard
+##########################################################
+def chain_length(board):
+	corners, index = _chain_corner(board)
+	return _chain_from(board, corners, index)
+
+def _chain_from(board, corners, index):
+	corner, path1, path2, above_four = CHAINS[index]
+
+	start = 0 if corners[index] == 0 else 1 << corners[index]
+	chain1, stop = _walk_chain(board, start, start, path1, above_four)
+	if corner == 15:
+		# the bottom right chain2 starts from the tile chain1 stopped on
+		chain2, _ = _walk_chain(board, stop, start, path2, above_four)
+	else:
+		chain2, _ = _walk_chain(board, start, start, path2, above_four)
+	return max(chain1, chain2)
+
+##########################################################
+# Game2048.evaluate on bitboards using the tables. Scores match
+# evaluate up to float rounding of the 0.2 neighbour terms.
+##########################################################
+def evaluate(parent_board, board, score):
+	if bitboard.is_terminal(board):
+		return TERMINAL_SCORE+score
+	return heuristic(parent_board, board, score)
+
+##########################################################
+# Game2048.heuristic on bitboards, evaluate without the terminal
+# check
+##########################################################
+def heuristic(parent_board, board, score):
+	t = bitboard.transpose(board)
+	res = score*5 + 200*chain_length(board) \
+		+ ROW_SCORE_0[board & ROW_MASK] + ROW_SCORE_1[(board >> 16) & ROW_MASK] \
+		+ ROW_SCORE_2[(board >> 32) & ROW_MASK] + ROW_SCORE_3[board >> 48] \
+		+ PAIR_SCORE[t & ROW_MASK] + PAIR_SCORE[(t >> 16) & ROW_MASK] \
+		+ PAIR_SCORE[(t >> 32) & ROW_MASK] + PAIR_SCORE[t >> 48]
+	return res - 12*moved_penalty(parent_board)
+
+##########################################################
+# Spawn deltas
+#
+# The leaves of an even depth expectimax are the spawns of a
+# chance node's board, and differ from it by one tile. A spawn
+# only changes one row and one column, so line_scores keeps the
+# eight row and column terms of the chance node's board (with its
+# transpose, chain and tile sum) and spawn_heuristic looks up the
+# spawned tile's row and column again.
+#
+# The chain stays the same unless the spawn is on a cell a chain
+# walk looked at, or on a corner, which can change the starting
+# corner. The walks of the other corners stop on the first tile
+# <= 4, and stop on an empty cell the same as on a new 2 or 4, so
+# only the cells of the bottom right walks are kept (chain_cells).
+#
+# The terms are added in the order of heuristic so the values are
+# the same to the last bit.
+##########################################################
+ROW_SCORES = (ROW_SCORE_0, ROW_SCORE_1, ROW_SCORE_2, ROW_SCORE_3)
+# bits of the cells that can change the starting corner of the chain
+CORNER_CELLS = 1 | 1 << 3 | 1 << 12 | 1 << 15
+
+##########################################################
+# bits of the cells a walk from a tile of value cur looks at along
+# path, up to the one it stops on
+##########################################################
+def _walked_cells(board, cur, path):
+	cells = 0
+	for cell in path:
+		cells |= 1 << cell
+		exp = (board >> (4*cell)) & CELL_MASK
+		value = 0 if exp == 0 else 1 << exp
+		if value < cur:
+			cur = value
+		else:
+			break
+	return cells
+
+##########################################################
+# the row and column terms, transpose, chain and tile sum of board
+# for spawn_heuristic, with the bits of the cells a spawn on which
+# changes the chain
+##########################################################
+def line_scores(board):
+	t = bitboard.transpose(board)
+	rows = [ROW_SCORE_0[board & ROW_MASK], ROW_SCORE_1[(board >> 16) & ROW_MASK],
+		ROW_SCORE_2[(board >> 32) & ROW_MASK], ROW_SCORE_3[board >> 48]]
+	cols = [PAIR_SCORE[t & ROW_MASK], PAIR_SCORE[(t >> 16) & ROW_MASK],
+		PAIR_SCORE[(t >> 32) & ROW_MASK], PAIR_SCORE[t >> 48]]
+	corners, index = _chain_corner(board)
+	chain_cells = CORNER_CELLS
+	_, path1, path2, above_four = CHAINS[index]
+	if not above_four:
+		start = 0 if corners[index] == 0 else 1 << corners[index]
+		chain_cells |= _walked_cells(board, start, path1) | _walked_cells(board, start, path2)
+	return rows, cols, t, _chain_from(board, corners, index), chain_cells, moved_penalty(board)
+
+##########################################################
+# heuristic(parent_board, board, score) for board = parent_board
+# with a tile spawned on the empty cell, lines = line_scores of
+# parent_board
+##########################################################
+def spawn_heuristic(lines, board, cell, score):
+	rows, cols, t, chain, chain_cells, moved = lines
+	r = cell >> 2
+	c = cell & 3
+	rows = rows.copy()
+	rows[r] = ROW_SCORES[r][(board >> 16*r) & ROW_MASK]
+	cols = cols.copy()
+	cols[c] = PAIR_SCORE[((t >> 16*c) & ROW_MASK) | ((board >> 4*cell) & CELL_MASK) << 4*r]
+	if chain_cells >> cell & 1:
+		chain = chain_length(board)
+	res = score*5 + 200*chain \
+		+ rows[0] + rows[1] + rows[2] + rows[3] \
+		+ cols[0] + cols[1] + cols[2] + cols[3]
+	return res - 12*moved
+
+##########################################################
+# sum of the parent board's tiles, evaluate subtracts 12 times
+# this for the tiles that moved
+##########################################################
+def moved_penalty(parent_board):
+	return ROW_SUM[parent_board & ROW_MASK] + ROW_SUM[(parent_board >> 16) & ROW_MASK] \
+		+ ROW_SUM[(parent_board >> 32) & ROW_MASK] + ROW_SUM[parent_board >> 48]
+
+##########################################################
+# report how the evaluation tables were loaded
+##########################################################
+if __name__ == "__main__":
+	print(f"evaluation tables {TABLE_STATS['source']} in {TABLE_STATS['seconds']*1000:.1f} ms")
+	print(f"evaluation tables use {TABLE_STATS['bytes']/1024:.0f} KiB")
+	print(f"cache file: {EVAL_CACHE}")
@@ -0,0 +1,297 @@
+# Noah Nisbet
+# Monte Carlo Tree Search
+# UCT search over bitboards with nodes kept in a fixed size pool of
+# arrays, so a tree costs a few dozen bytes per node and its useful
+# part survives from one move to the next.
+
+import math
+import time
+from array import array
+from random import randint, random
+
+import bitboard
+
+# no node, used for empty links
+NONE = -1
+
+DECISION_NODE = 0
+CHANCE_NODE = 1
+
+##########################################################
+# MCTS
+#
+# The tree alternates two kinds of node:
+# decision nodes = a board with a tile just spawned, the player
+#                  moves next. Their children are the chance
+#                  nodes of every legal move, like
+#                  get_child_boards(1, board).
+# chance nodes   = the board right after a move. Their children
+#                  are decision nodes for the spawns that have
+#                  been sampled so far, a two with a 90% chance and
+#                  a four with a 10% chance on a random empty cell.
+#
+# Every iteration walks down from the root, picking moves with
+# UCB1 and sampling spawns, until it reaches a new node. That node
+# is scored with a random playout and the playout score plus the
+# scores of the moves on the way is added to every node of the
+# path. Values are scaled by the root's average so one exploration
+# constant fits the whole game.
+#
+# Nodes live in parallel arrays of capacity entries. A node is an
+# index, children are a linked list (first_child, next_sibling).
+# When the pool is full the search keeps running but stops adding
+# nodes. Nodes that are no longer reachable after a move go back
+# to a free list.
+##########################################################
+class MCTS:
+	def __init__(self, capacity=1 << 20, exploration=1.0, playout_steps=None):
+		self.capacity = capacity
+		self.exploration = exploration
+		# random moves per playout, None plays to the end of the game
+		self.playout_steps = playout_steps
+
+		self.board = array("Q", bytes(8*capacity))
+		self.kind = array("b", bytes(capacity))
+		self.visits = array("I", bytes(4*capacity))
+		self.total = array("d", bytes(8*capacity))
+		self.first_child = array("i", [NONE])*capacity
+		self.next_sibling = array("i", [NONE])*capacity
+		# move (1-4) of a chance node, 16*cell+exponent of the spawn
+		# of a decision node
+		self.edge = array("H", bytes(2*capacity))
+		# score gained by the move of a chance node
+		self.reward = array("I", bytes(4*capacity))
+
+		# iterations run by the last search
+		self.iterations = 0
+		self.clear()
+
+	def clear(self):
+		self.root = NONE
+		self.used = 0
+		self.free = []
+		self.reused = 0
+
+	def __len__(self):
+		return self.used - len(self.free)
+
+	##########################################################
+	# takes a node from the pool, NONE when the pool is full
+	##########################################################
+	def _new_node(self, kind, board, edge=0, reward=0):
+		if self.free:
+			node = self.free.pop()
+		elif self.used < self.capacity:
+			node = self.used
+			self.used+=1
+		else:
+			return NONE
+		self.board[node] = board
+		self.kind[node] = kind
+		self.visits[node] = 0
+		self.total[node] = 0.0
+		self.first_child[node] = NONE
+		self.next_sibling[node] = NONE
+		self.edge[node] = edge
+		self.reward[node] = reward
+		return node
+
+	##########################################################
+	# returns a node and everything below it to the free list,
+	# except the subtree of keep
+	##########################################################
+	def _free_subtree(self, node, keep=NONE):
+		stack = [node]
+		while stack:
+			node = stack.pop()
+			if node == keep:
+				continue
+			child = self.first_child[node]
+			while child != NONE:
+				stack.append(child)
+				child = self.next_sibling[child]
+			self.free.append(node)
+
+	##########################################################
+	# makes board the root. If board is a grandchild of the old
+	# root (the move that was played followed by the spawn that
+	# happened) its subtree is kept and the rest is freed.
+	##########################################################
+	def set_root(self, board):
+		if self.root != NONE and self.board[self.root] == board:
+			return
+		new_root = NONE
+		if self.root != NONE:
+			chance = self.first_child[self.root]
+			while chance != NONE and new_root == NONE:
+				child = self.first_child[chance]
+				while child != NONE:
+					if self.board[child] == board:
+						new_root = child
+						break
+					child = self.next_sibling[child]
+				chance = self.next_sibling[chance]
+			self._free_subtree(self.root, new_root)
+
+		if new_root == NONE:
+			if self.root == NONE or len(self) == 0:
+				self.clear()
+			new_root = self._new_node(DECISION_NODE, board)
+		else:
+			self.reused += self.visits[new_root]
+			self.next_sibling[new_root] = NONE
+		self.root = new_root
+
+	##########################################################
+	# adds a chance node for every legal move of a decision node,
+	# returns False if the pool has no room for them
+	##########################################################
+	def _expand(self, node, board, moves):
+		if self.capacity - self.used + len(self.free) < len(moves):
+			return False
+		prev = NONE
+		for move in moves:
+			child_board, reward = bitboard.move(board, move)
+			child = self._new_node(CHANCE_NODE, child_board, move, reward)
+			if prev == NONE:
+				self.first_child[node] = child
+			else:
+				self.next_sibling[prev] = child
+			prev = child
+		return True
+
+	##########################################################
+	# UCB1 over the moves of a decision node, an unvisited move is
+	# always tried first
+	##########################################################
+	def _select(self, node):
+		visits = self.visits
+		total = self.total
+		reward = self.reward
+		root = self.root
+		# scale values to about 1 with the average score from the root
+		scale = max(1.0, total[root] / visits[root]) if visits[root] > 0 else 1.0
+		log_visits = math.log(visits[node]) if visits[node] > 0 else 0.0
+
+		best = NONE
+		best_score = -math.inf
+		child = self.first_child[node]
+		while child != NONE:
+			n = visits[child]
+			if n == 0:
+				return child
+			score = (reward[child] + total[child]/n)/scale + self.exploration*math.sqrt(log_visits/n)
+			if score > best_score:
+				best_score = score
+				best = child
+			child = self.next_sibling[child]
+		return best
+
+	##########################################################
+	# score of random moves from board until the game ends or
+	# playout_steps moves have been played
+	##########################################################
+	def playout(self, board):
+		score = 0
+		steps = 0
+		while self.playout_steps is None or steps < self.playout_steps:
+			moves = bitboard.legal_moves(board)
+			if len(moves) == 0:
+				break
+			board, reward = bitboard.move(board, moves[randint(0, len(moves)-1)])
+			score += reward
+			board = bitboard.spawn(board)
+			steps+=1
+		return score
+
+	##########################################################
+	# one selection, expansion, playout and backup
+	##########################################################
+	def iterate(self):
+		node = self.root
+		board = self.board[node]
+		path = [node]
+		while True:
+			if self.kind[node] == DECISION_NODE:
+				if self.first_child[node] == NONE:
+					moves = bitboard.legal_moves(board)
+					if len(moves) == 0:
+						value = 0
+						break
+					# a new node is scored by a playout before it is expanded
+					if node != self.root and self.visits[node] == 0:
+						value = self.playout(board)
+						break
+					if not self._expand(node, board, moves):
+						value = self.playout(board)
+						break
+				node = self._select(node)
+			else:
+				# sample a spawn with its true probability
+				cells = bitboard.empty_cells(board)
+				cell = cells[randint(0, len(cells)-1)]
+				exp = 2 if random() < 0.1 else 1
+				edge = 16*cell + exp
+				child = self.first_child[node]
+				while child != NONE and self.edge[child] != edge:
+					child = self.next_sibling[child]
+				if child == NONE:
+					child_board = bitboard.set_cell(board, cell, exp)
+					child = self._new_node(DECISION_NODE, child_board, edge)
+					if child == NONE:
+						# the pool is full, score the spawn without a node
+						value = self.playout(child_board)
+						break
+					self.next_sibling[child] = self.first_child[node]
+					self.first_child[node] = child
+				node = child
+			path.append(node)
+			board = self.board[node]
+
+		# a decision node is worth its move's score plus the chance node's value
+		visits = self.visits
+		total = self.total
+		for node in reversed(path):
+			visits[node]+=1
+			total[node] += value
+			if self.kind[node] == CHANCE_NODE:
+				value += self.reward[node]
+
+	##########################################################
+	# searches board for the given number of iterations or until
+	# the deadline (a time.perf_counter() value) and returns the
+	# most visited move, None if no move is legal
+	##########################################################
+	def search(self, board, iterations=None, deadline=None):
+		self.set_root(board)
+		if iterations is None and deadline is None:
+			iterations = 1000
+
+		done = 0
+		while iterations is None or done < iterations:
+			# the clock is only read every 16 iterations
+			if deadline is not None and done % 16 == 0 and time.perf_counter() > deadline:
+				break
+			self.iterate()
+			done+=1
+		self.iterations = done
+		return self.best_move()
+
+	def best_move(self):
+		best_move = None
+		best_visits = -1
+		child = self.first_child[self.root]
+		while child != NONE:
+			if self.visits[child] > best_visits:
+				best_visits = self.visits[child]
+				best_move = self.edge[child]
+			child = self.next_sibling[child]
+		return best_move
+
+	def stats(self):
+		return {
+			"nodes": len(self),
+			"capacity": self.capacity,
+			"root_visits": self.visits[self.root] if self.root != NONE else 0,
+			"reused_visits": self.reused,
+		}
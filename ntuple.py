@@ -0,0 +1,290 @@
+# Noah Nisbet
+# N-tuple network evaluator
+# Scores a bitboard with weight tables indexed by the tile exponents
+# of fixed groups of cells, an alternative to the hand tuned
+# Game2048.evaluate.
+#
+# example:
+#   python3 ntuple.py weights.bin
+
+import mmap
+import struct
+import sys
+from array import array
+
+import numpy as np
+
+import bitboard
+
+# score given to terminal boards, the same constant as Game2048.evaluate
+TERMINAL_SCORE = -99999999999999999
+
+##########################################################
+# Patterns
+#
+# A pattern is a tuple of cells (0-15, the same indexing as
+# Game2048.board). Its table has 16**len(pattern) weights, one for
+# every combination of tile exponents on those cells. Every
+# pattern is also applied to the seven other rotations and
+# reflections of the board, sharing the same table.
+#
+# DEFAULT_PATTERNS are the two 6 cell rectangles and the two 6 cell
+# corner shapes, 4 tables of 16**6 weights. SMALL_PATTERNS are
+# rows and squares of 4 cells, weaker but 5 tables of only 16**4
+# weights, quick to train and test with.
+##########################################################
+DEFAULT_PATTERNS = (
+	(0, 1, 2, 3, 4, 5),
+	(4, 5, 6, 7, 8, 9),
+	(0, 1, 2, 4, 5, 6),
+	(4, 5, 6, 8, 9, 10),
+)
+
+SMALL_PATTERNS = (
+	(0, 1, 2, 3),
+	(4, 5, 6, 7),
+	(0, 1, 4, 5),
+	(1, 2, 5, 6),
+	(5, 6, 9, 10),
+)
+
+##########################################################
+# Weight file
+#
+# A little endian header followed by the weights of every table,
+# one after another:
+#   magic      8 bytes
+#   version    1 byte
+#   typecode   1 byte, "f" for float32 or "h" for int16
+#   scale      float64, a weight is worth weight*scale points
+#   patterns   uint32 count, then per pattern a uint8 length and
+#              its cells
+# The weights start at the next multiple of WEIGHT_ALIGN bytes so
+# they can be read straight out of a memory map.
+##########################################################
+WEIGHT_VERSION = 1
+_WEIGHT_MAGIC = b"2048NTUP"
+_HEADER = struct.Struct("<8sBcdI")
+WEIGHT_ALIGN = 64
+TYPECODES = ("f", "h")
+
+##########################################################
+# splits a pattern into runs of cells that are next to each other
+# on the board, every run is read from the board with one shift
+# and mask. Returns (board shift, mask, index shift) per run.
+##########################################################
+def _pattern_runs(pattern):
+	runs = []
+	start = 0
+	for k in range(1, len(pattern)+1):
+		if k == len(pattern) or pattern[k] != pattern[k-1]+1:
+			length = k - start
+			runs.append((4*pattern[start], (1 << (4*length))-1, 4*start))
+			start = k
+	return tuple(runs)
+
+##########################################################
+# number of weights in the tables of patterns
+##########################################################
+def table_size(patterns):
+	return sum(16**len(pattern) for pattern in patterns)
+
+def _check_patterns(patterns):
+	for pattern in patterns:
+		if len(pattern) == 0 or len(set(pattern)) != len(pattern) or not all(0 <= cell < 16 for cell in pattern):
+			raise ValueError(f"invalid pattern {pattern}, cells must be distinct and between 0 and 15")
+
+##########################################################
+# N-tuple network
+#
+# weights is one flat buffer holding the tables of every pattern
+# (an array, a memoryview of a memory map or a NumPy array) and
+# scale converts a summed weight to points. The value of a board
+# estimates the score still to be gained from it.
+##########################################################
+class NTupleNetwork:
+	def __init__(self, patterns=DEFAULT_PATTERNS, weights=None, scale=1.0):
+		_check_patterns(patterns)
+		self.patterns = tuple(tuple(pattern) for pattern in patterns)
+		self.scale = scale
+
+		# start of each pattern's table in weights
+		self.offsets = []
+		size = 0
+		for pattern in self.patterns:
+			self.offsets.append(size)
+			size += 16**len(pattern)
+		self.size = size
+
+		if weights is None:
+			weights = array("f", bytes(4*size))
+		if len(weights) != size:
+			raise ValueError(f"expected {size} weights for the patterns, got {len(weights)}")
+		self.weights = weights
+
+		self.tables = list(zip(self.offsets, [_pattern_runs(pattern) for pattern in self.patterns]))
+		# the memory map backing weights when loaded with load()
+		self._mmap = None
+
+	##########################################################
+	# index of every table entry used by a board, one per pattern
+	# and symmetry, already offset into weights
+	##########################################################
+	def indices(self, board):
+		res = []
+		for sym in bitboard.symmetries(board):
+			for offset, runs in self.tables:
+				index = 0
+				for shift, mask, index_shift in runs:
+					index |= ((sym >> shift) & mask) << index_shift
+				res.append(offset+index)
+		return res
+
+	##########################################################
+	# sum of the weights a board uses, in points
+	##########################################################
+	def value(self, board):
+		weights = self.weights
+		total = 0
+		for sym in bitboard.symmetries(board):
+			for offset, runs in self.tables:
+				index = 0
+				for shift, mask, index_shift in runs:
+					index |= ((sym >> shift) & mask) << index_shift
+				total += weights[offset+index]
+		return total*self.scale
+
+	##########################################################
+	# moves the value of board towards target, spreading the step
+	# over every weight the board uses. Returns the error before
+	# the step. Needs writable weights.
+	##########################################################
+	def learn(self, board, target, learning_rate):
+		weights = self.weights
+		indices = self.indices(board)
+		error = target - sum(weights[i] for i in indices)*self.scale
+		step = learning_rate*error/(len(indices)*self.scale)
+		for i in indices:
+			weights[i] += step
+		return error
+
+	##########################################################
+	# a value evaluate never exceeds, for Game2048.leaf_upper_bound:
+	# the largest weight of every table counted once per symmetry,
+	# plus the most a single move can score (eight merges into the
+	# largest tile)
+	##########################################################
+	def upper_bound(self):
+		weights = np.asarray(self.weights)
+		largest = 0.0
+		for offset, pattern in zip(self.offsets, self.patterns):
+			largest += float(weights[offset:offset+16**len(pattern)].max())
+		return 8*largest*self.scale + 8*(1 << 16)
+
+	##########################################################
+	# drop in replacement for Game2048.evaluate. Boards may be
+	# bitboards or 16 element lists, score is the score gained by
+	# the move that made board.
+	##########################################################
+	def evaluate(self, parent_board, board, score):
+		if not isinstance(board, int):
+			board = bitboard.to_bitboard(board)
+		if bitboard.is_terminal(board):
+			return TERMINAL_SCORE+score
+		return score + self.value(board)
+
+	##########################################################
+	# writes the network to path. typecode "h" stores int16
+	# weights scaled to fill the int16 range, half the size of
+	# float32 at a small loss of precision.
+	##########################################################
+	def save(self, path, typecode="f"):
+		if typecode not in TYPECODES:
+			raise ValueError(f"typecode must be one of {TYPECODES}, got {typecode!r}")
+
+		weights = np.asarray(self.weights, dtype=np.float32)
+		if typecode == "f":
+			scale = self.scale
+		else:
+			largest = float(np.abs(weights).max()) if len(weights) else 0.0
+			step = largest/32767 if largest > 0 else 1.0
+			scale = self.scale*step
+			weights = np.round(weights/step).astype(np.int16)
+
+		header = _HEADER.pack(_WEIGHT_MAGIC, WEIGHT_VERSION, typecode.encode(), scale, len(self.patterns))
+		for pattern in self.patterns:
+			header += bytes([len(pattern), *pattern])
+		header += bytes(-len(header) % WEIGHT_ALIGN)
+
+		with open(path, "wb") as f:
+			f.write(header)
+			weights.astype(weights.dtype.newbyteorder("<")).tofile(f)
+
+	def close(self):
+		if self._mmap is not None:
+			# the memory map can only close once no view of it is left
+			self.weights.release()
+			self.weights = None
+			self._mmap.close()
+			self._mmap = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+##########################################################
+# loads a weight file written by NTupleNetwork.save
+#
+# The weights are not copied: they are read through a read only
+# memory map, so every process that loads the same file (the
+# ParallelSearch and simulate.py workers) shares one copy of them
+# in the page cache.
+##########################################################
+def load(path):
+	with open(path, "rb") as f:
+		mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	weights = None
+	try:
+		magic, version, typecode, scale, count = _HEADER.unpack_from(mm, 0)
+		if magic != _WEIGHT_MAGIC or version != WEIGHT_VERSION:
+			raise ValueError(f"{path} is not a version {WEIGHT_VERSION} n-tuple weight file")
+		typecode = typecode.decode()
+		if typecode not in TYPECODES:
+			raise ValueError(f"{path} has unknown weight type {typecode!r}")
+
+		pos = _HEADER.size
+		patterns = []
+		for _ in range(count):
+			length = mm[pos]
+			patterns.append(tuple(mm[pos+1:pos+1+length]))
+			pos += 1+length
+		pos += -pos % WEIGHT_ALIGN
+
+		weights = memoryview(mm)[pos:].cast(typecode)
+		network = NTupleNetwork(patterns, weights, scale)
+	except Exception:
+		# the traceback still holds the view, so release it by hand
+		# before closing the map
+		if weights is not None:
+			weights.release()
+		mm.close()
+		raise
+	network._mmap = mm
+	return network
+
+##########################################################
+# describe a weight file
+##########################################################
+if __name__ == "__main__":
+	if len(sys.argv) != 2:
+		print("usage: python3 ntuple.py WEIGHTS")
+		sys.exit(2)
+	with load(sys.argv[1]) as network:
+		print(f"patterns: {len(network.patterns)}")
+		for pattern in network.patterns:
+			print(f"\t{pattern}")
+		print(f"weights: {network.size} {network.weights.format} ({network.weights.nbytes/1024/1024:.1f} MiB)")
+		print(f"scale: {network.scale:g}")
@@ -0,0 +1,205 @@
+# Noah Nisbet
+# Parallel move search
+# Splits expectimax and alphabeta searches into subtrees that are
+# searched by a pool of persistent worker processes.
+
+import math
+import os
+import time
+from multiprocessing import Pool, RawValue
+
+import ntuple
+from transposition import TranspositionTable, LeafCache
+
+# the game each worker process searches with, made once by _init_worker
+_worker_game = None
+# set by ParallelSearch to stop the tasks of a cancelled search
+_cancelled = None
+
+# seconds between checks of the search deadline while the workers run
+POLL_INTERVAL = 0.005
+
+##########################################################
+# runs once in every worker. Builds the worker's game and searches
+# a small board so the first real request does not pay for
+# imports, table loading or first call overhead. The n-tuple
+# weights at evaluator_path are memory mapped, so all workers
+# share one copy. cancelled is the flag ParallelSearch sets to stop
+# a search (see _Deadline). With leaf_cache every worker keeps the
+# leaf values of the last two moves it searched (see
+# Game2048.leaf_value).
+##########################################################
+def _init_worker(game_class, cancelled, tt_bytes, evaluator_path=None, leaf_cache=False):
+	global _worker_game, _cancelled
+	_cancelled = cancelled
+	_worker_game = game_class()
+	if evaluator_path is not None:
+		_worker_game.evaluator = ntuple.load(evaluator_path)
+		_worker_game.symmetric_keys = True
+	if tt_bytes > 0:
+		# worker tables are never cleared, their keys include everything
+		# a value depends on so entries stay valid between moves
+		_worker_game.tt = TranspositionTable(max_bytes=tt_bytes, persist=True)
+	if leaf_cache:
+		_worker_game.leaf_cache = LeafCache()
+	_worker_game.expectimax(2)
+
+def _ready(_):
+	return os.getpid()
+
+##########################################################
+# Worker deadline
+#
+# time.perf_counter() > deadline is True once time_left seconds
+# have passed or the search was cancelled, so a cancelled search
+# raises SearchTimeout at the next node of every worker, like a
+# CancelToken does in a sequential search.
+##########################################################
+class _Deadline:
+	def __init__(self, time_left):
+		self.at = math.inf if time_left is None else time.perf_counter() + time_left
+
+	# time.perf_counter() > deadline
+	def __lt__(self, now):
+		return _cancelled.value or now > self.at
+
+	def __gt__(self, now):
+		return not _cancelled.value and now < self.at
+
+	def __sub__(self, now):
+		return 0.0 if _cancelled.value else self.at - now
+
+##########################################################
+# worker tasks, boards arrive in the engine's own representation
+# (a single int for the bitboard engine). time_left is converted
+# to a deadline in the worker because clocks of different
+# processes are not compared. root is the key of the searched
+# move's root, the tasks of one move share a leaf cache generation.
+##########################################################
+def _expectimax_task(task):
+	root, parent_board, board, depth_limit, score2, prob, prob_cutoff, star1, time_left = task
+	_worker_game.prob_cutoff = prob_cutoff
+	_worker_game.star1 = star1
+	if _worker_game.leaf_cache is not None:
+		_worker_game.leaf_cache.new_search(root)
+	_, value = _worker_game.expectimax_value(parent_board, board, depth_limit, score2, prob, _Deadline(time_left))
+	return value
+
+def _alphabeta_task(task):
+	board, depth_limit, move, time_left = task
+	_, value = _worker_game.alphabeta_value(board, board, depth_limit, deadline=_Deadline(time_left), moves=(move,))
+	return value
+
+##########################################################
+# Parallel search
+#
+# Keeps a pool of worker processes alive between moves. Each worker
+# builds its own game_class instance once, so a move only sends the
+# boards it needs searched.
+#
+# expectimax is split below the chance nodes: every (move, spawn)
+# pair is a task and the chance node averages are taken here, so
+# even the four root moves keep many workers busy. alphabeta is
+# split at the root, every legal move is searched with a full
+# window by one worker.
+#
+# evaluator_path, if given, is an n-tuple weight file the workers
+# score leaves with, it should match game.evaluator. tt_bytes and
+# leaf_cache give every worker a persistent transposition table and
+# a leaf cache, the game's own are only used by searches too
+# shallow to split.
+##########################################################
+class ParallelSearch:
+	def __init__(self, game_class, workers=None, tt_bytes=0, evaluator_path=None, leaf_cache=False):
+		self.workers = workers or os.cpu_count()
+		self.cancelled = RawValue("b", 0)
+		self.pool = Pool(processes=self.workers, initializer=_init_worker,
+			initargs=(game_class, self.cancelled, tt_bytes, evaluator_path, leaf_cache))
+		# wait for every worker to finish warming up
+		self.pool.map(_ready, range(self.workers), chunksize=1)
+
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	##########################################################
+	# pool.map that keeps checking deadline (a float or a
+	# CancelToken) while the workers search. Once it passes, the
+	# workers' tasks are stopped through the cancelled flag and the
+	# SearchTimeout they raise is raised here, so a cancelled search
+	# does not keep the pool busy.
+	##########################################################
+	def _map(self, task, tasks, deadline):
+		result = self.pool.map_async(task, tasks, chunksize=1)
+		if deadline is not None:
+			while not result.ready():
+				result.wait(POLL_INTERVAL)
+				if not result.ready() and time.perf_counter() > deadline:
+					self.cancelled.value = 1
+					result.wait()
+					self.cancelled.value = 0
+		return result.get()
+
+	##########################################################
+	# same result as game.expectimax(depth_limit, deadline)
+	##########################################################
+	def expectimax(self, game, depth_limit, deadline=None):
+		root = game.get_search_board()
+		# shallow searches are cheaper than sending them to the workers
+		if depth_limit < 3 or game.terminal(root):
+			return game.expectimax_value(root, root, depth_limit, deadline=deadline)[0]
+
+		time_left = None if deadline is None else deadline - time.perf_counter()
+		root_key = game.symmetry_key(root)[0]
+		tasks = []
+		moves = []
+		for move, child_board, score2 in game.get_child_boards(1, root):
+			if game.terminal(child_board):
+				moves.append((move, game.evaluate(root, child_board, score2), []))
+				continue
+			weights = []
+			for weight, spawn_board in game.get_chance_boards(child_board):
+				tasks.append((root_key, child_board, spawn_board, depth_limit-2, score2, weight, game.prob_cutoff, game.star1, time_left))
+				weights.append(weight)
+			moves.append((move, None, weights))
+
+		values = iter(self._map(_expectimax_task, tasks, deadline))
+
+		best_score = -math.inf
+		best_move = None
+		for move, score, weights in moves:
+			if score is None:
+				score = 0
+				for weight in weights:
+					score += weight*next(values)
+			if score > best_score:
+				best_score = score
+				best_move = move
+		return best_move
+
+	##########################################################
+	# same result as game.alphabeta(depth_limit, deadline) apart from
+	# values pruned at the root by the sequential search
+	##########################################################
+	def alphabeta(self, game, depth_limit, deadline=None):
+		root = game.get_search_board()
+		if depth_limit < 3 or game.terminal(root):
+			return game.alphabeta_value(root, root, depth_limit, deadline=deadline)[0]
+
+		time_left = None if deadline is None else deadline - time.perf_counter()
+		moves = [move for move, _, _ in game.get_child_boards(1, root)]
+		values = self._map(_alphabeta_task, [(root, depth_limit, move, time_left) for move in moves], deadline)
+
+		best_score = -math.inf
+		best_move = None
+		for move, score in zip(moves, values):
+			if score > best_score:
+				best_score = score
+				best_move = move
+		return best_move
@@ -0,0 +1,331 @@
+# Noah Nisbet
+# Game replay log
+# Records games in a compact binary stream (the seed, the moves,
+# the tiles that spawned and the time each move took to find) and
+# rebuilds any position of a recorded game without searching again.
+#
+# example:
+#   python3 replay.py games.bin
+#   python3 replay.py games.bin --game 3 --move 120
+#   python3 replay.py games.bin --corpus failing.json --last 10
+
+import argparse
+import importlib
+import json
+import os
+import struct
+import sys
+
+import bitboard
+
+##########################################################
+# Log format
+#
+# A log starts with an 8 byte magic and a version byte, then holds
+# games one after another. A game is
+#   "G"        1 byte
+#   seed       uint64, little endian
+#   board      uint64, the starting board as a bitboard
+# followed by one entry per move and an END byte. An entry is a
+# byte
+#   bits 0-1   move-1 (moves are 1-4, left up right down)
+#   bit 2      set if no tile spawned (the move changed nothing)
+#   bit 3      set if the tile that spawned was a four
+#   bits 4-7   cell the tile spawned on (0-15)
+# and the search time of the move in microseconds as an unsigned
+# LEB128 varint, so a move takes 2 to 4 bytes. END is an entry with
+# bits 2 and 3 set, which no move can have. A log cut off in the
+# middle of a game (a crash) is read up to its last whole move.
+# Before more games are appended to it, open_log cuts such a log
+# back to that move and closes the game with CUT, an END with bit 4
+# set, so the next game's "G" is not read as a move.
+##########################################################
+LOG_VERSION = 1
+_LOG_MAGIC = b"2048RPLY"
+_GAME = b"G"
+_GAME_HEADER = struct.Struct("<QQ")
+
+NO_SPAWN = 0x04
+SPAWN_FOUR = 0x08
+END = NO_SPAWN | SPAWN_FOUR
+CUT = END | 0x10
+
+##########################################################
+# opens a log file to append games to, writing the file header if
+# the file is new. A last game left without an END (the process
+# writing it was killed) is cut back to its last whole move and
+# closed with CUT.
+##########################################################
+def open_log(path):
+	f = open(path, "a+b")
+	f.seek(0)
+	data = f.read()
+	if not data:
+		f.write(_LOG_MAGIC + bytes([LOG_VERSION]))
+		f.flush()
+		return f
+
+	_, end, in_game = _parse_log(data)
+	if end < len(data) or in_game:
+		f.truncate(end)
+		if in_game:
+			f.write(bytes([CUT]))
+		f.flush()
+	return f
+
+def _varint(value):
+	res = bytearray()
+	while True:
+		byte = value & 0x7F
+		value >>= 7
+		if value:
+			res.append(byte | 0x80)
+		else:
+			res.append(byte)
+			return bytes(res)
+
+##########################################################
+# Game recorder
+#
+# Writes the games of a Game2048 to a binary file object (from
+# open_log, or an io.BytesIO whose bytes are appended to a log
+# later). Set a game's recorder and Game2048.play records every
+# move. Each move is flushed so the log can be followed while
+# games are played.
+##########################################################
+class GameRecorder:
+	def __init__(self, file):
+		self.file = file
+		self.in_game = False
+
+	def start_game(self, seed, board):
+		if self.in_game:
+			self.end_game()
+		if isinstance(board, list):
+			board = bitboard.to_bitboard(board)
+		self.file.write(_GAME + _GAME_HEADER.pack(seed & 0xFFFFFFFFFFFFFFFF, board))
+		self.in_game = True
+
+	##########################################################
+	# spawn is (cell, tile value) or None, search_time is in seconds
+	##########################################################
+	def record_move(self, move, spawn, search_time=0.0):
+		entry = move-1
+		if spawn is None:
+			entry |= NO_SPAWN
+		else:
+			cell, value = spawn
+			entry |= cell << 4
+			if value == 4:
+				entry |= SPAWN_FOUR
+		self.file.write(bytes([entry]) + _varint(max(0, round(search_time*1000000))))
+		self.file.flush()
+
+	def end_game(self):
+		if self.in_game:
+			self.file.write(bytes([END]))
+			self.file.flush()
+			self.in_game = False
+
+	def close(self):
+		self.end_game()
+		self.file.close()
+
+##########################################################
+# A recorded game
+#
+# moves is a list of (move, spawn cell, spawn exponent, search
+# microseconds) with cell and exponent None when nothing spawned.
+# Boards are bitboards.
+##########################################################
+class Replay:
+	def __init__(self, seed, start):
+		self.seed = seed
+		self.start = start
+		self.moves = []
+		# False if the log ended in the middle of this game
+		self.finished = False
+
+	def __len__(self):
+		return len(self.moves)
+
+	##########################################################
+	# yields (board, score) before the first move and after every
+	# move, only table lookups so a whole game takes milliseconds
+	##########################################################
+	def positions(self):
+		board = self.start
+		score = 0
+		yield board, score
+		for move, cell, exp, _ in self.moves:
+			board, gained = bitboard.move(board, move)
+			score += gained
+			if cell is not None:
+				board = bitboard.set_cell(board, cell, exp)
+			yield board, score
+
+	##########################################################
+	# board and score after the first n moves, the final position
+	# when n is None
+	##########################################################
+	def position(self, n=None):
+		if n is None:
+			n = len(self.moves)
+		if not 0 <= n <= len(self.moves):
+			raise IndexError(f"game has {len(self.moves)} moves, no position after move {n}")
+		for i, position in enumerate(self.positions()):
+			if i == n:
+				return position
+
+	def search_seconds(self):
+		return sum(micros for _, _, _, micros in self.moves) / 1000000
+
+##########################################################
+# yields the games of a log, from a path or a binary file object
+##########################################################
+def read_games(source):
+	if isinstance(source, (str, os.PathLike)):
+		with open(source, "rb") as f:
+			yield from read_games(f)
+		return
+
+	games, _, _ = _parse_log(source.read())
+	yield from games
+
+##########################################################
+# parses the bytes of a log, returns its games, the length of the
+# log up to the last whole move or game and whether the last game
+# is missing its END. A game header cut off by the end of the log is
+# dropped.
+##########################################################
+def _parse_log(data):
+	if data[:len(_LOG_MAGIC)] != _LOG_MAGIC or len(data) <= len(_LOG_MAGIC) or data[len(_LOG_MAGIC)] != LOG_VERSION:
+		raise ValueError(f"not a version {LOG_VERSION} game log")
+	pos = len(_LOG_MAGIC)+1
+	games = []
+
+	while pos < len(data):
+		if data[pos:pos+1] != _GAME:
+			raise ValueError(f"corrupt game log at byte {pos}")
+		if pos+1+_GAME_HEADER.size > len(data):
+			break
+		seed, start = _GAME_HEADER.unpack_from(data, pos+1)
+		game = Replay(seed, start)
+		pos += 1+_GAME_HEADER.size
+		games.append(game)
+
+		while pos < len(data):
+			entry = data[pos]
+			if entry & END == END:
+				pos+=1
+				game.finished = entry != CUT
+				break
+			# the varint of the search time
+			end = pos+1
+			while end < len(data) and data[end] & 0x80:
+				end+=1
+			if end >= len(data):
+				# the log stops in the middle of this move
+				return games, pos, True
+			micros = 0
+			for k, byte in enumerate(data[pos+1:end+1]):
+				micros |= (byte & 0x7F) << (7*k)
+			pos = end+1
+
+			if entry & NO_SPAWN:
+				cell = exp = None
+			else:
+				cell = entry >> 4
+				exp = 2 if entry & SPAWN_FOUR else 1
+			game.moves.append(((entry & 0x03)+1, cell, exp, micros))
+		else:
+			# the log stops after a whole move of this game
+			return games, pos, True
+	return games, pos, False
+
+##########################################################
+# checks that the game's seed reproduces the spawns in the log,
+# replaying the moves on game_class(seed). Returns the number of
+# the first move that differs, or None when every spawn matches.
+##########################################################
+def verify(replay, game_class):
+	game = game_class(replay.seed)
+	if bitboard.to_bitboard(game.board) != replay.start:
+		return 0
+	positions = replay.positions()
+	next(positions)
+	for i, ((move, _, _, _), (board, score)) in enumerate(zip(replay.moves, positions)):
+		game.play(move)
+		if bitboard.to_bitboard(game.board) != board or game.score != score:
+			return i+1
+	return None
+
+def print_board(board):
+	board = bitboard.from_bitboard(board)
+	for r in range(4):
+		print("\t" + " ".join(f"{tile:>5}" for tile in board[4*r:4*r+4]))
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description="List, show and export recorded 2048 games.")
+	parser.add_argument("log", help="game log written by simulate.py --record or the UI")
+	parser.add_argument("--game", type=int, help="game to show or export (0 is the first game)")
+	parser.add_argument("--move", type=int, help="with --game, show the position after this many moves")
+	parser.add_argument("--corpus", metavar="PATH",
+		help="write the last positions of the games as a benchmark.py --corpus file")
+	parser.add_argument("--last", type=int, default=10, help="positions per game written by --corpus")
+	parser.add_argument("--stage", default="replay", help="stage name of the positions written by --corpus")
+	parser.add_argument("--verify", action="store_true", help="check that every game's seed reproduces its spawns")
+	return parser.parse_args(argv)
+
+def main(argv=None):
+	args = parse_args(argv)
+	games = list(read_games(args.log))
+	if args.game is not None:
+		if not 0 <= args.game < len(games):
+			print(f"{args.log} has {len(games)} games", file=sys.stderr)
+			return 1
+		selected = {args.game: games[args.game]}
+	else:
+		selected = dict(enumerate(games))
+
+	if args.corpus:
+		boards = []
+		for game in selected.values():
+			positions = list(game.positions())
+			boards.extend(bitboard.from_bitboard(board) for board, _ in positions[-args.last:])
+		with open(args.corpus, "w") as f:
+			json.dump({args.stage: boards}, f)
+		print(f"wrote {len(boards)} positions to {args.corpus}")
+		return 0
+
+	if args.verify:
+		# the solver is only loaded here, it imports pygame
+		os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+		solver = importlib.import_module("2048_solver")
+		failed = 0
+		for i, game in selected.items():
+			move = verify(game, solver.Game2048)
+			if move is not None:
+				failed+=1
+				print(f"game {i}: seed {game.seed} differs at move {move}")
+		print(f"{len(selected)-failed}/{len(selected)} games reproduced by their seeds")
+		return 1 if failed else 0
+
+	if args.game is not None:
+		game = games[args.game]
+		board, score = game.position(args.move)
+		n = len(game) if args.move is None else args.move
+		print(f"game {args.game}: seed {game.seed}, after move {n}/{len(game)}, score {score}")
+		print_board(board)
+		return 0
+
+	print(f"{'game':>5}{'seed':>22}{'moves':>7}{'score':>8}{'max tile':>10}{'search s':>10}")
+	for i, game in selected.items():
+		board, score = game.position()
+		flag = "" if game.finished else "  (cut off)"
+		print(f"{i:>5}{game.seed:>22}{len(game):>7}{score:>8}{bitboard.max_tile(board):>10}"
+			f"{game.search_seconds():>10.2f}{flag}")
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,145 @@
+# Noah Nisbet
+# Batched Monte Carlo rollouts
+# Plays many 2048 games in lockstep as NumPy arrays of bitboards to
+# pick moves by their average playout score, no evaluation function
+# involved.
+
+import numpy as np
+
+import bitboard
+
+##########################################################
+# NumPy copies of the bitboard row tables. Boards are uint64
+# arrays in the bitboard layout.
+##########################################################
+_ROW_LEFT = np.array(bitboard.ROW_LEFT, dtype=np.uint64)
+_ROW_RIGHT = np.array(bitboard.ROW_RIGHT, dtype=np.uint64)
+_ROW_LEFT_SCORE = np.array(bitboard.ROW_LEFT_SCORE, dtype=np.int64)
+_ROW_RIGHT_SCORE = np.array(bitboard.ROW_RIGHT_SCORE, dtype=np.int64)
+
+_ROW_MASK = np.uint64(bitboard.ROW_MASK)
+_CELL_MASK = np.uint64(bitboard.CELL_MASK)
+_SHIFTS = np.arange(0, 64, 4, dtype=np.uint64)
+_ROW_SHIFTS = [np.uint64(16*r) for r in range(4)]
+
+POLICIES = ("random", "greedy")
+
+##########################################################
+# bitboard.transpose for an array of boards
+##########################################################
+def transpose_batch(boards):
+	a1 = boards & np.uint64(0xF0F00F0FF0F00F0F)
+	a2 = boards & np.uint64(0x0000F0F00000F0F0)
+	a3 = boards & np.uint64(0x0F0F00000F0F0000)
+	a = a1 | (a2 << np.uint64(12)) | (a3 >> np.uint64(12))
+	b1 = a & np.uint64(0xFF00FF0000FF00FF)
+	b2 = a & np.uint64(0x00FF00FF00000000)
+	b3 = a & np.uint64(0x00000000FF00FF00)
+	return b1 | (b2 >> np.uint64(24)) | (b3 << np.uint64(24))
+
+def _move_rows_batch(boards, rows, scores):
+	res = np.zeros_like(boards)
+	score = np.zeros(len(boards), dtype=np.int64)
+	for shift in _ROW_SHIFTS:
+		row = ((boards >> shift) & _ROW_MASK).astype(np.intp)
+		res |= rows[row] << shift
+		score += scores[row]
+	return res, score
+
+##########################################################
+# all four moves of every board. Returns (N, 4) arrays of the
+# moved boards and the score each move gains, column k is move
+# k+1 in the 1-4 order of bitboard.move.
+##########################################################
+def moves_batch(boards):
+	t = transpose_batch(boards)
+	left, left_score = _move_rows_batch(boards, _ROW_LEFT, _ROW_LEFT_SCORE)
+	up, up_score = _move_rows_batch(t, _ROW_LEFT, _ROW_LEFT_SCORE)
+	right, right_score = _move_rows_batch(boards, _ROW_RIGHT, _ROW_RIGHT_SCORE)
+	down, down_score = _move_rows_batch(t, _ROW_RIGHT, _ROW_RIGHT_SCORE)
+	moved = np.stack([left, transpose_batch(up), right, transpose_batch(down)], axis=1)
+	scores = np.stack([left_score, up_score, right_score, down_score], axis=1)
+	return moved, scores
+
+##########################################################
+# bitboard.spawn for an array of boards, a two with a 90% chance
+# and a four with a 10% chance on a random empty cell. Full boards
+# are returned unchanged.
+##########################################################
+def spawn_batch(boards, rng):
+	exps = (boards[:, None] >> _SHIFTS) & _CELL_MASK
+	empty = exps == 0
+	counts = empty.sum(axis=1)
+	# the pick-th empty cell of every board gets the tile
+	pick = (rng.random(len(boards))*counts).astype(np.int64)
+	chosen = empty & (np.cumsum(empty, axis=1)-1 == pick[:, None])
+	cell = np.argmax(chosen, axis=1).astype(np.uint64)
+	exp = np.where(rng.random(len(boards)) < 0.1, 2, 1).astype(np.uint64)
+	return np.where(counts > 0, boards | (exp << (np.uint64(4)*cell)), boards)
+
+##########################################################
+# plays every board until no move is left (or for max_steps
+# moves) and returns the score each playout gained
+#
+# policy "random" plays a random legal move, "greedy" the legal
+# move that scores the most right away with ties broken at random.
+# Only the boards still in play are stepped, so the batch shrinks
+# as games end.
+##########################################################
+def playout_batch(boards, rng, policy="random", max_steps=None):
+	if policy not in POLICIES:
+		raise ValueError(f"policy must be one of {POLICIES}, got {policy!r}")
+
+	boards = np.array(boards, dtype=np.uint64)
+	totals = np.zeros(len(boards), dtype=np.int64)
+	alive = np.arange(len(boards))
+	steps = 0
+	while len(alive) > 0 and (max_steps is None or steps < max_steps):
+		current = boards[alive]
+		moved, scores = moves_batch(current)
+		legal = moved != current[:, None]
+
+		if policy == "random":
+			keys = rng.random(moved.shape)
+		else:
+			# scores are even numbers so the random part only breaks ties
+			keys = scores + rng.random(moved.shape)
+		keys[~legal] = -1
+		choice = np.argmax(keys, axis=1)
+
+		playing = legal.any(axis=1)
+		rows = np.arange(len(current))
+		alive = alive[playing]
+		choice = choice[playing]
+		rows = rows[playing]
+		totals[alive] += scores[rows, choice]
+		boards[alive] = spawn_batch(moved[rows, choice], rng)
+		steps+=1
+	return totals
+
+##########################################################
+# Monte Carlo move choice
+#
+# Plays playouts games after every legal move of board and returns
+# the move with the best average score (the move's own score plus
+# the mean playout score) and a dictionary of every move's average.
+# The playouts of all moves run as one batch. Returns None when no
+# move is legal.
+##########################################################
+def best_move(board, playouts, rng, policy="random", max_steps=None):
+	moves = bitboard.legal_moves(board)
+	if len(moves) == 0:
+		return None, {}
+
+	starts = []
+	rewards = []
+	for move in moves:
+		child_board, reward = bitboard.move(board, move)
+		starts.append(child_board)
+		rewards.append(reward)
+
+	boards = spawn_batch(np.repeat(np.array(starts, dtype=np.uint64), playouts), rng)
+	totals = playout_batch(boards, rng, policy, max_steps).reshape(len(moves), playouts)
+
+	values = {move: reward + float(total.mean()) for move, reward, total in zip(moves, rewards, totals)}
+	return max(values, key=values.get), values
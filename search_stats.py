@@ -0,0 +1,248 @@
+# Noah Nisbet
+# Search instrumentation
+# Counts what expectimax and alphabeta do on every search and
+# appends one json line per search to a file, to find out where the
+# time goes and which positions blow up the tree.
+#
+# example:
+#   python3 simulate.py -n 4 --stats stats.jsonl
+#   python3 search_stats.py stats.jsonl
+
+import json
+import sys
+import time
+
+import bitboard
+
+##########################################################
+# Search statistics
+#
+# Set a game's search_stats to a SearchStats and every expectimax
+# and alphabeta search writes a record to path:
+#   search          "expectimax" or "alphabeta"
+#   depth           depth limit of the search
+#   board           the root board, 16 tile values
+#   move            the move chosen, None if the search was stopped
+#                   by its deadline
+#   seconds         time of the whole search
+#   max_nodes       max nodes expanded (their children were searched)
+#   chance_nodes    chance nodes (alphabeta min nodes) expanded
+#   leaves          nodes scored by the evaluation function or
+#                   answered by the transposition table
+#   evaluate_calls  calls of game.evaluate
+#   terminal_calls  calls of game.terminal
+#   cutoffs         alphabeta nodes whose value fell outside their
+#                   window, the ones that stopped searching early
+#   tt_hits         transposition table hits
+#   leaf_cache_hits leaf cache hits
+#   branching_factor the effective branching factor b, where a
+#                   uniform tree of the search depth and branching b
+#                   would have as many nodes as the search visited
+#   levels          per ply from the root: nodes visited, nodes
+#                   expanded and the seconds spent in them (not
+#                   counting the plies below)
+# plus the entries of tags (simulate.py adds the game's seed).
+#
+# Iterative deepening writes a record for every depth it searched.
+#
+# Nothing is counted while search_stats is None. When it is set
+# the search functions are wrapped for the length of a search, so
+# the searches themselves have no instrumentation code in them.
+##########################################################
+class SearchStats:
+	def __init__(self, path, tags=None):
+		self.path = path
+		self.tags = dict(tags) if tags else {}
+		self.records = 0
+		# opened on the first record, so forked processes each get
+		# their own file object
+		self.file = None
+		self.record = None
+
+	##########################################################
+	# called by Game2048.expectimax and Game2048.alphabeta before a
+	# search. game.evaluate and game.terminal are counted through
+	# instance attributes that end removes again.
+	##########################################################
+	def begin(self, game, search, board, depth):
+		self.game = game
+		self.root_depth = depth
+		# the ply that is being timed and when its time started
+		self.ply = -1
+		self.last = time.perf_counter()
+		# stack of child counts of the nodes being searched
+		self.children = [0]
+		self.tt_hits = game.tt.hits if game.tt is not None else 0
+		self.leaf_cache_hits = game.leaf_cache.hits if game.leaf_cache is not None else 0
+
+		if not isinstance(board, list):
+			board = bitboard.from_bitboard(board)
+		self.record = {
+			"search": search,
+			"depth": depth,
+			"board": list(board),
+			"move": None,
+			"seconds": 0.0,
+			"max_nodes": 0,
+			"chance_nodes": 0,
+			"leaves": 0,
+			"evaluate_calls": 0,
+			"terminal_calls": 0,
+			"cutoffs": 0,
+			"tt_hits": 0,
+			"leaf_cache_hits": 0,
+			"branching_factor": 0.0,
+			"levels": [{"nodes": 0, "expanded": 0, "seconds": 0.0} for _ in range(depth+1)],
+		}
+		self.start = self.last
+
+		record = self.record
+		evaluate = game.evaluate
+		terminal = game.terminal
+		def counted_evaluate(parent_board, board, score):
+			record["evaluate_calls"]+=1
+			return evaluate(parent_board, board, score)
+		def counted_terminal(board):
+			record["terminal_calls"]+=1
+			return terminal(board)
+		game.evaluate = counted_evaluate
+		game.terminal = counted_terminal
+
+	##########################################################
+	# called after the search with the move it chose, None when it
+	# was stopped. Writes the record.
+	##########################################################
+	def end(self, move):
+		record = self.record
+		game = self.game
+		del game.evaluate
+		del game.terminal
+		self.record = None
+		self.game = None
+
+		now = time.perf_counter()
+		record["move"] = move
+		record["seconds"] = now - self.start
+		if self.ply >= 0:
+			record["levels"][self.ply]["seconds"] += now - self.last
+		if game.tt is not None:
+			record["tt_hits"] = game.tt.hits - self.tt_hits
+		if game.leaf_cache is not None:
+			record["leaf_cache_hits"] = game.leaf_cache.hits - self.leaf_cache_hits
+		nodes = sum(level["nodes"] for level in record["levels"])
+		record["branching_factor"] = branching_factor(nodes, record["depth"])
+		record.update(self.tags)
+		self.write(record)
+
+	def write(self, record):
+		if self.file is None:
+			self.file = open(self.path, "a", buffering=1)
+		self.file.write(json.dumps(record) + "\n")
+		self.records+=1
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	##########################################################
+	# wraps one of the nested node functions of a search. Node
+	# functions take (parent_board, board, depth_limit, ...) and
+	# return (move, value). kind is "max" or "chance", window is
+	# True for alphabeta nodes, which also take alpha and beta.
+	#
+	# A node that called any child node was expanded, any other node
+	# was a leaf or a transposition table hit. Time is charged to
+	# the ply currently being searched, so a ply's seconds do not
+	# include the plies below it.
+	##########################################################
+	def node(self, function, kind, window=False):
+		record = self.record
+		levels = record["levels"]
+		children = self.children
+		expanded_key = "max_nodes" if kind == "max" else "chance_nodes"
+		clock = time.perf_counter
+
+		def wrapped(parent_board, board, depth_limit, *args):
+			ply = self.root_depth - depth_limit
+			now = clock()
+			if self.ply >= 0:
+				levels[self.ply]["seconds"] += now - self.last
+			self.last = now
+			self.ply = ply
+			levels[ply]["nodes"]+=1
+			children[-1]+=1
+			children.append(0)
+			try:
+				res = function(parent_board, board, depth_limit, *args)
+			finally:
+				now = clock()
+				levels[self.ply]["seconds"] += now - self.last
+				self.last = now
+				self.ply = ply-1
+				expanded = children.pop() > 0
+
+			if expanded:
+				record[expanded_key]+=1
+				levels[ply]["expanded"]+=1
+				if window:
+					alpha, beta = args[0], args[1]
+					value = res[1]
+					if (kind == "max" and value >= beta) or (kind == "chance" and value <= alpha):
+						record["cutoffs"]+=1
+			else:
+				record["leaves"]+=1
+			return res
+		return wrapped
+
+##########################################################
+# effective branching factor: the b for which a uniform tree of
+# the given depth, 1 + b + b**2 + ... + b**depth, has nodes nodes.
+# Found by bisection.
+##########################################################
+def branching_factor(nodes, depth):
+	if depth <= 0 or nodes <= depth+1:
+		return 1.0 if nodes > 1 else 0.0
+	def tree_size(b):
+		return sum(b**k for k in range(depth+1))
+	low, high = 1.0, float(nodes)
+	for _ in range(60):
+		mid = (low+high)/2
+		if tree_size(mid) < nodes:
+			low = mid
+		else:
+			high = mid
+	return (low+high)/2
+
+##########################################################
+# summarizes a stats file: the searches, their mean node counts
+# and times by search and depth, and the slowest searches
+##########################################################
+def summarize_file(path, slowest=5):
+	with open(path) as f:
+		records = [json.loads(line) for line in f if line.strip()]
+
+	groups = {}
+	for record in records:
+		groups.setdefault((record["search"], record["depth"]), []).append(record)
+
+	print(f"{len(records)} searches")
+	print(f"{'search':<11}{'depth':>6}{'count':>7}{'ms':>10}{'max nodes':>11}{'chance':>9}"
+		f"{'evals':>9}{'tt hits':>9}{'cutoffs':>9}{'ebf':>7}")
+	for (search, depth), group in sorted(groups.items()):
+		def mean(field):
+			return sum(record[field] for record in group) / len(group)
+		print(f"{search:<11}{depth:>6}{len(group):>7}{1000*mean('seconds'):>10.2f}{mean('max_nodes'):>11.0f}"
+			f"{mean('chance_nodes'):>9.0f}{mean('evaluate_calls'):>9.0f}{mean('tt_hits'):>9.0f}"
+			f"{mean('cutoffs'):>9.0f}{mean('branching_factor'):>7.2f}")
+
+	print("slowest searches:")
+	for record in sorted(records, key=lambda record: record["seconds"], reverse=True)[:slowest]:
+		print(f"\t{1000*record['seconds']:.1f} ms {record['search']} depth {record['depth']} "
+			f"move {record['move']} board {record['board']}")
+
+if __name__ == "__main__":
+	if len(sys.argv) != 2:
+		print("usage: python3 search_stats.py STATS.jsonl")
+		sys.exit(2)
+	summarize_file(sys.argv[1])
@@ -0,0 +1,213 @@
+# Noah Nisbet
+# Best move service
+# A long running process that answers best move requests over a
+# socket or stdin/stdout, so other tools can query the solver
+# without paying its start up cost every time.
+#
+# example:
+#   python3 service.py --port 2048
+#   python3 service.py --unix /tmp/2048.sock
+#   echo '{"id": 1, "board": [0,0,0,0,0,0,0,0,0,0,0,0,2,2,0,0]}' | python3 service.py --stdio
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+import batch_search
+from simulate import ENGINES
+
+##########################################################
+# Protocol
+#
+# Requests and responses are json objects, one per line. A
+# request holds the fields of batch_search.check_request and an
+# optional "id" that is copied to its response. A response holds
+#   id, move (1-4 or null), value, depth, seconds
+# or
+#   id, error
+# Responses are written as searches finish, so they can come back
+# in a different order than the requests were sent.
+##########################################################
+
+##########################################################
+# Batcher
+#
+# Collects the requests of every connection. Once a request
+# arrives the batcher waits batch_window seconds for more, then
+# sends everything waiting (up to max_batch requests) to the search
+# pool as one batch. Results are handed back to the asyncio loop
+# through futures.
+##########################################################
+class Batcher:
+	def __init__(self, pool, batch_window=0.002, max_batch=1024):
+		self.pool = pool
+		self.batch_window = batch_window
+		self.max_batch = max_batch
+		self.queue = asyncio.Queue()
+		self.batches = 0
+		self.requests = 0
+
+	async def search(self, request):
+		future = asyncio.get_running_loop().create_future()
+		await self.queue.put((request, future))
+		return await future
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			waiting = [await self.queue.get()]
+			if self.batch_window > 0:
+				await asyncio.sleep(self.batch_window)
+			while len(waiting) < self.max_batch and not self.queue.empty():
+				waiting.append(self.queue.get_nowait())
+
+			futures = [future for _, future in waiting]
+			self.batches+=1
+			self.requests += len(waiting)
+
+			def done(results, futures=futures):
+				loop.call_soon_threadsafe(resolve, futures, results)
+			# only the futures of the chunk that failed
+			def failed(indices, exc, futures=futures):
+				loop.call_soon_threadsafe(fail, [futures[i] for i in indices], exc)
+			self.pool.submit([(i, request) for i, (request, _) in enumerate(waiting)], done, failed)
+
+def resolve(futures, results):
+	for index, result in results:
+		if not futures[index].done():
+			futures[index].set_result(result)
+
+def fail(futures, exc):
+	for future in futures:
+		if not future.done():
+			future.set_exception(exc)
+
+##########################################################
+# answers one request line, returns the response object
+##########################################################
+async def answer(batcher, line):
+	try:
+		message = json.loads(line)
+	except ValueError:
+		return {"id": None, "error": "invalid json"}
+	request_id = message.get("id") if isinstance(message, dict) else None
+	try:
+		request = batch_search.check_request(message)
+	except ValueError as exc:
+		return {"id": request_id, "error": str(exc)}
+	try:
+		result = await batcher.search(request)
+	except Exception as exc:
+		return {"id": request_id, "error": f"search failed: {exc}"}
+	return {"id": request_id, **result}
+
+##########################################################
+# serves the requests of one stream. Every line is answered in its
+# own task so a connection can have many requests in flight.
+##########################################################
+async def serve_stream(batcher, reader, write):
+	tasks = set()
+	async def handle(line):
+		response = await answer(batcher, line)
+		await write(json.dumps(response) + "\n")
+
+	while True:
+		line = await reader.readline()
+		if not line:
+			break
+		if not line.strip():
+			continue
+		task = asyncio.create_task(handle(line))
+		tasks.add(task)
+		task.add_done_callback(tasks.discard)
+	if tasks:
+		await asyncio.gather(*tasks)
+
+async def serve_socket(batcher, options):
+	async def client(reader, writer):
+		async def write(text):
+			writer.write(text.encode())
+			await writer.drain()
+		try:
+			await serve_stream(batcher, reader, write)
+		except ConnectionError:
+			pass
+		finally:
+			writer.close()
+
+	if options["unix"]:
+		server = await asyncio.start_unix_server(client, path=options["unix"])
+		where = options["unix"]
+	else:
+		server = await asyncio.start_server(client, host=options["host"], port=options["port"])
+		where = f"{options['host']}:{options['port']}"
+	print(f"serving best moves on {where}", file=sys.stderr, flush=True)
+	async with server:
+		await server.serve_forever()
+
+async def serve_stdio(batcher):
+	loop = asyncio.get_running_loop()
+	reader = asyncio.StreamReader()
+	await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+	async def write(text):
+		sys.stdout.write(text)
+		sys.stdout.flush()
+	await serve_stream(batcher, reader, write)
+
+async def serve(pool, options):
+	batcher = Batcher(pool, options["batch_window"], options["max_batch"])
+	batching = asyncio.create_task(batcher.run())
+	try:
+		if options["stdio"]:
+			await serve_stdio(batcher)
+		else:
+			await serve_socket(batcher, options)
+	finally:
+		batching.cancel()
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description="Serve best move requests as json lines.")
+	where = parser.add_mutually_exclusive_group()
+	where.add_argument("--port", type=int, help="TCP port to listen on")
+	where.add_argument("--unix", metavar="PATH", help="Unix socket to listen on")
+	where.add_argument("--stdio", action="store_true", help="read requests from stdin and answer on stdout")
+	parser.add_argument("--host", default="127.0.0.1", help="address for --port (default: 127.0.0.1)")
+	parser.add_argument("--engine", choices=sorted(ENGINES), default="table")
+	parser.add_argument("--tt-mb", type=int, default=64, help="transposition table size per worker in MiB")
+	parser.add_argument("--ntuple", metavar="WEIGHTS", help="score leaves with the n-tuple network in WEIGHTS")
+	parser.add_argument("--star1", action="store_true",
+		help="prune expectimax chance nodes that can not change the move (Star1)")
+	parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: all cores)")
+	parser.add_argument("--batch-window", type=float, default=0.002,
+		help="seconds to wait for more requests before a batch is searched")
+	parser.add_argument("--max-batch", type=int, default=1024, help="most requests searched as one batch")
+	args = parser.parse_args(argv)
+	if args.port is None and args.unix is None and not args.stdio:
+		parser.error("give --port, --unix or --stdio")
+	return args
+
+def main(argv=None):
+	args = parse_args(argv)
+	options = {
+		"port": args.port,
+		"unix": args.unix,
+		"stdio": args.stdio,
+		"host": args.host,
+		"batch_window": args.batch_window,
+		"max_batch": args.max_batch,
+	}
+	pool = batch_search.SearchPool(ENGINES[args.engine], args.workers, args.tt_mb*1024*1024, args.ntuple, args.star1)
+	try:
+		asyncio.run(serve(pool, options))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		pool.close()
+		if args.unix and os.path.exists(args.unix):
+			os.remove(args.unix)
+
+if __name__ == "__main__":
+	main()
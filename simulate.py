@@ -0,0 +1,324 @@
+# Noah Nisbet
+# Headless 2048 simulations
+# Plays many games without the pygame UI across a process pool and
+# reports how a strategy performs.
+#
+# example:
+#   python3 simulate.py -n 50 --strategy expectimax
+
+import argparse
+import importlib
+import io
+import json
+import os
+import random
+import sys
+import time
+from multiprocessing import Pool
+
+import ntuple
+from replay import GameRecorder, open_log
+from search_stats import SearchStats
+from transposition import TranspositionTable, LeafCache
+
+# keep pygame quiet when the solver module is imported
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+# 2048_solver.py starts with a digit so it can not be named in an import statement
+solver = importlib.import_module("2048_solver")
+
+ENGINES = {
+	"bitboard": solver.BitboardGame2048,
+	"list": solver.Game2048,
+	"table": solver.TableEvalGame2048,
+}
+
+##########################################################
+# depth policies
+#
+# adaptive = the rule the pygame AI loops use, search deeper by one
+#            for every empty tile under three
+# fixed    = always search the base depth
+# timed    = iterative deepening within move_time seconds per move,
+#            the base depths are not used
+##########################################################
+def search_depth(game, base_depth, policy):
+	if policy == "adaptive":
+		num_zeros = game.get_num_zeros(game.board)
+		if num_zeros < 3:
+			return base_depth+(3-num_zeros)
+	return base_depth
+
+##########################################################
+# strategies, each returns the move to play on game.board
+##########################################################
+def expectimax_move(game, options):
+	if options["policy"] == "timed":
+		return game.expectimax_timed(options["move_time"])
+	return game.expectimax(search_depth(game, options["expectimax_depth"], options["policy"]))
+
+def alphabeta_move(game, options):
+	if options["policy"] == "timed":
+		return game.alphabeta_timed(options["move_time"])
+	return game.alphabeta(search_depth(game, options["alphabeta_depth"], options["policy"]))
+
+# expectimax until the score reaches 18,000 then alpha-beta, the same as the B key
+def hybrid_move(game, options):
+	if game.get_score() > 18000:
+		return alphabeta_move(game, options)
+	return expectimax_move(game, options)
+
+# draws among the moves that change the board, so no-ops (random_move's
+# 5 or a blocked direction) are not counted as moves or timed
+def random_strategy_move(game, options):
+	moves = [child[0] for child in game.get_child_boards(1, game.get_search_board())]
+	if not moves:
+		return None
+	return random.choice(moves)
+
+def monte_carlo_move(game, options):
+	return game.monte_carlo(options["playouts"], options["playout_policy"])
+
+def mcts_move(game, options):
+	if options["policy"] == "timed":
+		return game.mcts(time_limit=options["move_time"])
+	return game.mcts(options["iterations"])
+
+STRATEGIES = {
+	"expectimax": expectimax_move,
+	"alphabeta": alphabeta_move,
+	"hybrid": hybrid_move,
+	"random": random_strategy_move,
+	"montecarlo": monte_carlo_move,
+	"mcts": mcts_move,
+}
+
+# n-tuple networks loaded by this process, by path
+_networks = {}
+
+def load_network(path):
+	if path not in _networks:
+		_networks[path] = ntuple.load(path)
+	return _networks[path]
+
+##########################################################
+# creates a game for the given options. The game's spawns come from
+# seed and the global random generator the searches sample spawns
+# with is seeded with it too.
+##########################################################
+def new_game(options, seed):
+	random.seed(seed)
+	game = ENGINES[options["engine"]](seed)
+	if options["tt_mb"] > 0:
+		game.tt = TranspositionTable(max_bytes=options["tt_mb"]*1024*1024, persist=True)
+	if options.get("leaf_cache"):
+		game.leaf_cache = LeafCache()
+	game.prob_cutoff = options["prob_cutoff"]
+	game.star1 = options.get("star1", False)
+	if options.get("ntuple"):
+		game.evaluator = load_network(options["ntuple"])
+		# the network scores all symmetries of a board alike
+		game.symmetric_keys = True
+	if options.get("symmetric_keys"):
+		game.symmetric_keys = True
+	if options.get("stats"):
+		game.search_stats = SearchStats(options["stats"], {"seed": seed})
+	if options.get("record"):
+		# the game is recorded in memory and appended to the log by
+		# the main process, so games from different workers never mix
+		game.recorder = GameRecorder(io.BytesIO())
+	return game
+
+##########################################################
+# plays one game to the end and returns its result
+#
+# This is the same loop as the AI keys in 2048_solver.py, without
+# rendering: move, spawn a tile if the board changed, stop when the
+# board is terminal.
+##########################################################
+def play_game(options, seed):
+	game = new_game(options, seed)
+	choose_move = STRATEGIES[options["strategy"]]
+	move_times = []
+
+	while not game.terminal(game.get_search_board()):
+		start = time.perf_counter()
+		best_move = choose_move(game, options)
+		move_times.append(time.perf_counter() - start)
+		# the searches return None when no move changes the board
+		if best_move is None:
+			break
+
+		game.play(best_move, move_times[-1])
+	if game.search_stats is not None:
+		game.search_stats.close()
+	log = None
+	if game.recorder is not None:
+		game.recorder.end_game()
+		log = game.recorder.file.getvalue()
+
+	return {
+		"seed": seed,
+		"score": game.get_score(),
+		"max_tile": max(game.board),
+		"won": max(game.board) >= 2048,
+		"moves": len(move_times),
+		"move_times": move_times,
+		"log": log,
+	}
+
+def _play_game_task(task):
+	return play_game(*task)
+
+##########################################################
+# plays num_games games across workers processes and yields the
+# results as they finish
+##########################################################
+def run_games(options, num_games, seed=0, workers=None):
+	tasks = [(options, seed+i) for i in range(num_games)]
+	if workers == 1:
+		for task in tasks:
+			yield _play_game_task(task)
+		return
+
+	with Pool(processes=workers) as pool:
+		for result in pool.imap_unordered(_play_game_task, tasks):
+			yield result
+
+##########################################################
+# nearest rank percentile of a sorted list
+##########################################################
+def percentile(values, p):
+	if len(values) == 0:
+		return 0.0
+	index = max(0, min(len(values)-1, int(round(p/100*len(values)))-1))
+	return values[index]
+
+##########################################################
+# combines game results into a summary
+##########################################################
+def summarize(results, wall_time):
+	scores = sorted(result["score"] for result in results)
+	move_times = sorted(t for result in results for t in result["move_times"])
+	total_moves = len(move_times)
+
+	max_tiles = {}
+	for result in results:
+		max_tiles[result["max_tile"]] = max_tiles.get(result["max_tile"], 0)+1
+
+	return {
+		"games": len(results),
+		"win_rate": sum(result["won"] for result in results) / len(results) if results else 0.0,
+		"score": {
+			"mean": sum(scores) / len(scores) if scores else 0.0,
+			"min": scores[0] if scores else 0,
+			"p25": percentile(scores, 25),
+			"median": percentile(scores, 50),
+			"p75": percentile(scores, 75),
+			"max": scores[-1] if scores else 0,
+		},
+		"max_tile_histogram": dict(sorted(max_tiles.items())),
+		"moves": total_moves,
+		"wall_time": wall_time,
+		# moves played per second of wall clock across all workers
+		"moves_per_second": total_moves / wall_time if wall_time > 0 else 0.0,
+		"move_latency": {
+			"mean": sum(move_times) / total_moves if total_moves else 0.0,
+			"p50": percentile(move_times, 50),
+			"p90": percentile(move_times, 90),
+			"p99": percentile(move_times, 99),
+			"max": move_times[-1] if move_times else 0.0,
+		},
+	}
+
+def print_summary(summary):
+	print(f"games: {summary['games']}")
+	print(f"win rate: {100*summary['win_rate']:.1f}%")
+	score = summary["score"]
+	print(f"score: mean {score['mean']:.0f}  min {score['min']}  p25 {score['p25']}  "
+		f"median {score['median']}  p75 {score['p75']}  max {score['max']}")
+	print("max tile:")
+	for tile, count in summary["max_tile_histogram"].items():
+		print(f"\t{tile:>6}: {count}")
+	print(f"moves: {summary['moves']} in {summary['wall_time']:.1f} s "
+		f"({summary['moves_per_second']:.1f} moves/s)")
+	latency = summary["move_latency"]
+	print(f"move latency (ms): mean {1000*latency['mean']:.2f}  p50 {1000*latency['p50']:.2f}  "
+		f"p90 {1000*latency['p90']:.2f}  p99 {1000*latency['p99']:.2f}  max {1000*latency['max']:.2f}")
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description="Play 2048 games without the UI and report results.")
+	parser.add_argument("-n", "--games", type=int, default=10, help="number of games to play")
+	parser.add_argument("--strategy", choices=sorted(STRATEGIES), default="expectimax")
+	parser.add_argument("--policy", choices=["adaptive", "fixed", "timed"], default="adaptive",
+		help="adaptive searches deeper on crowded boards like the UI, fixed always uses the base depth, "
+		"timed deepens until --move-time runs out")
+	parser.add_argument("--expectimax-depth", type=int, default=5, help="base expectimax depth")
+	parser.add_argument("--alphabeta-depth", type=int, default=6, help="base alpha-beta depth")
+	parser.add_argument("--move-time", type=float, default=0.1, help="seconds per move for the timed policy")
+	parser.add_argument("--playouts", type=int, default=100, help="montecarlo playouts per legal move")
+	parser.add_argument("--playout-policy", choices=["random", "greedy"], default="random",
+		help="montecarlo playouts play random moves or the move that scores most right away")
+	parser.add_argument("--iterations", type=int, default=1000, help="mcts iterations per move, unless --policy timed")
+	parser.add_argument("--engine", choices=sorted(ENGINES), default="table")
+	parser.add_argument("--tt-mb", type=int, default=0, help="transposition table size per game in MiB, 0 disables it")
+	parser.add_argument("--leaf-cache", action="store_true",
+		help="keep expectimax leaf values between the moves of a game")
+	parser.add_argument("--prob-cutoff", type=float, default=None,
+		help="expand every spawn with its true probability and stop below this path probability (e.g. 0.001)")
+	parser.add_argument("--star1", action="store_true",
+		help="prune expectimax chance nodes that can not change the move (Star1)")
+	parser.add_argument("--ntuple", metavar="WEIGHTS", help="score leaves with the n-tuple network in WEIGHTS instead of the heuristic")
+	parser.add_argument("--symmetric-keys", action="store_true",
+		help="share cache entries between rotations and reflections of a board (always on with --ntuple)")
+	parser.add_argument("--stats", metavar="PATH",
+		help="append a json line per expectimax/alphabeta search to PATH (see search_stats.py)")
+	parser.add_argument("--record", metavar="PATH", help="append every game to the replay log PATH (see replay.py)")
+	parser.add_argument("--seed", type=int, default=0, help="seed of the first game, game i uses seed+i")
+	parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: all cores)")
+	parser.add_argument("--json", metavar="PATH", help="also write the summary and per game results to PATH")
+	return parser.parse_args(argv)
+
+def main(argv=None):
+	args = parse_args(argv)
+	options = {
+		"strategy": args.strategy,
+		"policy": args.policy,
+		"expectimax_depth": args.expectimax_depth,
+		"alphabeta_depth": args.alphabeta_depth,
+		"move_time": args.move_time,
+		"playouts": args.playouts,
+		"playout_policy": args.playout_policy,
+		"iterations": args.iterations,
+		"engine": args.engine,
+		"tt_mb": args.tt_mb,
+		"leaf_cache": args.leaf_cache,
+		"prob_cutoff": args.prob_cutoff,
+		"star1": args.star1,
+		"ntuple": args.ntuple,
+		"symmetric_keys": args.symmetric_keys,
+		"stats": args.stats,
+		"record": args.record,
+	}
+
+	log = open_log(args.record) if args.record else None
+	start = time.perf_counter()
+	results = []
+	for result in run_games(options, args.games, args.seed, args.workers):
+		game_log = result.pop("log")
+		if log is not None:
+			log.write(game_log)
+			log.flush()
+		results.append(result)
+		print(f"game {len(results)}/{args.games}: seed {result['seed']} score {result['score']} "
+			f"max tile {result['max_tile']}", file=sys.stderr)
+	summary = summarize(results, time.perf_counter() - start)
+	if log is not None:
+		log.close()
+	print_summary(summary)
+
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump({"options": options, "summary": summary, "games": results}, f)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,315 @@
+# Noah Nisbet
+# Self-play training for the n-tuple evaluator
+# Learns n-tuple network weights with temporal difference learning
+# on afterstates, playing headless games across worker processes.
+#
+# example:
+#   python3 train.py --checkpoint weights.bin --hours 8
+#   python3 train.py --checkpoint weights.bin --resume --hours 8
+
+import argparse
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import sys
+import time
+
+import numpy as np
+
+import bitboard
+import ntuple
+from simulate import solver
+
+PATTERN_SETS = {
+	"default": ntuple.DEFAULT_PATTERNS,
+	"small": ntuple.SMALL_PATTERNS,
+}
+
+##########################################################
+# plays one game greedily with the network and learns from it
+#
+# TD(0) on afterstates: in every state the move with the best
+# reward + value(afterstate) is played, and the value of the
+# previous afterstate is moved towards that same reward + value.
+# The last afterstate of a game is moved towards 0 since nothing
+# more can be scored from it. Uses the game's move2 (through
+# get_child_boards) and terminal, and bitboard.spawn, the
+# spawn_blocks rule of the bitboard engine.
+##########################################################
+def play_training_game(game, network, learning_rate):
+	game.__init__()
+	board = game.get_search_board()
+	score = 0
+	moves = 0
+	updates = 0
+	prev = None
+
+	while not game.terminal(board):
+		best_value = None
+		for move, child_board, reward in game.get_child_boards(1, board):
+			value = reward + network.value(child_board)
+			if best_value is None or value > best_value:
+				best_value = value
+				best_board = child_board
+				best_reward = reward
+
+		if prev is not None:
+			network.learn(prev, best_value, learning_rate)
+			updates+=1
+		prev = best_board
+		score += best_reward
+		moves+=1
+		board = bitboard.spawn(best_board)
+
+	if prev is not None:
+		network.learn(prev, 0, learning_rate)
+		updates+=1
+
+	return {
+		"score": score,
+		"max_tile": bitboard.max_tile(board),
+		"moves": moves,
+		"updates": updates,
+	}
+
+##########################################################
+# worker process, trains on the shared weights until stop is set
+#
+# All workers update the same weights in shared memory without
+# locks, so each game is played with the newest weights of every
+# worker. Rare lost updates from two workers writing one weight at
+# the same time do not matter to the learning. Results are sent to
+# the trainer every sync_games games.
+##########################################################
+def _train_worker(index, weights, patterns, learning_rate, seed, sync_games, results, stop):
+	# ctrl-c is handled by the trainer, which sets stop
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	random.seed(seed)
+	network = ntuple.NTupleNetwork(patterns, memoryview(weights).cast("f"))
+	game = solver.BitboardGame2048()
+
+	batch = []
+	while not stop.is_set():
+		batch.append(play_training_game(game, network, learning_rate))
+		if len(batch) >= sync_games:
+			results.put(batch)
+			batch = []
+	results.put(batch)
+	# tells the trainer this worker is done
+	results.put(index)
+
+##########################################################
+# Checkpoints
+#
+# A checkpoint is a float32 weight file (ntuple.load reads it) and
+# a json file next to it with the training totals. Both are written
+# under temporary names and renamed so a crash never leaves half a
+# checkpoint.
+##########################################################
+def checkpoint_paths(path):
+	return path, f"{path}.json"
+
+def save_checkpoint(path, network, state):
+	weights_path, state_path = checkpoint_paths(path)
+	network.save(f"{weights_path}.tmp")
+	os.replace(f"{weights_path}.tmp", weights_path)
+	with open(f"{state_path}.tmp", "w") as f:
+		json.dump(state, f, indent=1)
+	os.replace(f"{state_path}.tmp", state_path)
+
+##########################################################
+# returns the patterns, float32 weights and state of a checkpoint
+##########################################################
+def load_checkpoint(path):
+	weights_path, state_path = checkpoint_paths(path)
+	with ntuple.load(weights_path) as network:
+		weights = np.asarray(network.weights, dtype=np.float32)*np.float32(network.scale)
+		patterns = network.patterns
+	with open(state_path) as f:
+		state = json.load(f)
+	return patterns, weights, state
+
+##########################################################
+# one learning curve row for the games finished since the last row
+##########################################################
+def curve_row(state, window, window_seconds, session_games, session_updates, session_seconds):
+	scores = [result["score"] for result in window]
+	return {
+		"seconds": state["seconds"],
+		"games": state["games"],
+		"updates": state["updates"],
+		"games_per_hour": 3600*session_games / session_seconds if session_seconds > 0 else 0.0,
+		"updates_per_second": session_updates / session_seconds if session_seconds > 0 else 0.0,
+		"window_games": len(window),
+		"window_seconds": window_seconds,
+		"mean_score": sum(scores) / len(scores) if scores else 0.0,
+		"max_score": max(scores) if scores else 0,
+		"mean_moves": sum(result["moves"] for result in window) / len(window) if window else 0.0,
+		"reached_2048": sum(result["max_tile"] >= 2048 for result in window) / len(window) if window else 0.0,
+	}
+
+def print_row(row):
+	print(f"games {row['games']}  mean score {row['mean_score']:.0f}  max {row['max_score']}  "
+		f"2048 rate {100*row['reached_2048']:.1f}%  {row['games_per_hour']:.0f} games/h  "
+		f"{row['updates_per_second']:.0f} updates/s", flush=True)
+
+##########################################################
+# runs training until max_games games or max_hours hours have been
+# played in total (including earlier runs when resuming) or until
+# interrupted, then writes a final checkpoint
+##########################################################
+def train(options):
+	if options["resume"]:
+		patterns, initial, state = load_checkpoint(options["checkpoint"])
+	else:
+		patterns = PATTERN_SETS[options["patterns"]]
+		initial = None
+		state = {"games": 0, "moves": 0, "updates": 0, "seconds": 0.0}
+	state["learning_rate"] = options["learning_rate"]
+
+	# anonymous shared memory, inherited by the forked workers
+	shared = mmap.mmap(-1, 4*ntuple.table_size(patterns))
+	weights = np.frombuffer(shared, dtype=np.float32)
+	if initial is not None:
+		weights[:] = initial
+	network = ntuple.NTupleNetwork(patterns, memoryview(shared).cast("f"))
+
+	context = multiprocessing.get_context("fork")
+	results = context.Queue()
+	stop = context.Event()
+	workers = []
+	for i in range(options["workers"]):
+		seed = options["seed"] + 1000*state["games"] + i
+		workers.append(context.Process(target=_train_worker, daemon=True, args=(i, shared, patterns,
+			options["learning_rate"], seed, options["sync_games"], results, stop)))
+	for worker in workers:
+		worker.start()
+
+	session_start = time.perf_counter()
+	start_seconds = state["seconds"]
+	session_games = 0
+	session_updates = 0
+	window = []
+	last_log = last_checkpoint = session_start
+	running = len(workers)
+	# workers that reported they are done or died
+	finished = set()
+	failed = []
+
+	def write_row(now):
+		nonlocal window, last_log
+		row = curve_row(state, window, now - last_log, session_games, session_updates, now - session_start)
+		print_row(row)
+		if options["curve"]:
+			with open(options["curve"], "a") as f:
+				f.write(json.dumps(row) + "\n")
+		window = []
+		last_log = now
+
+	while running > 0:
+		try:
+			try:
+				batch = results.get(timeout=1)
+			except queue.Empty:
+				batch = []
+			if isinstance(batch, int):
+				finished.add(batch)
+				running-=1
+				continue
+
+			for result in batch:
+				window.append(result)
+				session_games+=1
+				session_updates += result["updates"]
+				state["games"]+=1
+				state["moves"] += result["moves"]
+				state["updates"] += result["updates"]
+
+			now = time.perf_counter()
+			state["seconds"] = start_seconds + now - session_start
+			if now - last_log >= options["log_every"] and window:
+				write_row(now)
+			if now - last_checkpoint >= options["checkpoint_every"]:
+				save_checkpoint(options["checkpoint"], network, state)
+				last_checkpoint = now
+
+			# a worker that raised or was killed never reports it is done,
+			# the others are stopped and the checkpoint is still written
+			for i, worker in enumerate(workers):
+				if i not in finished and worker.exitcode not in (None, 0):
+					print(f"training worker {i} died with exit code {worker.exitcode}, stopping", file=sys.stderr)
+					finished.add(i)
+					running-=1
+					failed.append(i)
+					stop.set()
+
+			done = options["games"] is not None and state["games"] >= options["games"]
+			done = done or (options["hours"] is not None and state["seconds"] >= 3600*options["hours"])
+			if done:
+				stop.set()
+		except KeyboardInterrupt:
+			print("interrupted, finishing the current games", file=sys.stderr)
+			stop.set()
+
+	for worker in workers:
+		worker.join()
+
+	now = time.perf_counter()
+	state["seconds"] = start_seconds + now - session_start
+	if window:
+		write_row(now)
+	save_checkpoint(options["checkpoint"], network, state)
+	if options["export"]:
+		network.save(options["export"], "h")
+	if failed:
+		raise RuntimeError(f"training workers {failed} died, the checkpoint holds the games played before")
+	return state
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description="Train n-tuple network weights by self-play.")
+	parser.add_argument("--checkpoint", metavar="PATH", default="ntuple_weights.bin",
+		help="float32 weight file written periodically, training totals go to PATH.json")
+	parser.add_argument("--resume", action="store_true", help="continue from --checkpoint")
+	parser.add_argument("--patterns", choices=sorted(PATTERN_SETS), default="default",
+		help="pattern set of a new network, ignored when resuming")
+	parser.add_argument("--learning-rate", type=float, default=0.1,
+		help="TD step size, spread over the weights of a board")
+	parser.add_argument("--games", type=int, default=None, help="stop after this many games in total")
+	parser.add_argument("--hours", type=float, default=None, help="stop after this many hours of training in total")
+	parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="worker processes (default: all cores)")
+	parser.add_argument("--sync-games", type=int, default=10, help="games a worker plays between reports")
+	parser.add_argument("--log-every", type=float, default=60, help="seconds between learning curve rows")
+	parser.add_argument("--checkpoint-every", type=float, default=600, help="seconds between checkpoints")
+	parser.add_argument("--curve", metavar="PATH", help="append learning curve rows to PATH as json lines")
+	parser.add_argument("--export", metavar="PATH", help="also write int16 weights for play to PATH at the end")
+	parser.add_argument("--seed", type=int, default=0)
+	return parser.parse_args(argv)
+
+def main(argv=None):
+	args = parse_args(argv)
+	if args.games is None and args.hours is None:
+		print("give --games or --hours, or stop training with ctrl-c", file=sys.stderr)
+	options = {
+		"checkpoint": args.checkpoint,
+		"resume": args.resume,
+		"patterns": args.patterns,
+		"learning_rate": args.learning_rate,
+		"games": args.games,
+		"hours": args.hours,
+		"workers": args.workers,
+		"sync_games": args.sync_games,
+		"log_every": args.log_every,
+		"checkpoint_every": args.checkpoint_every,
+		"curve": args.curve,
+		"export": args.export,
+		"seed": args.seed,
+	}
+	state = train(options)
+	print(f"trained {state['games']} games, {state['updates']} updates in {state['seconds']/3600:.2f} h")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,217 @@
+# Noah Nisbet
+# Transposition table for the 2048 searches
+# Different move orders reach the same board, this stores the value
+# of a searched position so it is only searched once.
+
+from collections import OrderedDict
+
+# node types used in transposition table keys
+MAX_NODE = 0
+CHANCE_NODE = 1
+MIN_NODE = 2
+
+# bound types for alphabeta values
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# approximate size of one stored entry (key tuple, entry tuple,
+# value and the dictionary slots holding them) on 64-bit CPython
+ENTRY_BYTES = 400
+
+##########################################################
+# Transposition table
+#
+# Keys are tuples that start with the node type, then the board
+# and the remaining depth (see Game2048.expectimax and
+# Game2048.alphabeta). Entries are (value, best_move, flag).
+#
+# The table holds at most max_bytes // ENTRY_BYTES entries. When
+# it is full an entry is evicted using policy:
+# "depth" = drop the oldest entry with the smallest remaining
+#           depth, a new entry shallower than everything stored
+#           is dropped instead
+# "lru"   = drop the least recently used entry
+#
+# If persist is False the table is cleared at the start of every
+# search, otherwise entries are kept between moves until clear is
+# called (Game2048 clears it when a new game starts).
+##########################################################
+class TranspositionTable:
+	def __init__(self, max_bytes=64*1024*1024, policy="depth", persist=False):
+		if policy not in ("depth", "lru"):
+			raise ValueError(f"unknown eviction policy: {policy}")
+		self.max_entries = max(1, max_bytes // ENTRY_BYTES)
+		self.policy = policy
+		self.persist = persist
+		self.entries = OrderedDict()
+		# for the depth policy, keys of each depth in insertion order
+		self.by_depth = {}
+
+		self.hits = 0
+		self.misses = 0
+		self.stores = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	##########################################################
+	# returns the entry stored for key or None
+	##########################################################
+	def get(self, key):
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses+=1
+			return None
+		self.hits+=1
+		if self.policy == "lru":
+			self.entries.move_to_end(key)
+		return entry
+
+	##########################################################
+	# store a value for key, depth is the remaining search depth
+	##########################################################
+	def put(self, key, depth, value, move=None, flag=EXACT):
+		if key in self.entries:
+			self.entries[key] = (value, move, flag)
+			if self.policy == "lru":
+				self.entries.move_to_end(key)
+			return
+
+		if len(self.entries) >= self.max_entries:
+			if not self.evict(depth):
+				return
+
+		self.entries[key] = (value, move, flag)
+		if self.policy == "depth":
+			self.by_depth.setdefault(depth, {})[key] = None
+		self.stores+=1
+
+	##########################################################
+	# make room for an entry of the given depth, returns False if
+	# the new entry should not be stored
+	##########################################################
+	def evict(self, depth):
+		self.evictions+=1
+		if self.policy == "lru":
+			self.entries.popitem(last=False)
+			return True
+
+		shallowest = min(self.by_depth)
+		if depth < shallowest:
+			return False
+		bucket = self.by_depth[shallowest]
+		key = next(iter(bucket))
+		del bucket[key]
+		if not bucket:
+			del self.by_depth[shallowest]
+		del self.entries[key]
+		return True
+
+	##########################################################
+	# called at the start of every search
+	##########################################################
+	def new_search(self):
+		if not self.persist:
+			self.clear()
+
+	def clear(self):
+		self.entries.clear()
+		self.by_depth.clear()
+
+	##########################################################
+	# hit, miss and eviction counters
+	##########################################################
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"hit_rate": self.hits / lookups if lookups else 0.0,
+			"stores": self.stores,
+			"evictions": self.evictions,
+			"entries": len(self.entries),
+			"max_entries": self.max_entries,
+		}
+
+	def reset_stats(self):
+		self.hits = 0
+		self.misses = 0
+		self.stores = 0
+		self.evictions = 0
+
+##########################################################
+# Leaf cache
+#
+# Keeps the evaluation of the leaves of one expectimax search for
+# the next. Between two moves only the branch of the move that was
+# played and the tile that spawned is searched again, so entries
+# live in two generations: the leaves scored by the current search
+# and the leaves scored by the previous one. A lookup moves an
+# entry into the current generation and new_search drops whatever
+# the last search did not use, so the cache holds at most two
+# searches' worth of leaves and never more than max_entries per
+# generation.
+#
+# Most hits come from within a search: boards that differ only
+# where a tile spawned often slide to the same board, which the
+# transposition table does not catch at depth 0.
+##########################################################
+class LeafCache:
+	def __init__(self, max_entries=1000000):
+		self.max_entries = max_entries
+		self.root = None
+		self.current = {}
+		self.previous = {}
+
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self.current) + len(self.previous)
+
+	def get(self, key):
+		value = self.current.get(key)
+		if value is None:
+			value = self.previous.pop(key, None)
+			if value is None:
+				self.misses+=1
+				return None
+			self.current[key] = value
+		self.hits+=1
+		return value
+
+	def put(self, key, value):
+		if len(self.current) < self.max_entries:
+			self.current[key] = value
+
+	##########################################################
+	# called at the start of every search with the key of its root.
+	# Searches of the same root (iterative deepening) stay in one
+	# generation.
+	##########################################################
+	def new_search(self, root):
+		if root == self.root:
+			return
+		self.root = root
+		self.previous = self.current
+		self.current = {}
+
+	def clear(self):
+		self.root = None
+		self.current = {}
+		self.previous = {}
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"hit_rate": self.hits / lookups if lookups else 0.0,
+			"entries": len(self),
+		}
+
+	def reset_stats(self):
+		self.hits = 0
+		self.misses = 0